@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import time
+import random
+import argparse
+
+import networkx as nx
+
+from cartprograph.index import AncestorIndex
+
+
+def build(num_nodes, window, seed):
+    rng = random.Random(seed)
+    graph = nx.DiGraph()
+    ancestor_index = AncestorIndex()
+    graph.add_node(0)
+    ancestor_index.add(0, None)
+    ancestor_index.set_lengths(0, {"basic_blocks": rng.randrange(1000)})
+    for node_id in range(1, num_nodes):
+        parent_id = rng.randrange(max(0, node_id - window), node_id)
+        graph.add_edge(parent_id, node_id)
+        ancestor_index.add(node_id, parent_id)
+        ancestor_index.set_lengths(node_id, {"basic_blocks": rng.randrange(1000)})
+    return graph, ancestor_index
+
+
+def reversed_dfs(graph, node_id):
+    return list(
+        reversed([node_id, *(e[1] for e in nx.dfs_edges(graph.reverse(), node_id))])
+    )
+
+
+def measure(fn, node_ids):
+    start_time = time.perf_counter()
+    for node_id in node_ids:
+        fn(node_id)
+    return (time.perf_counter() - start_time) / len(node_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare reversed-graph DFS with the ancestor index"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--window", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for num_nodes in args.sizes:
+        graph, ancestor_index = build(num_nodes, args.window, args.seed)
+        rng = random.Random(args.seed)
+        node_ids = [rng.randrange(num_nodes) for _ in range(args.queries)]
+
+        for node_id in node_ids[:10]:
+            assert reversed_dfs(graph, node_id) == ancestor_index.ancestors(node_id)
+
+        dfs_time = measure(lambda node_id: reversed_dfs(graph, node_id), node_ids)
+        index_time = measure(ancestor_index.ancestors, node_ids)
+        offsets_time = measure(ancestor_index.offsets, node_ids)
+        depth = sum(ancestor_index.depth(node_id) for node_id in node_ids) / len(
+            node_ids
+        )
+
+        print(
+            f"{num_nodes} nodes (mean depth {depth:.0f}): "
+            f"reversed dfs {dfs_time * 1e3:.3f}ms, "
+            f"ancestor index {index_time * 1e3:.3f}ms, "
+            f"offsets {offsets_time * 1e6:.3f}us"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import json
+import time
+import argparse
+import platform
+import threading
+import urllib.request
+
+from benchmarks.harness import commit, compare, latency, results_path
+
+ROUTES = {
+    "index": lambda node_id: "/",
+    "nodes": lambda node_id: "/nodes",
+    "socketio": lambda node_id: "/socket.io/?EIO=4&transport=polling",
+    "trace": lambda node_id: f"/trace/{node_id}",
+    "basic_blocks": lambda node_id: f"/trace/basic_blocks/{node_id}",
+    "syscalls": lambda node_id: f"/trace/syscalls/{node_id}",
+    "metrics": lambda node_id: "/metrics",
+}
+# Cheap routes timed while the heavy trace requests are running
+PROBES = ["index", "nodes", "socketio"]
+
+
+def get(url):
+    request = urllib.request.Request(url, headers={"Accept": "application/json"})
+    start_time = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - start_time
+
+
+def heaviest_node(url):
+    with urllib.request.urlopen(f"{url}/nodes") as response:
+        node_ids = json.load(response)["nodes"]
+    if not node_ids:
+        raise RuntimeError("No nodes to request traces for")
+
+    def size(node_id):
+        request = urllib.request.Request(
+            f"{url}/trace/basic_blocks/{node_id}?limit=0",
+            headers={"Accept": "application/json"},
+        )
+        with urllib.request.urlopen(request) as response:
+            return int(response.headers.get("X-Total-Count") or 0)
+
+    return max(node_ids, key=size)
+
+
+def worker(url, deadline, times, errors):
+    while time.monotonic() < deadline:
+        try:
+            times.append(get(url))
+        except OSError:
+            errors.append(url)
+
+
+def run(clients, duration):
+    # Every (name, url, threads) client requests its url in a loop from that
+    # many threads, all at the same time, until the duration is up
+    deadline = time.monotonic() + duration
+    times = {name: [] for name, _, _ in clients}
+    errors = {name: [] for name, _, _ in clients}
+    threads = [
+        threading.Thread(target=worker, args=(url, deadline, times[name], errors[name]))
+        for name, url, num_threads in clients
+        for _ in range(num_threads)
+    ]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total_time = time.perf_counter() - start_time
+    return {
+        name: {
+            "requests_per_second": len(times[name]) / total_time,
+            "errors": len(errors[name]),
+            "latency": latency(times[name]),
+        }
+        for name in times
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure web server routes under concurrent requests"
+    )
+    parser.add_argument("--url", default="http://localhost:4242")
+    parser.add_argument("--routes", nargs="+", choices=ROUTES, default=list(ROUTES))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument(
+        "--node", type=int, help="node to request traces for, the largest by default"
+    )
+    parser.add_argument("--output", help="where to write the results as JSON")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    url = args.url.rstrip("/")
+    node_id = args.node if args.node is not None else heaviest_node(url)
+    results = {
+        "commit": commit(),
+        "time": time.time(),
+        "python": platform.python_version(),
+        "params": {
+            **{
+                name: value
+                for name, value in vars(args).items()
+                if name not in ["output", "compare"]
+            },
+            "node": node_id,
+        },
+        "results": {},
+    }
+
+    for concurrency in args.concurrency:
+        result = {}
+        for name in args.routes:
+            result[name] = run(
+                [(name, f"{url}{ROUTES[name](node_id)}", concurrency)], args.duration
+            )[name]
+            print(f"{name} x{concurrency}: {json.dumps(result[name])}")
+        # Whole traces of the largest node, with one client on each probe
+        result["contended"] = run(
+            [("trace", f"{url}{ROUTES['trace'](node_id)}", concurrency)]
+            + [(name, f"{url}{ROUTES[name](node_id)}", 1) for name in PROBES],
+            args.duration,
+        )
+        print(f"contended x{concurrency}: {json.dumps(result['contended'])}")
+        results["results"][str(concurrency)] = result
+
+    output = args.output or results_path("concurrency", results)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import platform
+import subprocess
+import urllib.request
+import importlib.util
+
+import redis
+
+from cartprograph import context, Node, blocks, metrics, timing
+from cartprograph.blocks import BasicBlocks
+from cartprograph.index import AncestorIndex
+from cartprograph.prefixes import PrefixCache
+from cartprograph.scheduler import Scheduler
+
+# The workers log every node they write
+os.environ.setdefault("LOGLEVEL", "WARNING")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Ignored by git, so runs never end up committed
+RESULTS = os.path.join(ROOT, "benchmarks", "results")
+MAPS = [
+    {
+        "start_address": 0x400000,
+        "end_address": 0x500000,
+        "pathname": "/challenge",
+        "offset": 0,
+        "permissions": "r-xp",
+    }
+]
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def git(*args):
+    return subprocess.run(
+        ["git", *args], cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout.strip()
+
+
+def commit():
+    try:
+        head = git("rev-parse", "HEAD")
+        dirty = git("status", "--porcelain", "--untracked-files=no")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{head}-dirty" if dirty else head
+
+
+def results_path(name, results):
+    os.makedirs(RESULTS, exist_ok=True)
+    return os.path.join(RESULTS, f"{name}-{(results['commit'] or 'unknown')[:12]}.json")
+
+
+def latency(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": metrics.quantile(values, 0.5),
+        "p99": metrics.quantile(values, 0.99),
+        "max": values[-1],
+    }
+
+
+def memory(redis_client):
+    return {
+        # ru_maxrss is in kilobytes on Linux
+        "max_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "redis_used": redis_client.info("memory")["used_memory"],
+    }
+
+
+def blocked(interactions):
+    return bool(interactions) and interactions[-1]["data"] is None
+
+
+def timed(fn, *args):
+    start_time = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start_time
+
+
+class SyntheticTrace:
+    # Every job is traced the same way: the node's input, trace_size blocks
+    # with an output halfway through, then a read that blocks for the next
+    # input. Each traced input adds an input, output and blocked node.
+    def __init__(self, trace_size, syscalls, seed):
+        self.trace_size = max(trace_size, 4)
+        self.syscalls = syscalls
+        self.rng = random.Random(seed)
+
+    def payload(self, job, trace_index):
+        size = self.trace_size
+        output_index = trace_index + size // 2
+        blocked_index = trace_index + size - 1
+        basic_blocks = BasicBlocks(
+            0x400000 + self.rng.randrange(0x100000) for _ in range(size)
+        )
+        interactions = list(job["interactions"][-1:])
+        syscalls = list(job["syscalls"][-1:])
+        # Extra syscalls the tracer records but that do not interact
+        for i in range(self.syscalls):
+            syscall_index = trace_index + 1 + i * (size // 2 - 1) // self.syscalls
+            syscalls.append(
+                {
+                    "nr": 39,
+                    "name": "getpid",
+                    "args": [],
+                    "ret": 1,
+                    "trace_index": syscall_index,
+                }
+            )
+        syscalls.append(
+            {
+                "nr": 1,
+                "name": "write",
+                "args": [1, 0, 6],
+                "ret": 6,
+                "trace_index": output_index,
+            }
+        )
+        interactions.append(
+            {
+                "channel": "stdio",
+                "direction": "output",
+                "data": "world\n",
+                "trace_index": output_index,
+            }
+        )
+        syscalls.append(
+            {
+                "nr": 0,
+                "name": "read",
+                "args": [0, 0, 128],
+                "ret": None,
+                "trace_index": blocked_index,
+            }
+        )
+        interactions.append(
+            {
+                "channel": "stdio",
+                "direction": "input",
+                "data": None,
+                "trace_index": blocked_index,
+            }
+        )
+        return {
+            "node_id": job["node_id"],
+            "job": job["job"]["id"],
+            "seq": 0,
+            "trace_index": trace_index,
+            "basic_blocks": blocks.dumps(basic_blocks),
+            "syscalls": syscalls,
+            "interactions": interactions,
+            "datapoints": [],
+            "maps": MAPS,
+            "timing": job.get("timing"),
+        }
+
+
+class Harness:
+    def __init__(self, redis_client, args):
+        self.redis_client = redis_client
+        self.args = args
+
+        # The workers connect to the default database when imported, so they
+        # are pointed at the benchmark database instead
+        self.graph_worker = load_module("graph_worker", "workers/graph_worker.py")
+        self.graph_worker.redis_client = redis_client
+        self.graph_worker.prefix_cache = PrefixCache(redis_client)
+        context["redis_client"] = redis_client
+        context["cached_graph"] = None
+        context["ancestor_index"] = AncestorIndex(redis_client)
+        self.scheduler = Scheduler(redis_client, "benchmark")
+        self.trace = SyntheticTrace(args.trace_size, args.syscalls, args.seed)
+
+    def trace_next_job(self):
+        job = self.scheduler.next_job(timeout=1)
+        if job is None:
+            raise RuntimeError("No trace job was queued")
+        trace_index = context["ancestor_index"].trace_index(job["node_id"])
+        payload = self.trace.payload(job, trace_index)
+        event = {
+            "channel": b"event.trace.blocked.0",
+            "id": b"0-0",
+            "data": json.dumps(payload).encode(),
+            "timing": None,
+        }
+        _, trace_time = timed(self.graph_worker.handle_trace_event, event)
+        self.scheduler.done(job)
+        return trace_time
+
+    def blocked_leaves(self):
+        edges = Node.edges()
+        parents = set(edges.values())
+        leaves = [node_id for node_id in edges if node_id not in parents]
+        return [
+            node.id
+            for node in Node.load_many(leaves, ["segments"])
+            if blocked(node.interactions)
+        ]
+
+    def run_traces(self):
+        # Breadth first, every blocked node gets fanout inputs until depth
+        # rounds of input have been traced
+        input_times = []
+        trace_times = []
+        start_time = time.perf_counter()
+        self.graph_worker.initialize_graph()
+        trace_times.append(self.trace_next_job())
+        # Input nodes are siblings of the blocked node, which stays a leaf
+        answered = set()
+        frontier = self.blocked_leaves()
+        for _ in range(self.args.depth):
+            answered.update(frontier)
+            for node_id in frontier:
+                for i in range(self.args.fanout):
+                    event = {
+                        "data": json.dumps(
+                            {"id": node_id, "data": f"input {i}\n"}
+                        ).encode()
+                    }
+                    _, input_time = timed(self.graph_worker.handle_input_event, event)
+                    input_times.append(input_time)
+                    trace_times.append(self.trace_next_job())
+            frontier = [
+                node_id for node_id in self.blocked_leaves() if node_id not in answered
+            ]
+        total_time = time.perf_counter() - start_time
+        num_nodes = self.redis_client.zcard("nodes")
+        return {
+            "nodes": num_nodes,
+            "traces": len(trace_times),
+            "nodes_per_second": num_nodes / total_time,
+            "traces_per_second": len(trace_times) / total_time,
+            "input_latency": latency(input_times),
+            "trace_latency": latency(trace_times),
+            "memory": memory(self.redis_client),
+        }
+
+    def run_storage(self):
+        # Node writes and reads on their own, without the graph worker
+        rng = random.Random(self.args.seed)
+        size = self.args.trace_size
+        num_nodes = sum(
+            self.args.fanout**depth for depth in range(self.args.depth + 1)
+        )
+        first_id = Node.allocate_id()
+        for _ in range(num_nodes - 1):
+            Node.allocate_id()
+
+        write_times = []
+        start_time = time.perf_counter()
+        for i in range(num_nodes):
+            node_id = first_id + i
+            parent_id = None if i == 0 else first_id + (i - 1) // self.args.fanout
+            basic_blocks = BasicBlocks(
+                0x400000 + rng.randrange(0x100000) for _ in range(size)
+            )
+            syscalls = [
+                {"nr": 39, "name": "getpid", "args": [], "ret": 1, "trace_index": j}
+                for j in range(self.args.syscalls)
+            ]
+
+            def write():
+                node = Node.create(node_id)
+                with node.batch():
+                    node.parent_id = parent_id
+                    node.basic_blocks = basic_blocks
+                    node.syscalls = syscalls
+                    node.interactions = []
+                    node.datapoints = []
+
+            _, write_time = timed(write)
+            write_times.append(write_time)
+        write_total = time.perf_counter() - start_time
+
+        read_times = []
+        start_time = time.perf_counter()
+        for i in range(num_nodes):
+            node = Node(first_id + i)
+            _, read_time = timed(
+                lambda: [getattr(node, name) for name in Node.trace_attributes]
+            )
+            read_times.append(read_time)
+        read_total = time.perf_counter() - start_time
+        return {
+            "nodes": num_nodes,
+            "writes_per_second": num_nodes / write_total,
+            "reads_per_second": num_nodes / read_total,
+            "write_latency": latency(write_times),
+            "read_latency": latency(read_times),
+            "memory": memory(self.redis_client),
+        }
+
+    def run_endpoints(self):
+        # Importing the server monkey patches the process, so this runs last
+        server = load_module("server", "web/server.py")
+        server.redis_client = self.redis_client
+        server.ancestor_index = AncestorIndex(self.redis_client)
+        context["redis_client"] = self.redis_client
+        client = server.app.test_client()
+
+        node_ids = Node.ids()
+        rng = random.Random(self.args.seed)
+        sample = [rng.choice(node_ids) for _ in range(self.args.requests)]
+        endpoints = {
+            "nodes": lambda node_id: "/nodes",
+            "trace": lambda node_id: f"/trace/{node_id}",
+            "trace_window": lambda node_id: f"/trace/{node_id}?limit=16",
+            "basic_blocks": lambda node_id: f"/trace/basic_blocks/{node_id}",
+            "syscalls": lambda node_id: f"/trace/syscalls/{node_id}",
+            "coverage": lambda node_id: "/coverage",
+            "metrics": lambda node_id: "/metrics",
+        }
+        results = {}
+        for name, url in endpoints.items():
+            request_times = []
+            start_time = time.perf_counter()
+            for node_id in sample:
+                response, request_time = timed(client.get, url(node_id))
+                if response.status_code != 200:
+                    raise RuntimeError(f"{url(node_id)}: {response.status_code}")
+                request_times.append(request_time)
+            total_time = time.perf_counter() - start_time
+            results[name] = {
+                "requests_per_second": len(sample) / total_time,
+                "latency": latency(request_times),
+            }
+        results["memory"] = memory(self.redis_client)
+        return results
+
+
+def run_pipeline(url, inputs, timeout):
+    # Drives a running deployment tracing simple_program, and times each
+    # input from the web server until its node update is broadcast
+    def request(path, data=None):
+        if data is not None:
+            data = json.dumps(data).encode()
+        http_request = urllib.request.Request(
+            f"{url}{path}", data, {"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(http_request) as response:
+            return json.load(response)
+
+    deadline = time.monotonic() + timeout
+    while True:
+        blocked_ids = [
+            node_id
+            for node_id in request("/nodes")["nodes"]
+            if blocked(request(f"/trace/{node_id}?attrs=interactions")["interactions"])
+        ]
+        if blocked_ids or time.monotonic() >= deadline:
+            break
+        time.sleep(1)
+    if not blocked_ids:
+        raise RuntimeError("No blocked node to send input to")
+
+    traces = {}
+    start_time = time.perf_counter()
+    for i in range(inputs):
+        data = ["hello\n", "hola\n", "what\n"][i % 3] + str(i) * (i // 3)
+        response = request(
+            f"/input/{blocked_ids[0]}", {"input": data, "priority": "interactive"}
+        )
+        traces[response["trace"]] = None
+
+    while time.monotonic() < deadline:
+        for job_timing in request(f"/timings?count={max(inputs * 4, 100)}"):
+            if job_timing["id"] in traces and "broadcast" in job_timing["stages"]:
+                traces[job_timing["id"]] = job_timing
+        if all(traces.values()):
+            break
+        time.sleep(0.5)
+    total_time = time.perf_counter() - start_time
+
+    stages = {}
+    done = [job_timing for job_timing in traces.values() if job_timing]
+    for job_timing in done:
+        for stage, duration in timing.durations(job_timing).items():
+            stages.setdefault(stage, []).append(duration)
+    return {
+        "inputs": inputs,
+        "completed": len(done),
+        "traces_per_second": len(done) / total_time,
+        "stages": {stage: latency(values) for stage, values in stages.items()},
+    }
+
+
+def compare(results, baseline):
+    # Throughputs should not go down, latencies should not go up
+    def walk(current, previous, path):
+        for name, value in current.items():
+            if name not in previous:
+                continue
+            if isinstance(value, dict):
+                walk(value, previous[name], f"{path}{name}.")
+            elif name.endswith("per_second") or name in ["p50", "p99"]:
+                old = previous[name]
+                if old:
+                    print(
+                        f"  {path}{name}: {old:.4g} -> {value:.4g} ({value / old - 1:+.1%})"
+                    )
+
+    print(f"Compared with {baseline.get('commit')}:")
+    walk(results["results"], baseline["results"], "")
+
+
+WORKLOADS = ["traces", "storage", "endpoints"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark graph building, node storage and the web endpoints"
+    )
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=WORKLOADS)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--fanout", type=int, default=3)
+    parser.add_argument("--trace-size", type=int, default=1000)
+    parser.add_argument("--syscalls", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--redis", default="redis://localhost:6379/15")
+    parser.add_argument(
+        "--flush",
+        action="store_true",
+        help="allow running in a database that is not empty, it is flushed",
+    )
+    parser.add_argument(
+        "--pipeline",
+        metavar="URL",
+        help="also drive a running deployment, e.g. http://localhost:4242",
+    )
+    parser.add_argument("--pipeline-inputs", type=int, default=20)
+    parser.add_argument("--pipeline-timeout", type=float, default=300)
+    parser.add_argument("--output", help="where to write the results as JSON")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    redis_client = redis.Redis.from_url(args.redis)
+    if redis_client.dbsize() and not args.flush:
+        sys.exit(f"{args.redis} is not empty, pass --flush to use it anyway")
+
+    results = {
+        "commit": commit(),
+        "time": time.time(),
+        "python": platform.python_version(),
+        "params": {
+            name: value
+            for name, value in vars(args).items()
+            if name not in ["output", "compare", "flush"]
+        },
+        "results": {},
+    }
+
+    for name in sorted(args.workloads, key=WORKLOADS.index):
+        redis_client.flushdb()
+        harness = Harness(redis_client, args)
+        # The endpoints are measured against the graph the traces build
+        if name == "endpoints":
+            harness.run_traces()
+        result = getattr(harness, f"run_{name}")()
+        results["results"][name] = result
+        print(f"{name}: {json.dumps(result)}")
+    redis_client.flushdb()
+
+    if args.pipeline:
+        results["results"]["pipeline"] = run_pipeline(
+            args.pipeline.rstrip("/"), args.pipeline_inputs, args.pipeline_timeout
+        )
+        print(f"pipeline: {json.dumps(results['results']['pipeline'])}")
+
+    output = args.output or results_path("benchmark", results)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import time
+import ctypes
+import random
+import argparse
+
+from cartprograph import tracing
+from cartprograph.blocks import BasicBlocks
+from cartprograph.tracing import Desync, TracingList, TracingBlocks
+
+
+def record(num_blocks, batch_size, syscall_interval, seed):
+    rng = random.Random(seed)
+    basic_blocks = BasicBlocks(rng.randrange(2**47) for _ in range(num_blocks))
+    batches = []
+    syscalls = [
+        {"nr": None, "name": "execve", "args": [], "ret": None, "trace_index": -1}
+    ]
+    for start in range(0, num_blocks, batch_size):
+        end = min(start + batch_size, num_blocks)
+        batch = (ctypes.c_uint64 * (end - start))(*basic_blocks[start:end])
+        syscall = None
+        if (start // batch_size) % syscall_interval == 0:
+            syscall = {
+                "nr": 0,
+                "name": "read",
+                "args": [0, 0x7FFC0000, 4096],
+                "ret": rng.randrange(4096),
+                "trace_index": end - 1,
+            }
+            syscalls.append(syscall)
+        batches.append((batch, syscall))
+    return basic_blocks, syscalls, batches
+
+
+def replay(mode, basic_blocks, syscalls, batches):
+    traced_blocks = TracingBlocks(basic_blocks, verify=mode)
+    traced_syscalls = TracingList(syscalls, verify=mode)
+    traced_syscalls.append(syscalls[0])
+    for batch, syscall in batches:
+        traced_blocks.extend(batch)
+        if syscall is not None:
+            traced_blocks.checkpoint()
+            traced_syscalls.append(dict(syscall, ret=None), ignore_attrs=["ret"])
+
+
+def desynced(batches, position):
+    # Once replay takes a different path, every later block differs too
+    batches = list(batches)
+    for index in range(position, len(batches)):
+        batch, syscall = batches[index]
+        batch = (ctypes.c_uint64 * len(batch))(*(address ^ 0x10 for address in batch))
+        batches[index] = (batch, syscall)
+    return batches
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure prefix replay speed for each verification mode"
+    )
+    parser.add_argument("--blocks", type=int, default=1000000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--syscall-interval", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    basic_blocks, syscalls, batches = record(
+        args.blocks, args.batch_size, args.syscall_interval, args.seed
+    )
+    rng = random.Random(args.seed)
+    desync_positions = [rng.randrange(len(batches)) for _ in range(10)]
+
+    for mode in tracing.VERIFY_MODES:
+        replay_time = float("inf")
+        for _ in range(args.repeat):
+            start_time = time.perf_counter()
+            replay(mode, basic_blocks, syscalls, batches)
+            replay_time = min(replay_time, time.perf_counter() - start_time)
+
+        detected = 0
+        for position in desync_positions:
+            try:
+                replay(mode, basic_blocks, syscalls, desynced(batches, position))
+            except Desync:
+                detected += 1
+
+        print(
+            f"{mode}: {args.blocks / replay_time:,.0f} blocks/s "
+            f"({len(syscalls) - 1} syscalls), "
+            f"detected {detected}/{len(desync_positions)} desyncs"
+        )
+
+
+if __name__ == "__main__":
+    main()
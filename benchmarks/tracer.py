@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+import gc
+import time
+import ctypes
+import random
+import logging
+import argparse
+
+import qtrace
+
+from cartprograph.blocks import BasicBlocks
+from cartprograph.tracer import CartprographTracer, tracer_class
+
+l = logging.getLogger(__name__)
+
+# Syscalls a busy target makes that the tracer has no handler for
+SYSCALLS = [
+    (39, []),
+    (12, [0]),
+    (9, [0, 4096, 3, 34, 2**64 - 1, 0]),
+    (228, [1, 0x7FFC0000]),
+    (202, [0x7F000000, 129, 1, 0, 0, 0]),
+    (0, [3, 0x7FFC0000, 4096]),
+]
+
+
+class Target:
+    target_args = ["/challenge"]
+
+
+class LegacyTracer(CartprographTracer):
+    # How the tracer handled events before dispatch tables and tracer classes
+
+    def on_basic_blocks(self, addresses):
+        qtrace.TraceMachine.on_basic_blocks(self, addresses)
+        self.basic_blocks.extend(addresses)
+        self.trace_index += len(addresses)
+
+    def on_syscall_start(self, syscall_nr, *args):
+        qtrace.TraceMachine.on_syscall_start(self, syscall_nr, *args)
+        syscall_name = qtrace.syscalls["x86_64"][syscall_nr][1][len("sys_") :]
+        l.debug(f"Trace syscall start: {syscall_name}")
+        syscall = {
+            "nr": syscall_nr,
+            "name": syscall_name,
+            "args": list(args),
+            "ret": None,
+            "trace_index": self.trace_index,
+        }
+        self.syscalls.append(syscall, ignore_attrs=["ret"])
+
+        syscall_handlers = {
+            "read": self.handle_read,
+            "write": self.handle_write,
+            "accept": self.handle_accept,
+        }
+        if syscall_name in syscall_handlers:
+            syscall_handlers[syscall_name](*args)
+
+    def on_syscall_end(self, syscall_nr, ret):
+        qtrace.TraceMachine.on_syscall_end(self, syscall_nr, ret)
+        current_syscall = self.syscalls.previous
+        syscall_name = current_syscall["name"]
+        l.debug(f"Trace syscall end: {syscall_name}")
+        current_syscall["ret"] = ret
+
+        syscall_handlers = {
+            "accept": self.handle_accept_end,
+        }
+        if syscall_name in syscall_handlers:
+            syscall_handlers[syscall_name](ret)
+
+    def add_tracepoints(self, tracepoints):
+        for tracepoint in tracepoints:
+            address = tracepoint["address"]
+            datapoints = tracepoint["datapoints"]
+
+            @qtrace.breakpoint(address)
+            def tracepoint_callback(self, *, address=address, datapoints=datapoints):
+                data = dict()
+                for datapoint in datapoints:
+                    result = self.gdb.registers[datapoint]
+                    data[datapoint] = result
+                datapoint = {
+                    "address": address,
+                    "data": data,
+                    "trace_index": self.trace_index,
+                }
+                self.datapoints.append(datapoint)
+
+            setattr(
+                self, f"breakpoint_{hex(address)}", tracepoint_callback.__get__(self)
+            )
+
+
+class Registers:
+    registers = {"rax": 1, "rdi": 2, "rsi": 3, "rdx": 4}
+
+
+def machine(tracer, tracepoints):
+    if tracer is LegacyTracer:
+        machine = LegacyTracer(Target(), BasicBlocks(), [], [], [])
+        machine.add_tracepoints(tracepoints)
+    else:
+        machine = tracer_class(tracepoints)(Target(), BasicBlocks(), [], [], [])
+    machine.ack = lambda: None
+    machine.gdb = Registers()
+    machine.std_streams = (None, None, None)
+    machine.maps = {(0x400000, 0x401000): ("/challenge", 0, "r-xp")}
+    return machine
+
+
+def syscall_workload(tracer, events, seed):
+    rng = random.Random(seed)
+    batch = (ctypes.c_uint64 * 4)(*(rng.randrange(2**47) for _ in range(4)))
+    syscalls = [rng.choice(SYSCALLS) for _ in range(events)]
+    # Reads of an untracked fd still go through the read handler
+    tracer_machine = machine(tracer, [])
+    start_time = time.perf_counter()
+    for syscall_nr, args in syscalls:
+        tracer_machine.on_basic_blocks(batch)
+        tracer_machine.on_syscall_start(syscall_nr, *args)
+        tracer_machine.on_syscall_end(syscall_nr, 0)
+    return time.perf_counter() - start_time
+
+
+def tracepoint_workload(tracer, events, seed):
+    tracepoints = [
+        {"address": 0x1000 + 0x10 * i, "datapoints": ["rax", "rdi", "rsi"]}
+        for i in range(8)
+    ]
+    tracer_machine = machine(tracer, tracepoints)
+    callbacks = tracer_machine.breakpoints
+    rng = random.Random(seed)
+    hits = [rng.choice(callbacks) for _ in range(events)]
+    start_time = time.perf_counter()
+    for callback in hits:
+        callback()
+    return time.perf_counter() - start_time
+
+
+def setup_workload(tracer, events, seed):
+    tracepoints = [
+        {"address": 0x1000 + 0x10 * i, "datapoints": ["rax", "rdi"]} for i in range(32)
+    ]
+    start_time = time.perf_counter()
+    for _ in range(events):
+        machine(tracer, tracepoints)
+    return time.perf_counter() - start_time
+
+
+def measure(workload, tracer, events, seed):
+    # Like timeit, keep garbage collection out of the measurement
+    gc.collect()
+    gc.disable()
+    try:
+        return workload(tracer, events, seed)
+    finally:
+        gc.enable()
+
+
+WORKLOADS = {
+    "syscalls": syscall_workload,
+    "tracepoints": tracepoint_workload,
+    "setup": setup_workload,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure tracer overhead for syscall and tracepoint events"
+    )
+    parser.add_argument("--workloads", nargs="+", default=list(WORKLOADS))
+    parser.add_argument("--events", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for name in args.workloads:
+        events = args.events if name != "setup" else args.events // 1000
+        results = {}
+        for tracer in [LegacyTracer, CartprographTracer]:
+            results[tracer] = min(
+                measure(WORKLOADS[name], tracer, events, args.seed)
+                for _ in range(args.repeat)
+            )
+        legacy_time, tracer_time = results[LegacyTracer], results[CartprographTracer]
+        print(
+            f"{name} ({events} events): "
+            f"legacy {legacy_time / events * 1e6:.2f}us, "
+            f"tracer {tracer_time / events * 1e6:.2f}us "
+            f"({legacy_time / tracer_time:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
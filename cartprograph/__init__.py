@@ -1,2 +1,2 @@
-context = {"redis_client": None, "cached_graph": None}
+context = {"redis_client": None, "cached_graph": None, "ancestor_index": None}
 from .model import Node
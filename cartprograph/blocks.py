@@ -0,0 +1,171 @@
+import os
+import sys
+import array
+import base64
+import ctypes
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+CODEC = os.getenv("BASIC_BLOCK_CODEC", "delta-varint")
+MIMETYPE = "application/vnd.cartprograph.basic-blocks"
+
+# Encoded basic blocks are a one byte codec id followed by the payload:
+#   raw:          little endian uint64 addresses
+#   delta-varint: zigzag encoded deltas between addresses, as LEB128 varints
+#   zstd:         zstd compressed delta-varint payload
+CODECS = {
+    "raw": 0,
+    "delta-varint": 1,
+    "zstd": 2,
+}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODECS.items()}
+UINT64_MASK = 2**64 - 1
+
+
+class BasicBlocks(array.array):
+    def __new__(cls, addresses=()):
+        if isinstance(addresses, ctypes.Array):
+            basic_blocks = super().__new__(cls, "Q")
+            basic_blocks.frombytes(memoryview(addresses).cast("B"))
+            return basic_blocks
+        return super().__new__(cls, "Q", addresses)
+
+    def __init__(self, addresses=()):
+        pass
+
+
+def encode(basic_blocks, codec=None):
+    if codec is None:
+        codec = CODEC
+    if codec == "zstd" and zstandard is None:
+        codec = "delta-varint"
+
+    if codec == "raw":
+        payload = _raw(basic_blocks)
+    elif codec == "delta-varint":
+        payload = _delta_varint_encode(basic_blocks)
+    elif codec == "zstd":
+        payload = _delta_varint_encode(basic_blocks)
+        payload = zstandard.ZstdCompressor().compress(payload)
+    else:
+        raise ValueError(f"Unknown basic block codec: {codec}")
+
+    return bytes([CODECS[codec]]) + payload
+
+
+def decode(data):
+    codec = CODEC_NAMES[data[0]]
+    payload = data[1:]
+
+    if codec == "raw":
+        basic_blocks = BasicBlocks()
+        basic_blocks.frombytes(payload)
+        if sys.byteorder != "little":
+            basic_blocks.byteswap()
+        return basic_blocks
+    elif codec == "delta-varint":
+        return _delta_varint_decode(payload)
+    elif codec == "zstd":
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+        return _delta_varint_decode(payload)
+
+
+def codec_name(data):
+    return CODEC_NAMES[data[0]]
+
+
+def dumps(basic_blocks, codec=None):
+    return base64.b64encode(encode(basic_blocks, codec)).decode()
+
+
+def loads(data):
+    return decode(base64.b64decode(data))
+
+
+def _raw(basic_blocks):
+    if sys.byteorder != "little":
+        basic_blocks = array.array("Q", basic_blocks)
+        basic_blocks.byteswap()
+    return basic_blocks.tobytes()
+
+
+def _delta_varint_encode(basic_blocks):
+    if not basic_blocks:
+        return b""
+
+    if np is not None:
+        addresses = np.frombuffer(basic_blocks, dtype=np.uint64).astype(np.int64)
+        deltas = np.diff(addresses, prepend=0)
+        values = ((deltas << 1) ^ (deltas >> 63)).view(np.uint64)
+
+        lengths = np.ones(len(values), dtype=np.int64)
+        for shift in range(7, 64, 7):
+            lengths += values >= np.uint64(1 << shift)
+        width = int(lengths.max())
+        positions = np.arange(width, dtype=np.uint64)
+        groups = (values[:, None] >> (positions * np.uint64(7))) & np.uint64(0x7F)
+        continuation = positions[None, :] < (lengths[:, None] - 1).astype(np.uint64)
+        groups |= continuation.astype(np.uint64) << np.uint64(7)
+        mask = positions[None, :] < lengths[:, None].astype(np.uint64)
+        return groups[mask].astype(np.uint8).tobytes()
+
+    # Deltas wrap around at 64 bits, as they do in the numpy path
+    result = bytearray()
+    previous = 0
+    for address in basic_blocks:
+        delta = (address - previous) & UINT64_MASK
+        previous = address
+        if delta >= 1 << 63:
+            delta -= 1 << 64
+        value = (delta << 1) if delta >= 0 else ((-delta << 1) - 1)
+        while value >= 0x80:
+            result.append((value & 0x7F) | 0x80)
+            value >>= 7
+        result.append(value)
+    return bytes(result)
+
+
+def _delta_varint_decode(payload):
+    basic_blocks = BasicBlocks()
+    if not payload:
+        return basic_blocks
+
+    if np is not None:
+        data = np.frombuffer(payload, dtype=np.uint8)
+        ends = (data & 0x80) == 0
+        starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+        positions = np.arange(len(data)) - np.repeat(
+            starts, np.diff(np.append(starts, len(data)))
+        )
+        values = (data & 0x7F).astype(np.uint64) << (
+            positions.astype(np.uint64) * np.uint64(7)
+        )
+        values = np.add.reduceat(values, starts)
+        deltas = (values >> np.uint64(1)).view(np.int64) ^ -(
+            values & np.uint64(1)
+        ).view(np.int64)
+        basic_blocks.frombytes(np.cumsum(deltas).astype("<u8").tobytes())
+        return basic_blocks
+
+    address = 0
+    value = 0
+    shift = 0
+    for byte in payload:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            address += (value >> 1) if not value & 1 else -((value + 1) >> 1)
+            address &= UINT64_MASK
+            basic_blocks.append(address)
+            value = 0
+            shift = 0
+    return basic_blocks
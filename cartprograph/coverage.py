@@ -0,0 +1,304 @@
+import os
+import time
+import bisect
+import logging
+import collections
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import Node, blocks
+from .blocks import BasicBlocks
+
+
+l = logging.getLogger(__name__)
+
+# Offsets per key of the index of the nodes that reached each block
+SHARD_SIZE = int(os.getenv("COVERAGE_SHARD_SIZE", 65536))
+
+module_ids = {}
+
+
+class AddressMap:
+    def __init__(self, maps):
+        self.maps = sorted(maps or [], key=lambda mapping: mapping["start_address"])
+        self.starts = [mapping["start_address"] for mapping in self.maps]
+        self.pathnames = [mapping["pathname"] or "[anonymous]" for mapping in self.maps]
+
+    def resolve(self, address):
+        index = bisect.bisect_right(self.starts, address) - 1
+        if index < 0:
+            return None
+        mapping = self.maps[index]
+        if address >= mapping["end_address"]:
+            return None
+        pathname = self.pathnames[index]
+        return pathname, address - mapping["start_address"] + mapping["offset"]
+
+    def resolve_all(self, addresses):
+        # The map index and offset of every address in one range lookup, and
+        # which of the addresses are mapped at all
+        starts = np.array(self.starts, dtype=np.uint64)
+        ends = np.array([mapping["end_address"] for mapping in self.maps], np.uint64)
+        offsets = np.array([mapping["offset"] for mapping in self.maps], np.uint64)
+        indexes = np.searchsorted(starts, addresses, side="right") - 1
+        mapped = indexes >= 0
+        indexes = np.maximum(indexes, 0)
+        if len(self.maps):
+            mapped &= addresses < ends[indexes]
+        indexes, addresses = indexes[mapped], addresses[mapped]
+        return indexes, addresses - starts[indexes] + offsets[indexes], mapped
+
+
+def module_id(redis_client, pathname):
+    if pathname in module_ids:
+        return module_ids[pathname]
+    existing = redis_client.hget("coverage.modules", pathname)
+    if existing is None:
+        new_id = redis_client.incr("coverage.modules.next_id") - 1
+        if redis_client.hsetnx("coverage.modules", pathname, new_id):
+            existing = new_id
+        else:
+            existing = redis_client.hget("coverage.modules", pathname)
+    module_ids[pathname] = int(existing)
+    return module_ids[pathname]
+
+
+def modules(redis_client):
+    return {
+        pathname.decode(): int(module)
+        for pathname, module in redis_client.hgetall("coverage.modules").items()
+    }
+
+
+def bitmap_key(module):
+    return f"coverage.bitmap.{module}"
+
+
+def first_seen_key(module):
+    return f"coverage.first_seen.{module}"
+
+
+def nodes_key(module):
+    # The blocks of a module each node reached, as encoded sorted offsets
+    return f"coverage.node_blocks.{module}"
+
+
+def block_nodes_key(module, offset):
+    # The nodes that reached each block in a range of a module's offsets, as
+    # "<offset>.<node>" members scored by offset
+    return f"coverage.block_nodes.{module}.{offset // SHARD_SIZE}"
+
+
+def index_blocks(pipeline, module, node_id, offsets):
+    shards = collections.defaultdict(dict)
+    for offset in offsets:
+        shards[block_nodes_key(module, offset)][f"{offset}.{node_id}"] = offset
+    for key, members in shards.items():
+        pipeline.zadd(key, members)
+
+
+def resolve_chunk(redis_client, traces, maps):
+    # {node_id: {module: sorted offsets}} for the blocks each node reached
+    address_map = AddressMap(maps)
+    node_ids = list(dict.fromkeys(node_id for node_id, _ in traces))
+
+    if np is None:
+        locations = {node_id: collections.defaultdict(set) for node_id in node_ids}
+        for node_id, basic_blocks in traces:
+            for address in set(basic_blocks):
+                location = address_map.resolve(address)
+                if location is None:
+                    continue
+                pathname, offset = location
+                locations[node_id][module_id(redis_client, pathname)].add(offset)
+        return {
+            node_id: {
+                module: sorted(offsets)
+                for module, offsets in sorted(node_locations.items())
+            }
+            for node_id, node_locations in locations.items()
+        }
+
+    # Every address of the chunk is resolved at once, tagged with its node
+    positions = {node_id: position for position, node_id in enumerate(node_ids)}
+    addresses = np.concatenate(
+        [np.empty(0, np.uint64)]
+        + [np.frombuffer(basic_blocks, np.uint64) for _, basic_blocks in traces]
+    )
+    nodes = np.repeat(
+        [positions[node_id] for node_id, _ in traces],
+        [len(basic_blocks) for _, basic_blocks in traces],
+    ).astype(np.int64)
+    indexes, offsets, mapped = address_map.resolve_all(addresses)
+    nodes = nodes[mapped]
+    map_modules = np.zeros(len(address_map.maps), np.int64)
+    for index in np.unique(indexes).tolist():
+        map_modules[index] = module_id(redis_client, address_map.pathnames[index])
+    modules = map_modules[indexes]
+
+    order = np.lexsort((offsets, modules, nodes))
+    nodes, modules, offsets = nodes[order], modules[order], offsets[order]
+    groups = np.ones(len(order), bool)
+    groups[1:] = (nodes[1:] != nodes[:-1]) | (modules[1:] != modules[:-1])
+    unique = groups.copy()
+    unique[1:] |= offsets[1:] != offsets[:-1]
+    nodes, modules, offsets = nodes[unique], modules[unique], offsets[unique]
+    bounds = np.flatnonzero(groups[unique]).tolist() + [len(offsets)]
+
+    locations = {node_id: {} for node_id in node_ids}
+    for start, stop in zip(bounds, bounds[1:]):
+        node_id = node_ids[nodes[start]]
+        locations[node_id][int(modules[start])] = offsets[start:stop].tolist()
+    return locations
+
+
+def record(redis_client, traces, maps):
+    locations = resolve_chunk(redis_client, list(traces), maps)
+
+    # Each block of the chunk is set once in its module's bitmap, with the
+    # bits it had before telling which blocks are new
+    module_offsets = collections.defaultdict(set)
+    module_nodes = collections.defaultdict(list)
+    for node_id, node_locations in locations.items():
+        for module, offsets in node_locations.items():
+            module_offsets[module].update(offsets)
+            module_nodes[module].append(node_id)
+    pipeline = redis_client.pipeline(transaction=False)
+    for module, offsets in module_offsets.items():
+        offsets = module_offsets[module] = sorted(offsets)
+        bitfield = pipeline.bitfield(bitmap_key(module))
+        for offset in offsets:
+            bitfield.set("u1", offset, 1)
+        bitfield.execute()
+        pipeline.hmget(nodes_key(module), module_nodes[module])
+    results = iter(pipeline.execute())
+
+    new_offsets = {}
+    for module, offsets in module_offsets.items():
+        new_offsets[module] = {
+            offset for offset, bit in zip(offsets, next(results)) if not bit
+        }
+        node_blocks = {}
+        for node_id, existing in zip(module_nodes[module], next(results)):
+            offsets = locations[node_id][module]
+            if existing is not None:
+                existing = set(blocks.decode(existing))
+                added = [offset for offset in offsets if offset not in existing]
+                index_blocks(pipeline, module, node_id, added)
+                offsets = sorted(existing.union(offsets))
+            else:
+                index_blocks(pipeline, module, node_id, offsets)
+            node_blocks[node_id] = blocks.encode(BasicBlocks(offsets))
+        pipeline.hset(nodes_key(module), mapping=node_blocks)
+
+    # Nodes are recorded in trace order, so the first one to reach a new
+    # block is the first node to reach it at all. Only one recorder sees a
+    # block's bit change, so no other one sets its first node.
+    now = time.time()
+    total = 0
+    novelty = {}
+    first_seen = collections.defaultdict(dict)
+    for node_id, node_locations in locations.items():
+        count = 0
+        for module, offsets in node_locations.items():
+            new = new_offsets[module]
+            if not new:
+                continue
+            first = new.intersection(offsets)
+            new -= first
+            first_seen[module].update(dict.fromkeys(first, node_id))
+            count += len(first)
+        pipeline.hincrby("coverage.novelty", node_id, count)
+        if count:
+            pipeline.incrby("coverage.total", count)
+        novelty[node_id] = count
+        total += count
+    for module, nodes in first_seen.items():
+        pipeline.hset(first_seen_key(module), mapping=nodes)
+    pipeline.execute()
+
+    if total:
+        covered = int(redis_client.get("coverage.total") or 0)
+        redis_client.xadd(
+            "coverage.timeline",
+            {"time": now, "new": total, "total": covered, "nodes": len(locations)},
+        )
+    return novelty
+
+
+def locate(redis_client, address, maps=None, pathname=None):
+    if pathname is None:
+        location = AddressMap(maps).resolve(address)
+        if location is None:
+            return None
+        pathname, address = location
+    module = modules(redis_client).get(pathname)
+    if module is None:
+        return None
+    return pathname, module, address
+
+
+def hits(redis_client, module, offset):
+    pipeline = redis_client.pipeline(transaction=False)
+    pipeline.hget(first_seen_key(module), offset)
+    pipeline.zrangebyscore(block_nodes_key(module, offset), offset, offset)
+    first_seen, members = pipeline.execute()
+    return {
+        "first_seen": int(first_seen) if first_seen is not None else None,
+        "nodes": sorted(int(member.split(b".")[1]) for member in members),
+    }
+
+
+def address_hits(redis_client, address, pathname=None):
+    # Addresses are absolute unless a module is given, then they are offsets
+    location = locate(
+        redis_client,
+        address,
+        maps=Node(0).maps if pathname is None else None,
+        pathname=pathname,
+    )
+    if location is None:
+        return dict(module=pathname, first_seen=None, nodes=[])
+    pathname, module, offset = location
+    return dict(module=pathname, offset=offset, **hits(redis_client, module, offset))
+
+
+def novelty(redis_client, node_ids):
+    if not node_ids:
+        return {}
+    counts = redis_client.hmget("coverage.novelty", node_ids)
+    return {
+        node_id: int(count) if count is not None else None
+        for node_id, count in zip(node_ids, counts)
+    }
+
+
+def total(redis_client):
+    return int(redis_client.get("coverage.total") or 0)
+
+
+def summary(redis_client):
+    pathnames = modules(redis_client)
+    pipeline = redis_client.pipeline(transaction=False)
+    for module in pathnames.values():
+        pipeline.bitcount(bitmap_key(module))
+    counts = pipeline.execute()
+    return {
+        "total": total(redis_client),
+        "modules": dict(zip(pathnames, counts)),
+    }
+
+
+def timeline(redis_client, start="-", end="+", count=None):
+    return [
+        {
+            "id": entry_id.decode(),
+            **{name.decode(): float(value) for name, value in fields.items()},
+        }
+        for entry_id, fields in redis_client.xrange(
+            "coverage.timeline", start, end, count=count
+        )
+    ]
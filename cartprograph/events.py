@@ -0,0 +1,165 @@
+import os
+import time
+import logging
+
+import redis
+
+
+l = logging.getLogger(__name__)
+
+STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", 10000))
+CLAIM_IDLE_TIME = int(os.getenv("CLAIM_IDLE_TIME", 60000))
+MAX_DELIVERIES = int(os.getenv("MAX_DELIVERIES", 3))
+RECLAIM_INTERVAL = CLAIM_IDLE_TIME / 1000 / 2
+NUM_GRAPH_WORKERS = int(os.getenv("NUM_GRAPH_WORKERS", 1))
+
+# Events about an existing node go to the graph worker owning its partition
+PARTITIONED_STREAMS = [
+    "event.input",
+    "event.trace.progress",
+    "event.trace.blocked",
+    "event.trace.finished",
+]
+
+STREAMS = [
+    "event.initialize",
+    *(
+        f"{stream}.{partition}"
+        for stream in PARTITIONED_STREAMS
+        for partition in range(NUM_GRAPH_WORKERS)
+    ),
+    "event.node",
+]
+
+
+def partition(node_id):
+    return int(node_id) % NUM_GRAPH_WORKERS
+
+
+def partitioned(stream, node_id):
+    return f"{stream}.{partition(node_id)}"
+
+
+def publish(redis_client, stream, data, timing=None):
+    fields = {"data": data}
+    if timing is not None:
+        fields["timing"] = timing
+    return redis_client.xadd(stream, fields, maxlen=STREAM_MAXLEN, approximate=True)
+
+
+def parse_id(entry_id):
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode()
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+def last_id(redis_client, stream):
+    entries = redis_client.xrevrange(stream, count=1)
+    return entries[0][0].decode() if entries else "0-0"
+
+
+def entries_since(redis_client, stream, entry_id):
+    first = redis_client.xrange(stream, count=1)
+    if not first:
+        return [] if parse_id(entry_id) == (0, 0) else None
+    if parse_id(first[0][0]) > parse_id(entry_id):
+        # Anything between entry_id and the oldest entry may have been trimmed
+        return None
+    return redis_client.xrange(stream, min=f"({entry_id}")
+
+
+def stream_info(redis_client, stream):
+    try:
+        groups = redis_client.xinfo_groups(stream)
+    except redis.ResponseError:
+        groups = []
+    return {
+        "length": redis_client.xlen(stream),
+        "groups": {
+            group["name"].decode(): {
+                "consumers": group["consumers"],
+                "pending": group["pending"],
+                "lag": group.get("lag"),
+                "last_delivered_id": group["last-delivered-id"].decode(),
+            }
+            for group in groups
+        },
+    }
+
+
+class EventConsumer:
+    def __init__(self, redis_client, group, consumer, handlers, *, count=16):
+        self.redis_client = redis_client
+        self.group = group
+        self.consumer = consumer
+        self.handlers = {
+            stream.encode(): handler for stream, handler in handlers.items()
+        }
+        self.count = count
+
+    def create_groups(self):
+        for stream in self.handlers:
+            try:
+                self.redis_client.xgroup_create(
+                    stream, self.group, id="0", mkstream=True
+                )
+            except redis.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    def handle(self, stream, entry_id, fields):
+        event = {
+            "channel": stream,
+            "id": entry_id,
+            "data": fields[b"data"],
+            "timing": fields.get(b"timing"),
+        }
+        self.handlers[stream](event)
+        self.ack(stream, entry_id)
+
+    def ack(self, stream, entry_id):
+        self.redis_client.xack(stream, self.group, entry_id)
+
+    def read(self, streams, block=None):
+        response = self.redis_client.xreadgroup(
+            self.group, self.consumer, streams, count=self.count, block=block
+        )
+        for stream, entries in response or []:
+            for entry_id, fields in entries:
+                self.handle(stream, entry_id, fields)
+
+    def reclaim(self):
+        for stream in self.handlers:
+            pending = self.redis_client.xpending_range(
+                stream,
+                self.group,
+                min="-",
+                max="+",
+                count=self.count,
+                idle=CLAIM_IDLE_TIME,
+            )
+            for entry in pending:
+                entry_id = entry["message_id"]
+                if entry["times_delivered"] > MAX_DELIVERIES:
+                    l.error(f"Dropping {stream.decode()} event {entry_id.decode()}")
+                    self.redis_client.xack(stream, self.group, entry_id)
+                    continue
+                claimed = self.redis_client.xclaim(
+                    stream, self.group, self.consumer, CLAIM_IDLE_TIME, [entry_id]
+                )
+                for claimed_id, fields in claimed:
+                    if fields:
+                        self.handle(stream, claimed_id, fields)
+                    else:
+                        self.redis_client.xack(stream, self.group, claimed_id)
+
+    def listen(self, block=1000):
+        self.create_groups()
+
+        reclaim_time = 0
+        while True:
+            if time.monotonic() >= reclaim_time:
+                self.reclaim()
+                reclaim_time = time.monotonic() + RECLAIM_INTERVAL
+            self.read({stream: ">" for stream in self.handlers}, block=block)
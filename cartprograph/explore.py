@@ -0,0 +1,267 @@
+import os
+import re
+import json
+import heapq
+import random
+import logging
+
+from . import Node, events, scheduler, coverage
+from .index import AncestorIndex
+
+
+l = logging.getLogger(__name__)
+
+DEFAULT_SEEDS = ["\n", "A\n", "0\n", "1\n", "-1\n", "y\n", "n\n", "A" * 64 + "\n"]
+INTERESTING_NUMBERS = [0, 1, -1, 7, 8, 15, 16, 31, 32, 63, 64, 127, 128, 255, 256]
+MAX_INPUT_LENGTH = int(os.getenv("EXPLORE_MAX_INPUT_LENGTH", 256))
+MAX_HARVESTED = int(os.getenv("EXPLORE_MAX_HARVESTED", 1024))
+# Nodes and inputs kept track of, the least recently updated are dropped first
+MAX_TRACKED = int(os.getenv("EXPLORE_MAX_TRACKED", 65536))
+
+
+def load_seeds(path):
+    if not path:
+        return list(DEFAULT_SEEDS)
+    if os.path.isdir(path):
+        seeds = []
+        for name in sorted(os.listdir(path)):
+            with open(os.path.join(path, name), "rb") as f:
+                seeds.append(f.read().decode("latin-1"))
+        return seeds
+    with open(path, "rb") as f:
+        return [line.decode("latin-1") + "\n" for line in f.read().splitlines()]
+
+
+def load_dictionary(path):
+    if not path:
+        return []
+    tokens = []
+    with open(path, "rb") as f:
+        for line in f.read().decode("latin-1").splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            # AFL style entries look like name="value" or "value"
+            match = re.fullmatch(r'(?:[\w-]+\s*=\s*)?"(.*)"', line)
+            if match:
+                line = match.group(1).encode("latin-1").decode("unicode_escape")
+            tokens.append(line)
+    return tokens
+
+
+def remember(mapping, key, value):
+    mapping.pop(key, None)
+    mapping[key] = value
+    while len(mapping) > MAX_TRACKED:
+        del mapping[next(iter(mapping))]
+
+
+class Strategy:
+    name = NotImplemented
+
+    def __init__(self, explorer):
+        self.explorer = explorer
+        self.rng = explorer.rng
+
+    def generate(self, node_id):
+        raise NotImplementedError()
+
+
+class SeedStrategy(Strategy):
+    name = "seed"
+
+    def generate(self, node_id):
+        seeds = self.explorer.seeds
+        return seeds[self.explorer.selected[node_id] % len(seeds)]
+
+
+class DictionaryStrategy(Strategy):
+    name = "dictionary"
+
+    def generate(self, node_id):
+        tokens = self.explorer.dictionary + sorted(self.explorer.harvested)
+        if not tokens:
+            return self.rng.choice(self.explorer.seeds)
+        count = self.rng.choice([1, 1, 1, 2, 3])
+        return " ".join(self.rng.choice(tokens) for _ in range(count)) + "\n"
+
+
+class MutationStrategy(Strategy):
+    name = "mutation"
+
+    def generate(self, node_id):
+        data = self.rng.choice(self.explorer.corpus or self.explorer.seeds)
+        data = data.rstrip("\n")
+        for _ in range(self.rng.randint(1, 4)):
+            data = self.mutate(data)
+        return data[:MAX_INPUT_LENGTH] + "\n"
+
+    def mutate(self, data):
+        rng = self.rng
+        mutation = rng.randrange(7)
+        position = rng.randint(0, len(data))
+        if mutation == 0 and data:
+            position = min(position, len(data) - 1)
+            flipped = chr(ord(data[position]) ^ (1 << rng.randrange(7)))
+            return data[:position] + flipped + data[position + 1 :]
+        elif mutation == 1:
+            return data[:position] + chr(rng.randrange(32, 127)) + data[position:]
+        elif mutation == 2 and data:
+            end = rng.randint(position, len(data))
+            return data[:position] + data[end:]
+        elif mutation == 3 and data:
+            end = rng.randint(position, len(data))
+            return data[:end] + data[position:end] + data[end:]
+        elif mutation == 4:
+            return data + str(rng.choice(INTERESTING_NUMBERS))
+        elif mutation == 5 and (self.explorer.dictionary or self.explorer.harvested):
+            tokens = self.explorer.dictionary + sorted(self.explorer.harvested)
+            return data[:position] + rng.choice(tokens) + data[position:]
+        else:
+            other = rng.choice(self.explorer.corpus or self.explorer.seeds)
+            return data[:position] + other.rstrip("\n")[position:]
+
+
+STRATEGIES = {
+    strategy.name: strategy
+    for strategy in [SeedStrategy, MutationStrategy, DictionaryStrategy]
+}
+
+
+class Explorer:
+    def __init__(
+        self,
+        redis_client,
+        strategies,
+        *,
+        seeds=None,
+        dictionary=None,
+        inputs_per_node=16,
+        rng=None,
+    ):
+        self.redis_client = redis_client
+        self.rng = rng or random.Random()
+        self.seeds = seeds or list(DEFAULT_SEEDS)
+        self.dictionary = dictionary or []
+        self.harvested = set()
+        self.inputs_per_node = inputs_per_node
+        self.strategies = {name: STRATEGIES[name](self) for name in strategies}
+        self.stats = {name: {"inputs": 0, "new_blocks": 0} for name in strategies}
+
+        self.ancestor_index = AncestorIndex(redis_client)
+        self.corpus = []
+        self.novelty = {}
+        self.selected = {}
+        self.candidates = []
+        self.pending = {}
+        self.origins = {}
+
+    def observe(self, node_id):
+        node = Node(node_id, redis_client=self.redis_client)
+        interactions = node.interactions
+        if interactions is None:
+            return
+
+        # graph_worker records coverage before announcing the node
+        new_blocks = coverage.novelty(self.redis_client, [node_id])[node_id] or 0
+        added = new_blocks - self.novelty.get(node_id, 0)
+        remember(self.novelty, node_id, new_blocks)
+
+        for interaction in interactions:
+            if len(self.harvested) >= MAX_HARVESTED:
+                break
+            if interaction["direction"] == "output" and interaction["data"]:
+                self.harvested.update(
+                    word
+                    for word in re.findall(r"\w+", interaction["data"])
+                    if len(word) <= 32
+                )
+
+        blocked = (
+            len(interactions) == 1
+            and interactions[0]["direction"] == "input"
+            and interactions[0]["data"] is None
+        )
+        if blocked and node_id not in self.selected:
+            remember(self.selected, node_id, 0)
+            self.push(node_id, node.parent_id)
+
+        if added > 0:
+            self.credit(node_id, added)
+
+    def score(self, node_id, parent_id):
+        novelty = 1 + self.novelty.get(node_id, 0) + self.novelty.get(parent_id, 0)
+        return novelty / (1 + self.selected[node_id])
+
+    def push(self, node_id, parent_id):
+        score = self.score(node_id, parent_id)
+        heapq.heappush(self.candidates, (-score, node_id, parent_id))
+        # Each node has one entry, but dropped nodes keep theirs until popped
+        if len(self.candidates) > 2 * len(self.selected):
+            self.candidates = [
+                candidate
+                for candidate in self.candidates
+                if candidate[1] in self.selected
+            ]
+            heapq.heapify(self.candidates)
+
+    def select(self):
+        while self.candidates:
+            _, node_id, parent_id = heapq.heappop(self.candidates)
+            if node_id not in self.selected:
+                continue
+            if self.selected[node_id] >= self.inputs_per_node:
+                del self.selected[node_id]
+                continue
+            return node_id, parent_id
+        return None, None
+
+    def resolve(self):
+        if not self.pending:
+            return
+        path_hashes = list(self.pending)
+        node_ids = self.redis_client.hmget("paths", path_hashes)
+        for path_hash, node_id in zip(path_hashes, node_ids):
+            if node_id is not None:
+                remember(self.origins, int(node_id), self.pending.pop(path_hash))
+
+    def credit(self, node_id, new_blocks):
+        self.resolve()
+        for ancestor_id in reversed(self.ancestor_index.ancestors(node_id)):
+            if ancestor_id in self.origins:
+                strategy, data = self.origins[ancestor_id]
+                self.stats[strategy]["new_blocks"] += new_blocks
+                if data not in self.corpus:
+                    self.corpus.append(data)
+                return
+
+    def choose_strategy(self):
+        names = list(self.strategies)
+        weights = [
+            (1 + self.stats[name]["new_blocks"]) / (1 + self.stats[name]["inputs"])
+            for name in names
+        ]
+        return self.strategies[self.rng.choices(names, weights)[0]]
+
+    def explore(self):
+        node_id, parent_id = self.select()
+        if node_id is None:
+            return None
+
+        strategy = self.choose_strategy()
+        data = strategy.generate(node_id)
+        remember(self.selected, node_id, self.selected[node_id] + 1)
+        self.push(node_id, parent_id)
+        self.stats[strategy.name]["inputs"] += 1
+        if len(self.pending) >= MAX_TRACKED:
+            # Inputs that never made a node are forgotten once the rest are
+            # resolved
+            self.resolve()
+        remember(
+            self.pending, scheduler.path_hash(node_id, data), (strategy.name, data)
+        )
+
+        input_ = {"id": node_id, "data": data, "priority": "background"}
+        stream = events.partitioned("event.input", node_id)
+        events.publish(self.redis_client, stream, json.dumps(input_))
+        return node_id, data, strategy.name
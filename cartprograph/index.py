@@ -0,0 +1,209 @@
+import os
+import json
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import segments
+
+
+l = logging.getLogger(__name__)
+
+EMPTY = (0,) * len(segments.ATTRIBUTES)
+ATTRIBUTE_INDEX = {name: i for i, name in enumerate(segments.ATTRIBUTES)}
+
+
+def children_key(node_id):
+    return f"children.{node_id}"
+
+
+class AncestorIndex:
+    # A node's parent, depth and starts never change once it is added, so they
+    # are shared through the "ancestry" hash and fetched on a miss. Lengths
+    # change while a node is still being traced, so they are only kept for
+    # nodes written here and otherwise read when a child is added.
+    def __init__(self, redis_client=None):
+        self.redis_client = redis_client
+        self.parents = {}
+        self.depths = {}
+        self.starts = {}
+        self.lengths = {}
+
+    @classmethod
+    def build(cls, parents, lengths, redis_client=None):
+        ancestor_index = cls(redis_client)
+        # Node ids are allocated in order, so parents always come first
+        for node_id in sorted(parents):
+            parent_id = parents[node_id]
+            if parent_id is not None and parent_id not in ancestor_index:
+                l.warning(f"Skipping node {node_id} with unknown parent {parent_id}")
+                continue
+            ancestor_index.lengths[node_id] = tuple(lengths.get(node_id, EMPTY))
+            ancestor_index.add(node_id, parent_id)
+        return ancestor_index
+
+    @classmethod
+    def from_redis(cls, redis_client):
+        ancestor_index = cls(redis_client)
+        for node_id, entry in redis_client.hgetall("ancestry").items():
+            ancestor_index.insert(int(node_id), json.loads(entry))
+        return ancestor_index
+
+    @classmethod
+    def load(cls, path, redis_client=None):
+        # Row 0 is a header of (version, number of nodes), every other row is
+        # (node id, parent id or -1, depth, starts..., lengths... or -1)
+        snapshot = np.load(path, mmap_mode="r")
+        version, num_nodes = (int(value) for value in snapshot[0, :2])
+        rows = snapshot[1 : num_nodes + 1]
+        width = len(EMPTY)
+        node_ids = rows[:, 0].tolist()
+        parent_ids = rows[:, 1].tolist()
+
+        ancestor_index = cls(redis_client)
+        ancestor_index.parents = dict(
+            zip(
+                node_ids,
+                (parent_id if parent_id >= 0 else None for parent_id in parent_ids),
+            )
+        )
+        ancestor_index.depths = dict(zip(node_ids, rows[:, 2].tolist()))
+        ancestor_index.starts = dict(
+            zip(node_ids, map(tuple, rows[:, 3 : 3 + width].tolist()))
+        )
+        known = rows[:, 3 + width] >= 0
+        ancestor_index.lengths = dict(
+            zip(
+                rows[known, 0].tolist(),
+                map(tuple, rows[known, 3 + width :].tolist()),
+            )
+        )
+        return ancestor_index, version
+
+    def save(self, path, version):
+        width = len(EMPTY)
+        node_ids = list(self.parents)
+        snapshot = np.zeros((len(node_ids) + 1, 3 + 2 * width), dtype=np.int64)
+        snapshot[0, :2] = (version, len(node_ids))
+        if node_ids:
+            snapshot[1:, 0] = node_ids
+            snapshot[1:, 1] = [
+                -1 if parent_id is None else parent_id
+                for parent_id in self.parents.values()
+            ]
+            snapshot[1:, 2] = [self.depths[node_id] for node_id in node_ids]
+            snapshot[1:, 3 : 3 + width] = [self.starts[node_id] for node_id in node_ids]
+            snapshot[1:, 3 + width :] = [
+                self.lengths.get(node_id, (-1,) * width) for node_id in node_ids
+            ]
+        with open(f"{path}.tmp", "wb") as f:
+            np.save(f, snapshot)
+        os.replace(f"{path}.tmp", path)
+
+    def store(self, node_ids=None):
+        if node_ids is None:
+            node_ids = list(self.parents)
+        for start in range(0, len(node_ids), 10000):
+            self.redis_client.hset(
+                "ancestry",
+                mapping={
+                    node_id: self.entry(node_id)
+                    for node_id in node_ids[start : start + 10000]
+                },
+            )
+
+    def __contains__(self, node_id):
+        return node_id in self.parents
+
+    def __len__(self):
+        return len(self.parents)
+
+    def entry(self, node_id):
+        return json.dumps(
+            [self.parents[node_id], self.depths[node_id], *self.starts[node_id]]
+        )
+
+    def insert(self, node_id, entry):
+        parent_id, depth, *start = entry
+        self.parents[node_id] = parent_id
+        self.depths[node_id] = depth
+        self.starts[node_id] = tuple(start)
+
+    def fetch(self, node_id):
+        if node_id in self.parents or self.redis_client is None:
+            return
+        # Entries are immutable, so a missing node only needs the part of its
+        # ancestor chain that has not been seen yet
+        while node_id is not None and node_id not in self.parents:
+            entry = self.redis_client.hget("ancestry", node_id)
+            if entry is None:
+                return
+            entry = json.loads(entry)
+            self.insert(node_id, entry)
+            node_id = entry[0]
+
+    def parent_lengths(self, parent_id):
+        lengths = self.lengths.get(parent_id)
+        if lengths is None and self.redis_client is not None:
+            lengths = self.redis_client.hget("lengths", parent_id)
+            lengths = tuple(json.loads(lengths)) if lengths is not None else None
+        if lengths is None:
+            raise KeyError(parent_id)
+        return lengths
+
+    def add(self, node_id, parent_id):
+        if parent_id is None:
+            depth = 0
+            start = EMPTY
+        else:
+            self.fetch(parent_id)
+            depth = self.depths[parent_id] + 1
+            start = tuple(
+                offset + length
+                for offset, length in zip(
+                    self.starts[parent_id], self.parent_lengths(parent_id)
+                )
+            )
+        self.parents[node_id] = parent_id
+        self.depths[node_id] = depth
+        self.starts[node_id] = start
+        self.lengths.setdefault(node_id, EMPTY)
+
+    def set_lengths(self, node_id, lengths):
+        node_lengths = list(self.lengths.get(node_id, EMPTY))
+        for name, length in lengths.items():
+            node_lengths[ATTRIBUTE_INDEX[name]] = length
+        self.lengths[node_id] = tuple(node_lengths)
+
+    def forget_lengths(self, node_id):
+        self.lengths.pop(node_id, None)
+
+    def depth(self, node_id):
+        self.fetch(node_id)
+        return self.depths[node_id]
+
+    def ancestors(self, node_id):
+        self.fetch(node_id)
+        node_ids = []
+        while node_id is not None:
+            node_ids.append(node_id)
+            node_id = self.parents[node_id]
+        node_ids.reverse()
+        return node_ids
+
+    def root(self, node_id):
+        self.fetch(node_id)
+        while self.parents[node_id] is not None:
+            node_id = self.parents[node_id]
+        return node_id
+
+    def offsets(self, node_id):
+        self.fetch(node_id)
+        return dict(zip(segments.ATTRIBUTES, self.starts[node_id]))
+
+    def trace_index(self, node_id):
+        self.fetch(node_id)
+        return self.starts[node_id][ATTRIBUTE_INDEX["basic_blocks"]]
@@ -0,0 +1,87 @@
+import os
+
+
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", 1000))
+
+
+def metric_key(name):
+    return f"metrics.{name}"
+
+
+def observe(redis_client, name, value, pipeline=None):
+    execute = pipeline is None
+    if execute:
+        pipeline = redis_client.pipeline(transaction=False)
+    pipeline.sadd("metrics", name)
+    pipeline.lpush(metric_key(name), value)
+    pipeline.ltrim(metric_key(name), 0, METRICS_WINDOW - 1)
+    if execute:
+        pipeline.execute()
+
+
+def quantile(values, q):
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def summary(redis_client, name):
+    values = sorted(
+        float(value) for value in redis_client.lrange(metric_key(name), 0, -1)
+    )
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": quantile(values, 0.5),
+        "p90": quantile(values, 0.9),
+        "p99": quantile(values, 0.99),
+        "max": values[-1],
+    }
+
+
+def summaries(redis_client):
+    names = sorted(name.decode() for name in redis_client.smembers("metrics"))
+    return {name: summary(redis_client, name) for name in names}
+
+
+PROMETHEUS_MIMETYPE = "text/plain; version=0.0.4"
+# Prometheus asks for its version of text/plain, which plain text also gets
+MIMETYPES = ["application/json", "text/plain", PROMETHEUS_MIMETYPE]
+QUANTILES = {"0.5": "p50", "0.9": "p90", "0.99": "p99"}
+
+
+def wants_prometheus(mimetype, format=None):
+    return mimetype in MIMETYPES[1:] or format == "prometheus"
+
+
+def prometheus_name(name):
+    return "cartprograph_" + "".join(c if c.isalnum() else "_" for c in name)
+
+
+def prometheus_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+
+def prometheus(redis_client, gauges=()):
+    # Summaries are over the last METRICS_WINDOW observations of each metric,
+    # gauges are (name, labels, value) and may repeat a name with other labels
+    lines = []
+    for name, stats in summaries(redis_client).items():
+        metric = prometheus_name(name)
+        lines.append(f"# TYPE {metric} summary")
+        if stats["count"]:
+            for q, quantile_name in QUANTILES.items():
+                lines.append(f'{metric}{{quantile="{q}"}} {stats[quantile_name]}')
+            lines.append(f"{metric}_sum {stats['mean'] * stats['count']}")
+        lines.append(f"{metric}_count {stats['count']}")
+
+    typed = set()
+    for name, labels, value in gauges:
+        metric = prometheus_name(name)
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} gauge")
+            typed.add(metric)
+        lines.append(f"{metric}{prometheus_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import json
+import argparse
+import collections
+import logging
+
+import redis
+
+from . import Node, blocks, coverage, segments, summaries
+from .index import AncestorIndex, children_key
+
+
+l = logging.getLogger(__name__)
+
+
+def legacy_basic_blocks(value):
+    if value.startswith(b"["):
+        return blocks.BasicBlocks(json.loads(value))
+    return blocks.decode(value)
+
+
+def migrate_node(redis_client, node_id, legacy_attributes):
+    node = Node.create(node_id, redis_client=redis_client)
+    with node.batch():
+        node_segments = {}
+        for name in segments.ATTRIBUTES:
+            value = legacy_attributes.pop(name, None)
+            if value is None:
+                continue
+            if name == "basic_blocks":
+                value = legacy_basic_blocks(value)
+            else:
+                value = json.loads(value)
+            node_segments[name] = segments.store(
+                redis_client, name, value, pipeline=node.pipeline
+            )
+        if node_segments:
+            legacy_segments = legacy_attributes.pop("segments", None)
+            if legacy_segments is not None:
+                node_segments = {**json.loads(legacy_segments), **node_segments}
+            node.segments = {
+                name: node_segments.get(name, []) for name in segments.ATTRIBUTES
+            }
+
+        for name, value in legacy_attributes.items():
+            if name in Node.attributes:
+                setattr(node, name, json.loads(value))
+
+
+def migrate(redis_client, *, delete=False):
+    legacy_nodes = collections.defaultdict(dict)
+    legacy_keys = []
+    for key in redis_client.scan_iter(match="node.*", count=1000):
+        _, node_id, name = key.decode().split(".", 2)
+        legacy_nodes[int(node_id)][name] = redis_client.get(key)
+        legacy_keys.append(key)
+
+    for node_id, legacy_attributes in sorted(legacy_nodes.items()):
+        l.info(f"Migrating node {node_id}")
+        legacy_attributes.setdefault("parent_id", b"null")
+        migrate_node(redis_client, node_id, legacy_attributes)
+
+    if delete:
+        for start in range(0, len(legacy_keys), 1000):
+            redis_client.delete(*legacy_keys[start : start + 1000])
+
+    return len(legacy_nodes)
+
+
+def reindex(redis_client):
+    indexed = {int(node_id) for node_id in redis_client.hkeys("lengths")}
+    node_ids = [node_id for node_id in Node.ids(redis_client) if node_id not in indexed]
+    for start in range(0, len(node_ids), 1000):
+        for node in Node.load_many(
+            node_ids[start : start + 1000], ["segments"], redis_client=redis_client
+        ):
+            if node.segments is not None:
+                node.segments = node.segments
+    return len(node_ids)
+
+
+def index_children(redis_client):
+    edges = Node.edges(redis_client)
+    pipeline = redis_client.pipeline(transaction=False)
+    for node_id, parent_id in edges.items():
+        if parent_id is not None:
+            pipeline.zadd(children_key(parent_id), {node_id: node_id})
+    pipeline.execute()
+    return len(edges)
+
+
+def index_coverage(redis_client):
+    pipeline = redis_client.pipeline(transaction=False)
+    num_nodes = 0
+    for module in coverage.modules(redis_client).values():
+        for node_id, offsets in redis_client.hscan_iter(
+            coverage.nodes_key(module), count=1000
+        ):
+            coverage.index_blocks(
+                pipeline, module, int(node_id), blocks.decode(offsets)
+            )
+            num_nodes += 1
+            if len(pipeline) >= 1000:
+                pipeline.execute()
+    pipeline.execute()
+    return num_nodes
+
+
+def summarize(redis_client):
+    ancestor_index = AncestorIndex.build(Node.edges(redis_client), {}, redis_client)
+    node_ids = Node.ids(redis_client)
+    num_nodes = 0
+    for start in range(0, len(node_ids), 1000):
+        for node in Node.load_many(
+            node_ids[start : start + 1000],
+            ["segments", "summary"],
+            redis_client=redis_client,
+        ):
+            if node.summary is None and node.segments is not None:
+                node.summary = summaries.update(
+                    summaries.empty(ancestor_index.depth(node.id)),
+                    node.syscalls,
+                    node.interactions,
+                    node.segments,
+                )
+                num_nodes += 1
+    return num_nodes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Migrate node.<id>.<attr> keys to node:<id> hashes and index trace lengths, children, coverage and summaries"
+    )
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument(
+        "--delete", action="store_true", help="delete the legacy keys afterwards"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    redis_client = redis.Redis(host=args.host, port=args.port)
+    num_nodes = migrate(redis_client, delete=args.delete)
+    l.info(f"Migrated {num_nodes} nodes")
+    num_nodes = reindex(redis_client)
+    l.info(f"Indexed trace lengths of {num_nodes} nodes")
+    num_nodes = index_children(redis_client)
+    l.info(f"Indexed children of {num_nodes} nodes")
+    num_nodes = index_coverage(redis_client)
+    l.info(f"Indexed the coverage of {num_nodes} nodes")
+    num_nodes = summarize(redis_client)
+    l.info(f"Summarized {num_nodes} nodes")
+
+
+if __name__ == "__main__":
+    main()
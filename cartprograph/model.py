@@ -1,6 +1,8 @@
 import json
+import contextlib
 
-from . import context
+from . import context, segments, prefixes
+from .index import children_key
 
 
 class RedisBackedObject:
@@ -13,6 +15,9 @@ class RedisBackedObject:
         if cached_graph is None:
             cached_graph = context["cached_graph"]
         self.cached_graph = cached_graph
+        self.pipeline = None
+        self.batched = None
+        self.callbacks = None
         if copy_from:
             for name, value in copy_from:
                 setattr(self, name, value)
@@ -29,17 +34,80 @@ class RedisBackedObject:
             else:
                 del self.cache[attr]
 
+    @contextlib.contextmanager
+    def batch(self):
+        if self.pipeline is not None:
+            yield self
+            return
+
+        self.pipeline = self.redis_client.pipeline()
+        self.batched = {}
+        self.callbacks = []
+        try:
+            yield self
+            if self.batched:
+                mapping = {
+                    name: self.serialize(name, value)
+                    for name, value in self.batched.items()
+                }
+                self.pipeline.hset(str(self), mapping=mapping)
+            results = self.pipeline.execute()
+            for index, callback in self.callbacks:
+                callback(results[index])
+        finally:
+            self.pipeline.reset()
+            self.pipeline = None
+            self.batched = None
+            self.callbacks = None
+
+    def after_batch(self, callback):
+        # Called with the result of the last command queued so far, once the
+        # batch has been sent
+        self.callbacks.append((len(self.pipeline) - 1, callback))
+
+    @classmethod
+    def create(cls, *args, copy_from=None, **kwargs):
+        obj = cls(*args, **kwargs)
+        for attr in cls.attributes:
+            obj.cache[attr] = None
+        if copy_from:
+            for name, value in copy_from:
+                setattr(obj, name, value)
+        return obj
+
+    @classmethod
+    def load_many(cls, ids, attributes=None, **kwargs):
+        if attributes is None:
+            attributes = cls.attributes
+        objects = [cls(id, **kwargs) for id in ids]
+        if not objects or not attributes:
+            return objects
+        pipeline = objects[0].redis_client.pipeline(transaction=False)
+        for obj in objects:
+            pipeline.hmget(str(obj), attributes)
+        for obj, values in zip(objects, pipeline.execute()):
+            for attr, value in zip(attributes, values):
+                if value is not None:
+                    value = obj.deserialize(attr, value)
+                obj.cache[attr] = value
+        return objects
+
     def __str__(self):
         raise NotImplementedError()
 
+    def raw(self, name):
+        return self.redis_client.hget(str(self), name)
+
     def __getattr__(self, name):
         if name in self.attributes:
+            if self.batched and name in self.batched:
+                return self.batched[name]
             try:
                 value = self.cache[name]
             except KeyError:
-                value = self.redis_client.get(f"{self}.{name}")
+                value = self.raw(name)
                 if value is not None:
-                    value = json.loads(value)
+                    value = self.deserialize(name, value)
                 self.cache[name] = value
             return value
         else:
@@ -47,7 +115,10 @@ class RedisBackedObject:
 
     def __setattr__(self, name, value):
         if name in self.attributes:
-            self.redis_client.set(f"{self}.{name}", json.dumps(value))
+            if self.batched is not None:
+                self.batched[name] = value
+            else:
+                self.redis_client.hset(str(self), name, self.serialize(name, value))
             self.cache[name] = value
         else:
             return super().__setattr__(name, value)
@@ -56,48 +127,173 @@ class RedisBackedObject:
         for attr in self.attributes:
             yield attr, getattr(self, attr)
 
+    def serialize(self, name, value):
+        return json.dumps(value)
 
-class FakeCache:
-    def __getitem__(self, key):
-        raise KeyError()
-
-    def __setitem__(self, key, value):
-        pass
-
-    def __delitem__(self, key):
-        pass
+    def deserialize(self, name, value):
+        return json.loads(value)
 
 
 class Node(RedisBackedObject):
     attributes = [
         "parent_id",
         "tracepoints",
-        "basic_blocks",
-        "syscalls",
-        "interactions",
-        "datapoints",
+        "segments",
         "maps",
+        "summary",
     ]
+    trace_attributes = segments.ATTRIBUTES
 
-    def __init__(self, id, **kwargs):
+    def __init__(self, id, *, ancestor_index=None, **kwargs):
         self.id = id
+        self.local_cache = {}
+        if ancestor_index is None:
+            ancestor_index = context["ancestor_index"]
+        self.ancestor_index = ancestor_index
         super().__init__(**kwargs)
         self.cache  # warm up the cache
 
+    def __getattr__(self, name):
+        if name in self.trace_attributes:
+            node_segments = self.segments
+            if node_segments is None:
+                return None
+            return segments.load(self.redis_client, name, node_segments.get(name, []))
+        return super().__getattr__(name)
+
     def __setattr__(self, name, value):
+        if name in self.trace_attributes:
+            with self.batch():
+                node_segments = dict(self.segments or {})
+                node_segments[name] = segments.store(
+                    self.redis_client, name, value, pipeline=self.pipeline
+                )
+                self.segments = node_segments
+            return
+        if name == "segments":
+            with self.batch():
+                lengths = {
+                    name: segments.length(refs) for name, refs in (value or {}).items()
+                }
+                if self.ancestor_index is not None:
+                    self.ancestor_index.set_lengths(self.id, lengths)
+                self.pipeline.hset(
+                    "lengths",
+                    self.id,
+                    json.dumps([lengths.get(name, 0) for name in segments.ATTRIBUTES]),
+                )
+                self.pipeline.incr("graph.version")
+                prefixes.invalidate(self.redis_client, self.id, pipeline=self.pipeline)
+                # Prefixes cached for the node's descendants include it too
+                self.pipeline.zcard(children_key(self.id))
+                self.after_batch(self.invalidate_descendants)
+                return super().__setattr__("segments", value)
         if name == "parent_id":
-            parent_id = value
-            if parent_id is not None:
-                self.cached_graph.add_edge(parent_id, self.id)
+            with self.batch():
+                parent_id = value
+                if parent_id is not None and self.cached_graph is not None:
+                    self.cached_graph.add_edge(parent_id, self.id)
+                if self.ancestor_index is not None:
+                    self.ancestor_index.add(self.id, parent_id)
+                    self.pipeline.hset(
+                        "ancestry", self.id, self.ancestor_index.entry(self.id)
+                    )
+                if parent_id is not None:
+                    self.pipeline.zadd(children_key(parent_id), {self.id: self.id})
+                self.pipeline.zadd("nodes", {self.id: self.id})
+                self.pipeline.hset("edges", self.id, json.dumps(parent_id))
+                self.pipeline.incr("graph.version")
+                return super().__setattr__(name, value)
         return super().__setattr__(name, value)
 
+    def invalidate(self, name=None, *, purge=False):
+        super().invalidate(name, purge=purge)
+        prefixes.invalidate(self.redis_client)
+
+    def invalidate_descendants(self, num_children):
+        if num_children:
+            prefixes.invalidate(self.redis_client)
+
+    def append(self, name, values):
+        with self.batch():
+            node_segments = dict(self.segments or {})
+            node_segments[name] = node_segments.get(name, []) + segments.store(
+                self.redis_client, name, values, pipeline=self.pipeline
+            )
+            self.segments = node_segments
+
+    def raw_trace(self, name):
+        node_segments = self.segments
+        if node_segments is None:
+            return None
+        return segments.load_raw(self.redis_client, name, node_segments.get(name, []))
+
     @property
     def cache(self):
         if self.cached_graph is None:
-            return FakeCache()
+            return self.local_cache
         if self.id not in self.cached_graph.nodes:
             self.cached_graph.add_node(self.id)
         return self.cached_graph.nodes[self.id]
 
+    @staticmethod
+    def ids(redis_client=None):
+        if redis_client is None:
+            redis_client = context["redis_client"]
+        return [int(node_id) for node_id in redis_client.zrange("nodes", 0, -1)]
+
+    @staticmethod
+    def edges(redis_client=None):
+        if redis_client is None:
+            redis_client = context["redis_client"]
+        return {
+            int(node_id): json.loads(parent_id)
+            for node_id, parent_id in redis_client.hgetall("edges").items()
+        }
+
+    @staticmethod
+    def segment_ids(redis_client=None):
+        # Every segment some node refers to
+        if redis_client is None:
+            redis_client = context["redis_client"]
+        node_ids = Node.ids(redis_client)
+        segment_ids = set()
+        for start in range(0, len(node_ids), 1000):
+            pipeline = redis_client.pipeline(transaction=False)
+            for node_id in node_ids[start : start + 1000]:
+                pipeline.hget(f"node:{node_id}", "segments")
+            for node_segments in pipeline.execute():
+                if node_segments is None:
+                    continue
+                for refs in json.loads(node_segments).values():
+                    segment_ids.update(segment_id for segment_id, _ in refs)
+        return segment_ids
+
+    @staticmethod
+    def lengths(redis_client=None):
+        if redis_client is None:
+            redis_client = context["redis_client"]
+        return {
+            int(node_id): json.loads(lengths)
+            for node_id, lengths in redis_client.hgetall("lengths").items()
+        }
+
+    @staticmethod
+    def allocate_id(redis_client=None):
+        if redis_client is None:
+            redis_client = context["redis_client"]
+        return redis_client.incr("node_id") - 1
+
+    @staticmethod
+    def parent_ids(node_ids, redis_client=None):
+        if redis_client is None:
+            redis_client = context["redis_client"]
+        if not node_ids:
+            return []
+        return [
+            json.loads(parent_id) if parent_id is not None else None
+            for parent_id in redis_client.hmget("edges", node_ids)
+        ]
+
     def __str__(self):
-        return f"node.{self.id}"
+        return f"node:{self.id}"
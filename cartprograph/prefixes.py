@@ -0,0 +1,68 @@
+import os
+import json
+import time
+import zlib
+
+
+PREFIX_CACHE_SIZE = int(os.getenv("PREFIX_CACHE_SIZE", 4096))
+
+
+def prefix_key(node_id):
+    return f"prefix.{node_id}"
+
+
+def invalidate(redis_client, node_id=None, pipeline=None):
+    execute = pipeline is None
+    if execute:
+        pipeline = redis_client.pipeline(transaction=False)
+    if node_id is None:
+        # Every cached prefix may include the node, so all of them are dropped
+        pipeline.incr("prefix.generation")
+    else:
+        # The entry leaves the LRU too, or it would count against the size
+        pipeline.delete(prefix_key(node_id))
+        pipeline.zrem("prefix.lru", node_id)
+    if execute:
+        pipeline.execute()
+
+
+class PrefixCache:
+    # Merged segment refs of a node and all of its ancestors, shared by every
+    # graph worker. Entries are compressed, evicted least recently used first,
+    # and all dropped at once by bumping the generation.
+    def __init__(self, redis_client, size=PREFIX_CACHE_SIZE):
+        self.redis_client = redis_client
+        self.size = size
+        self.generation = 0
+
+    def get(self, node_id):
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.get("prefix.generation")
+        pipeline.get(prefix_key(node_id))
+        generation, entry = pipeline.execute()
+        # Entries built from here on are only valid for this generation
+        self.generation = int(generation or 0)
+        if entry is None:
+            return None
+        entry = json.loads(zlib.decompress(entry))
+        if entry["generation"] != self.generation:
+            return None
+        self.redis_client.zadd("prefix.lru", {node_id: time.time()})
+        return entry
+
+    def put(self, node_id, segments, root_id):
+        entry = {"generation": self.generation, "segments": segments, "root": root_id}
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.set(prefix_key(node_id), zlib.compress(json.dumps(entry).encode(), 1))
+        pipeline.zadd("prefix.lru", {node_id: time.time()})
+        pipeline.zcard("prefix.lru")
+        *_, num_entries = pipeline.execute()
+        if num_entries > self.size:
+            self.evict(num_entries - self.size)
+
+    def evict(self, count):
+        evicted = self.redis_client.zpopmin("prefix.lru", count)
+        if evicted:
+            self.redis_client.delete(
+                *(prefix_key(int(node_id)) for node_id, _ in evicted)
+            )
@@ -0,0 +1,43 @@
+def int_arg(args, name, default=None):
+    try:
+        return int(args[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def window_args(args):
+    # offset/limit page through whatever the trace_index range [start, end)
+    # and syscall name filters select
+    window = {arg: int_arg(args, arg) for arg in ["offset", "limit", "start", "end"]}
+    if any(window[arg] is not None and window[arg] < 0 for arg in ["offset", "limit"]):
+        return None
+    window["names"] = {
+        name for names in args.getlist("name") for name in names.split(",")
+    }
+    return window
+
+
+def windowed(window):
+    return any(window[arg] is not None for arg in ["offset", "limit", "start", "end"])
+
+
+def ranged(window):
+    return window["start"] is not None or window["end"] is not None
+
+
+def block_range(window, node_start=None):
+    # Basic blocks are one trace index each, so ranges are just positions,
+    # node_start is only needed when the window is ranged
+    offset = window["offset"] or 0
+    limit = window["limit"]
+    start, end = window["start"], window["end"]
+
+    lo, hi = 0, None
+    if start is not None:
+        lo = max(start - node_start, 0)
+    if end is not None:
+        hi = max(end - node_start, lo)
+    lo += offset
+    if limit is not None:
+        hi = lo + limit if hi is None else min(hi, lo + limit)
+    return lo, hi
@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+
+import redis
+
+from . import events, metrics, timing
+
+
+l = logging.getLogger(__name__)
+
+# Queues are served in this order, after a trace worker's own queue
+PRIORITIES = ["interactive", "background"]
+CONCURRENCY = {
+    "interactive": int(os.getenv("INTERACTIVE_CONCURRENCY", 0)),
+    "background": int(os.getenv("BACKGROUND_CONCURRENCY", 0)),
+}
+
+
+def queue_key(priority):
+    return f"work.trace.{priority}"
+
+
+def worker_queue_key(name):
+    return f"work.trace.{name}"
+
+
+def running_key(priority):
+    return f"work.trace.running.{priority}"
+
+
+def token_key(node_id):
+    return f"work.trace.token.{node_id}"
+
+
+def path_hash(node_id, data):
+    return hashlib.blake2b(
+        f"{node_id}\0{json.dumps(data)}".encode(), digest_size=16
+    ).hexdigest()
+
+
+def submit(redis_client, job, priority="interactive", worker=None, *, promote=False):
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority: {priority}")
+    queue = queue_key(priority)
+
+    node_id = job["node_id"]
+    job_id = uuid.uuid4().hex
+    job["job"] = {"id": job_id, "priority": priority, "enqueued": time.time()}
+    token = {"id": job_id, "priority": priority, "queue": queue, "state": "queued"}
+    if worker is not None:
+        job["job"]["worker"] = token["worker"] = worker
+    entry = token["entry"] = json.dumps(job)
+
+    # A newer job for the same node supersedes any that are still queued
+    with redis_client.pipeline() as pipeline:
+        try:
+            if promote:
+                pipeline.watch(token_key(node_id))
+                existing = pending(pipeline, node_id)
+                if not promotes(existing, priority):
+                    return None
+                pipeline.multi()
+                cancel(pipeline, node_id, existing)
+            pipeline.hset(token_key(node_id), mapping=token)
+            # A job that resumes from a checkpoint is also queued for the
+            # worker holding it, which takes it first if it is free. Any
+            # other worker can still take it in turn, without the checkpoint.
+            if worker is not None:
+                pipeline.rpush(worker_queue_key(worker), entry)
+            pipeline.rpush(queue, entry)
+            pipeline.execute()
+        except redis.WatchError:
+            return None
+    return job_id
+
+
+def pending(redis_client, node_id):
+    token = redis_client.hgetall(token_key(node_id))
+    if not token:
+        return None
+    return {name.decode(): value.decode() for name, value in token.items()}
+
+
+def promotes(token, priority):
+    return (
+        token is not None
+        and token["state"] == "queued"
+        and "worker" not in token
+        and PRIORITIES.index(priority) < PRIORITIES.index(token["priority"])
+    )
+
+
+def promotable(redis_client, node_id, priority):
+    return promotes(pending(redis_client, node_id), priority)
+
+
+def cancel(redis_client, node_id, token=None):
+    # A job that is still queued is taken off its queue along with its token
+    if token is None:
+        token = pending(redis_client, node_id)
+    if token is None:
+        return
+    if token["state"] == "queued":
+        drop_entries(redis_client, token)
+    redis_client.delete(token_key(node_id))
+
+
+def drop_entries(redis_client, token):
+    redis_client.lrem(token["queue"], 1, token["entry"])
+    if "worker" in token:
+        redis_client.lrem(worker_queue_key(token["worker"]), 1, token["entry"])
+
+
+def queue_info(redis_client):
+    pipeline = redis_client.pipeline(transaction=False)
+    for priority in PRIORITIES:
+        pipeline.llen(queue_key(priority))
+        pipeline.hlen(running_key(priority))
+    results = pipeline.execute()
+    return {
+        priority: {
+            "depth": depth,
+            "running": running,
+            "limit": CONCURRENCY[priority] or None,
+        }
+        for priority, depth, running in zip(PRIORITIES, results[::2], results[1::2])
+    }
+
+
+def queues(redis_client):
+    return {
+        "streams": {
+            stream: events.stream_info(redis_client, stream)
+            for stream in events.STREAMS
+        },
+        "work": queue_info(redis_client),
+    }
+
+
+def queue_gauges(redis_client):
+    # (name, labels, value) gauges for metrics.prometheus
+    info = queues(redis_client)
+    gauges = [
+        ("work.trace.depth", {"priority": priority}, work["depth"])
+        for priority, work in info["work"].items()
+    ]
+    gauges += [
+        ("work.trace.running", {"priority": priority}, work["running"])
+        for priority, work in info["work"].items()
+    ]
+    gauges += [
+        ("stream.length", {"stream": stream}, stream_info["length"])
+        for stream, stream_info in info["streams"].items()
+    ]
+    for field in ["pending", "lag"]:
+        gauges += [
+            (f"stream.{field}", {"stream": stream, "group": group}, group_info[field])
+            for stream, stream_info in info["streams"].items()
+            for group, group_info in stream_info["groups"].items()
+            if group_info[field] is not None
+        ]
+    return gauges
+
+
+class Scheduler:
+    def __init__(self, redis_client, name):
+        self.redis_client = redis_client
+        self.name = name
+        self.private_queue = worker_queue_key(name)
+        # Anything left over from before a restart is no longer running
+        for priority in PRIORITIES:
+            self.redis_client.hdel(running_key(priority), self.name)
+
+    def available(self):
+        queues = [self.private_queue]
+        for priority in PRIORITIES:
+            limit = CONCURRENCY[priority]
+            if limit and self.redis_client.hlen(running_key(priority)) >= limit:
+                continue
+            queues.append(queue_key(priority))
+        return queues
+
+    def claim(self, job):
+        priority = job["job"]["priority"]
+        limit = CONCURRENCY[priority]
+        pipeline = self.redis_client.pipeline()
+        pipeline.hset(running_key(priority), self.name, job["node_id"])
+        pipeline.hlen(running_key(priority))
+        _, running = pipeline.execute()
+        if limit and running > limit:
+            # Another worker took the last slot first, hand the job back
+            pipeline = self.redis_client.pipeline()
+            pipeline.hdel(running_key(priority), self.name)
+            pipeline.lpush(queue_key(priority), json.dumps(job))
+            pipeline.execute()
+            return False
+        return True
+
+    def current(self, job, token=None):
+        if token is None:
+            token = pending(self.redis_client, job["node_id"])
+        return token is not None and token["id"] == job["job"]["id"]
+
+    def start(self, job):
+        key = token_key(job["node_id"])
+        with self.redis_client.pipeline() as pipeline:
+            try:
+                pipeline.watch(key)
+                token = pending(pipeline, job["node_id"])
+                if not self.current(job, token) or token["state"] != "queued":
+                    return False
+                pipeline.multi()
+                pipeline.hset(key, "state", "running")
+                if "worker" in token:
+                    # The job's other entry is no longer needed
+                    drop_entries(pipeline, token)
+                pipeline.execute()
+            except redis.WatchError:
+                return False
+        return True
+
+    def next_job(self, timeout=1):
+        item = self.redis_client.blpop(self.available(), timeout=timeout)
+        if item is None:
+            return None
+        queue, job = item
+        job = json.loads(job)
+
+        # Entries of superseded jobs are dropped before they take a slot
+        if not self.current(job):
+            l.info(f"Dropping superseded job for node {job['node_id']}")
+            return None
+
+        private = queue.decode() == self.private_queue
+        if not private and not self.claim(job):
+            return None
+
+        priority = job["job"]["priority"]
+        if not self.start(job):
+            l.info(f"Dropping superseded job for node {job['node_id']}")
+            self.redis_client.hdel(running_key(priority), self.name)
+            return None
+
+        wait_time = time.time() - job["job"]["enqueued"]
+        metrics.observe(self.redis_client, f"scheduler.wait.{priority}", wait_time)
+        if "timing" in job:
+            timing.stamp(job["timing"], "dequeued")
+        else:
+            job["timing"] = timing.start("dequeued")
+        return job
+
+    def done(self, job):
+        self.redis_client.hdel(running_key(job["job"]["priority"]), self.name)
+        token = pending(self.redis_client, job["node_id"])
+        if self.current(job, token):
+            cancel(self.redis_client, job["node_id"], token)
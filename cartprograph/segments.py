@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import bisect
+import hashlib
+import collections
+import logging
+
+import redis
+
+from . import blocks
+from .blocks import BasicBlocks
+
+
+l = logging.getLogger(__name__)
+
+SEGMENT_SIZE = int(os.getenv("SEGMENT_SIZE", 65536))
+# Seconds a segment stays unreferenced before a sweep deletes it
+SWEEP_GRACE = float(os.getenv("SEGMENT_SWEEP_GRACE", 600))
+
+ATTRIBUTES = [
+    "basic_blocks",
+    "syscalls",
+    "interactions",
+    "datapoints",
+]
+
+
+class SegmentCache:
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.segments = collections.OrderedDict()
+
+    def get(self, segment_id):
+        data = self.segments.get(segment_id)
+        if data is not None:
+            self.segments.move_to_end(segment_id)
+        return data
+
+    def add(self, segment_id, data):
+        if segment_id in self.segments or len(data) > self.size:
+            return
+        while self.used + len(data) > self.size:
+            _, evicted = self.segments.popitem(last=False)
+            self.used -= len(evicted)
+        self.segments[segment_id] = data
+        self.used += len(data)
+
+
+def empty(name):
+    return BasicBlocks() if name == "basic_blocks" else []
+
+
+def encode(name, values):
+    if name == "basic_blocks":
+        return blocks.encode(values)
+    return json.dumps(values).encode()
+
+
+def decode(name, data):
+    if name == "basic_blocks":
+        return blocks.decode(data)
+    return json.loads(data)
+
+
+def segment_key(segment_id):
+    return f"segment.{segment_id}"
+
+
+def length(refs):
+    return sum(segment_length for _, segment_length in refs)
+
+
+def store(redis_client, name, values, pipeline=None):
+    refs = []
+    execute = pipeline is None
+    if execute:
+        pipeline = redis_client.pipeline(transaction=False)
+    for start in range(0, len(values), SEGMENT_SIZE):
+        chunk = values[start : start + SEGMENT_SIZE]
+        data = encode(name, chunk)
+        segment_id = hashlib.blake2b(
+            name.encode() + b"\0" + data, digest_size=16
+        ).hexdigest()
+        pipeline.set(segment_key(segment_id), data, nx=True)
+        # A segment stored again is about to be referenced, so a sweep must
+        # not delete it
+        pipeline.zrem("segments.unreferenced", segment_id)
+        refs.append([segment_id, len(chunk)])
+    if execute and refs:
+        pipeline.execute()
+    return refs
+
+
+def sweep(redis_client, referenced, grace=SWEEP_GRACE):
+    # Segments are stored before the node referring to them, and stay shared
+    # by every node with the same values, so instead of counting references
+    # a segment is deleted once two sweeps at least grace seconds apart find
+    # nothing referring to it. The referenced ids are read before the scan.
+    now = time.time()
+    unreferenced = [
+        key.decode()[len(segment_key("")) :]
+        for key in redis_client.scan_iter(match=segment_key("*"), count=1000)
+    ]
+    unreferenced = [
+        segment_id for segment_id in unreferenced if segment_id not in referenced
+    ]
+
+    with redis_client.pipeline() as pipeline:
+        try:
+            # Storing a segment again removes its mark, which aborts the sweep
+            pipeline.watch("segments.unreferenced")
+            marked = {
+                segment_id.decode(): since
+                for segment_id, since in pipeline.zrange(
+                    "segments.unreferenced", 0, -1, withscores=True
+                )
+            }
+            expired = [
+                segment_id
+                for segment_id in unreferenced
+                if segment_id in marked and marked[segment_id] <= now - grace
+            ]
+            pipeline.multi()
+            pipeline.delete("segments.unreferenced")
+            for start in range(0, len(expired), 1000):
+                pipeline.delete(
+                    *(
+                        segment_key(segment_id)
+                        for segment_id in expired[start : start + 1000]
+                    )
+                )
+            marks = {
+                segment_id: marked.get(segment_id, now)
+                for segment_id in unreferenced
+                if segment_id not in expired
+            }
+            if marks:
+                pipeline.zadd("segments.unreferenced", marks)
+            pipeline.execute()
+        except redis.WatchError:
+            l.info("Segments were stored during the sweep, retrying next time")
+            return 0
+    return len(expired)
+
+
+def load(redis_client, name, refs, cache=None):
+    chunks = {}
+    missing = []
+    for segment_id, _ in refs:
+        data = cache.get(segment_id) if cache is not None else None
+        if data is None:
+            missing.append(segment_id)
+        else:
+            chunks[segment_id] = data
+
+    if missing:
+        keys = [segment_key(segment_id) for segment_id in missing]
+        for segment_id, data in zip(missing, redis_client.mget(keys)):
+            if data is None:
+                raise KeyError(f"Missing trace segment: {segment_id}")
+            chunks[segment_id] = data
+            if cache is not None:
+                cache.add(segment_id, data)
+
+    values = empty(name)
+    for segment_id, _ in refs:
+        values.extend(decode(name, chunks[segment_id]))
+    return values
+
+
+class SegmentReader:
+    # The values of a list of segments, loaded a segment at a time as they are
+    # read, so only the last two segments read are held in memory
+    def __init__(self, redis_client, name, refs, cache=None):
+        self.redis_client = redis_client
+        self.name = name
+        self.refs = refs
+        self.cache = cache
+        self.starts = [0]
+        for _, segment_length in refs:
+            self.starts.append(self.starts[-1] + segment_length)
+        self.loaded = collections.OrderedDict()
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def segment(self, position):
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+        index = bisect.bisect_right(self.starts, position) - 1
+        values = self.loaded.get(index)
+        if values is None:
+            values = load(self.redis_client, self.name, [self.refs[index]], self.cache)
+            self.loaded[index] = values
+            if len(self.loaded) > 2:
+                self.loaded.popitem(last=False)
+        return self.starts[index], values
+
+    def __getitem__(self, position):
+        start, values = self.segment(position)
+        return values[position - start]
+
+    def chunks(self, start, stop):
+        # The values in [start, stop), a slice of one segment at a time
+        while start < stop:
+            segment_start, values = self.segment(start)
+            end = min(stop, segment_start + len(values))
+            yield values[start - segment_start : end - segment_start]
+            start = end
+
+
+def load_raw(redis_client, name, refs):
+    if len(refs) == 1:
+        segment_id, _ = refs[0]
+        return redis_client.get(segment_key(segment_id))
+    return encode(name, load(redis_client, name, refs))
+
+
+def window(refs, start=0, stop=None):
+    # The segments overlapping [start, stop), and the position of the first
+    selected = []
+    first = position = 0
+    for segment_id, segment_length in refs:
+        if stop is not None and position >= stop:
+            break
+        if position + segment_length > start:
+            if not selected:
+                first = position
+            selected.append([segment_id, segment_length])
+        position += segment_length
+    return selected, first
+
+
+def load_range(redis_client, name, refs, start=0, stop=None, cache=None):
+    selected, first = window(refs, start, stop)
+    values = load(redis_client, name, selected, cache)
+    return values[start - first : stop - first if stop is not None else None]
+
+
+def etag(node_segments, names, representation=None):
+    # Segment ids are content hashes, so the refs change exactly when the data
+    # does, and the query string is part of the URL the ETag is scoped to
+    refs = [node_segments.get(name, []) for name in names]
+    data = json.dumps([refs, representation]).encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
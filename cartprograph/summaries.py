@@ -0,0 +1,59 @@
+import os
+
+from . import Node, segments
+
+
+# Longest label kept in a summary, in characters
+SUMMARY_LABEL_LENGTH = int(os.getenv("SUMMARY_LABEL_LENGTH", 80))
+
+COUNTS = ["basic_blocks", "syscalls", "interactions"]
+
+
+def empty(depth):
+    return {
+        "kind": None,
+        "label": "",
+        "truncated": False,
+        "blocked": False,
+        "depth": depth,
+        **{name: 0 for name in COUNTS},
+    }
+
+
+def update(summary, syscalls, interactions, node_segments):
+    # Traces are appended chunk by chunk, so only the appended syscalls and
+    # interactions are looked at, and the counts come from the segments
+    summary = dict(summary)
+    if summary["kind"] is None:
+        if not summary["syscalls"] and syscalls and syscalls[0]["name"] == "execve":
+            summary["kind"] = "execve"
+            summary["label"] = " ".join(syscalls[0]["args"][1])
+        elif not summary["interactions"] and interactions:
+            summary["kind"] = interactions[0]["direction"]
+    if summary["kind"] in ["input", "output"] and not summary["truncated"]:
+        summary["label"] += "".join(
+            interaction["data"]
+            for interaction in interactions
+            if interaction["data"] is not None
+        )
+    if len(summary["label"]) > SUMMARY_LABEL_LENGTH:
+        summary["label"] = summary["label"][:SUMMARY_LABEL_LENGTH]
+        summary["truncated"] = True
+    if interactions:
+        # A read still waiting for input
+        summary["blocked"] = interactions[-1]["data"] is None
+    for name in COUNTS:
+        summary[name] = segments.length((node_segments or {}).get(name, []))
+    return summary
+
+
+def load(redis_client, node_ids):
+    nodes = Node.load_many(node_ids, ["summary"], redis_client=redis_client)
+    return {node.id: node.summary for node in nodes}
+
+
+def page(redis_client, offset=0, limit=None):
+    # Nodes in id order, so a client can list the whole graph a page at a time
+    stop = offset + limit - 1 if limit is not None else -1
+    node_ids = [int(node_id) for node_id in redis_client.zrange("nodes", offset, stop)]
+    return load(redis_client, node_ids)
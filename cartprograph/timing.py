@@ -0,0 +1,73 @@
+import json
+import time
+import uuid
+import logging
+
+from . import metrics
+
+
+l = logging.getLogger(__name__)
+
+# Where an input spends its time on the way to the UI, in order. Each stage is
+# timed from the last earlier stage that was recorded, since a job from the
+# explorer or resumed from a checkpoint skips some of them.
+STAGES = [
+    "input",  # received by the web server
+    "input_event",  # read by the graph worker
+    "submitted",  # node written and trace job queued
+    "dequeued",  # taken by a trace worker
+    "target",  # target acquired or checkpoint resumed
+    "replayed",  # prefix replayed, new execution starts
+    "traced",  # trace finished or blocked
+    "applied",  # trace written to the graph
+    "broadcast",  # node update sent to clients
+]
+
+
+def start(stage):
+    return {"id": uuid.uuid4().hex, "stages": {stage: time.time()}}
+
+
+def stamp(timing, stage):
+    stages = timing["stages"]
+    if stage not in stages:
+        stages[stage] = time.time()
+    return timing
+
+
+def durations(timing):
+    stages = timing["stages"]
+    recorded = [stage for stage in STAGES if stage in stages]
+    result = {
+        stage: stages[stage] - stages[previous]
+        for previous, stage in zip(recorded, recorded[1:])
+    }
+    if result:
+        result["total"] = stages[recorded[-1]] - stages[recorded[0]]
+    return result
+
+
+def record(redis_client, timing, pipeline=None):
+    execute = pipeline is None
+    if execute:
+        pipeline = redis_client.pipeline(transaction=False)
+    stage_durations = durations(timing)
+    for stage, duration in stage_durations.items():
+        metrics.observe(redis_client, f"stage.{stage}", duration, pipeline)
+    pipeline.lpush("timings", json.dumps(timing))
+    pipeline.ltrim("timings", 0, metrics.METRICS_WINDOW - 1)
+    if execute:
+        pipeline.execute()
+    l.debug(
+        "Trace %s: %s",
+        timing["id"],
+        ", ".join(
+            f"{stage} {duration:.3f}s" for stage, duration in stage_durations.items()
+        ),
+    )
+
+
+def recent(redis_client, count=100):
+    return [
+        json.loads(timing) for timing in redis_client.lrange("timings", 0, count - 1)
+    ]
@@ -0,0 +1,255 @@
+import os
+import socket
+import logging
+import functools
+
+import qtrace
+
+from .tracing import Desync, TracingList, TracingBlocks
+
+
+l = logging.getLogger(__name__)
+
+SYSCALL_NAMES = [
+    definition[1][len("sys_") :] for definition in qtrace.syscalls["x86_64"]
+]
+
+
+class Block(Exception):
+    pass
+
+
+class CartprographTracer(qtrace.TraceMachine):
+    syscall_start_handlers = {
+        "read": "handle_read",
+        "write": "handle_write",
+        "accept": "handle_accept",
+    }
+    syscall_end_handlers = {
+        "accept": "handle_accept_end",
+    }
+
+    def __init__(
+        self,
+        target,
+        basic_blocks,
+        syscalls,
+        interactions,
+        datapoints,
+        *,
+        prefix=None,
+        on_block=None,
+        on_progress=None,
+    ):
+        super().__init__(argv=target.target_args)
+
+        self.target = target
+        self.on_block = on_block
+        self.on_progress = on_progress
+        # The recorded trace before the given one, replayed without being
+        # kept in memory
+        if prefix is None:
+            prefix = {}
+        self.basic_blocks = TracingBlocks(
+            basic_blocks, prefix=prefix.get("basic_blocks", ())
+        )
+        self.syscalls = TracingList(syscalls, prefix=prefix.get("syscalls", ()))
+        self.interactions = TracingList(
+            interactions, prefix=prefix.get("interactions", ())
+        )
+        self.datapoints = TracingList(datapoints, prefix=prefix.get("datapoints", ()))
+
+        self.syscall_table = self.dispatch_table()
+        self.trace_index = -1
+        self.buffered_interaction = {
+            "channel": None,
+            "direction": None,
+            "data": None,
+        }
+
+        self._fd_channels = {}
+
+    @property
+    def fd_channels(self):
+        if not self._fd_channels:
+            stdin, stdout, stderr = self.std_streams
+            self._fd_channels.update(
+                {
+                    0: ("stdio", stdin),
+                    1: ("stdio", stdout),
+                    2: ("stderr", stderr),
+                }
+            )
+        return self._fd_channels
+
+    @classmethod
+    def dispatch_table(cls):
+        # One (name, start handler, end handler) entry per syscall number,
+        # built once for each tracer class
+        if "_dispatch_table" not in cls.__dict__:
+            cls._dispatch_table = [
+                (
+                    name,
+                    getattr(cls, cls.syscall_start_handlers.get(name, ""), None),
+                    getattr(cls, cls.syscall_end_handlers.get(name, ""), None),
+                )
+                for name in SYSCALL_NAMES
+            ]
+        return cls._dispatch_table
+
+    def run(self, *args, **kwargs):
+        syscall = {
+            "nr": None,
+            "name": "execve",
+            "args": [self.target.target_args[0], self.target.target_args, {}],
+            "ret": None,
+            "trace_index": -1,
+        }
+        self.syscalls.append(syscall)
+
+        super().run(*args, **kwargs)
+
+    # The base class keeps every event in self.trace, which is never used here
+    # and grows with the trace, so its handlers are not called
+
+    def on_basic_blocks(self, addresses):
+        self.basic_blocks.extend(addresses)
+        self.trace_index += len(addresses)
+        if self.on_progress is not None:
+            self.on_progress()
+
+    def on_syscall_start(self, syscall_nr, *args):
+        self.ack()
+        self.basic_blocks.checkpoint()
+        syscall_name, start_handler, _ = self.syscall_table[syscall_nr]
+        l.debug("Trace syscall start: %s", syscall_name)
+        syscall = {
+            "nr": syscall_nr,
+            "name": syscall_name,
+            "args": list(args),
+            "ret": None,
+            "trace_index": self.trace_index,
+        }
+        self.syscalls.append(syscall, ignore_attrs=["ret"])
+
+        if start_handler is not None:
+            start_handler(self, *args)
+
+    def on_syscall_end(self, syscall_nr, ret):
+        self.ack()
+        current_syscall = self.syscalls.previous
+        syscall_name, _, end_handler = self.syscall_table[syscall_nr]
+        l.debug("Trace syscall end: %s", syscall_name)
+        assert current_syscall["nr"] == syscall_nr
+        assert current_syscall["trace_index"] == self.trace_index
+        if self.syscalls.tracing:
+            assert current_syscall["ret"] == ret
+        current_syscall["ret"] = ret
+
+        if end_handler is not None:
+            end_handler(self, ret)
+
+    def handle_read(self, fd, buf, count):
+        if fd not in self.fd_channels:
+            return
+        channel_name, channel = self.fd_channels[fd]
+        interaction = {
+            "channel": channel_name,
+            "direction": "input",
+            "data": None,
+            "trace_index": self.trace_index,
+        }
+        buffered_interaction_available = (
+            all(
+                self.buffered_interaction[attr] == interaction[attr]
+                for attr in ["channel", "direction"]
+            )
+            and self.buffered_interaction["data"]
+        )
+
+        if self.interactions.tracing:
+            current_interaction = self.interactions.current
+            for attr in ["channel", "direction", "trace_index"]:
+                if current_interaction[attr] != interaction[attr]:
+                    raise Desync()
+            interaction["data"] = current_interaction["data"]
+        elif buffered_interaction_available:
+            interaction["data"] = self.buffered_interaction["data"]
+        else:
+            self.interactions.append(interaction)
+            if self.on_block is None:
+                raise Block()
+            interaction["data"] = self.on_block(interaction)
+            self.interactions.pop()
+
+        data = interaction["data"]
+        data, buffered_data = data[:count], data[count:]
+        l.info("data=%r, buffered_data=%r", data, buffered_data)
+        interaction["data"] = data
+        for attr in ["channel", "direction"]:
+            self.buffered_interaction[attr] = interaction[attr]
+        self.buffered_interaction["data"] = buffered_data
+        os.write(channel.fileno(), data.encode("latin"))
+
+        if self.interactions.tracing:
+            assert self.interactions.current["data"].startswith(data)
+            self.interactions.current["data"] = data
+        self.interactions.append(interaction)
+
+    def handle_write(self, fd, buf, count):
+        if fd not in self.fd_channels:
+            return
+        channel_name, channel = self.fd_channels[fd]
+        data = os.read(channel.fileno(), count)
+        interaction = {
+            "channel": channel_name,
+            "direction": "output",
+            "data": data.decode("latin"),
+            "trace_index": self.trace_index,
+        }
+        self.interactions.append(interaction)
+
+    def handle_accept(self, sockfd, addr, addrlen):
+        # TODO: determine the port correctly (with detailed syscall info)
+        address = (self.target.ipv4_address, self.target.tcp_ports[0])
+        self.accepted_socket = socket.create_connection(address)
+
+    def handle_accept_end(self, ret):
+        if hasattr(self, "accepted_socket"):
+            port = self.accepted_socket.getpeername()[1]
+            self.fd_channels[ret] = (f"TCP:{port}", self.accepted_socket)
+            del self.accepted_socket
+
+
+def tracepoint_callback(address, registers):
+    @qtrace.breakpoint(address)
+    def callback(self):
+        gdb_registers = self.gdb.registers
+        data = {}
+        for register in registers:
+            data[register] = gdb_registers[register]
+        self.datapoints.append(
+            {"address": address, "data": data, "trace_index": self.trace_index}
+        )
+
+    return callback
+
+
+@functools.lru_cache(maxsize=64)
+def tracepoint_class(tracepoints):
+    attributes = {
+        f"breakpoint_{hex(address)}": tracepoint_callback(address, registers)
+        for address, registers in tracepoints
+    }
+    return type("CartprographTracer", (CartprographTracer,), attributes)
+
+
+def tracer_class(tracepoints):
+    # Tracepoint callbacks are built once per set of tracepoints and reused
+    # for every job tracing with it
+    return tracepoint_class(
+        tuple(
+            (tracepoint["address"], tuple(tracepoint["datapoints"]))
+            for tracepoint in tracepoints
+        )
+    )
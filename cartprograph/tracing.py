@@ -0,0 +1,198 @@
+import os
+import zlib
+import ctypes
+
+from .blocks import BasicBlocks
+
+
+# How replayed trace data is checked against what was recorded:
+#   full:    every element is compared
+#   sampled: every REPLAY_SAMPLE_INTERVAL-th element is compared, as is the
+#            last recorded element before new data is traced
+#   hash:    basic blocks are hashed as they replay and the hashes compared at
+#            every syscall, other elements only compare their trace index
+#   off:     nothing is compared
+VERIFY_MODES = ["full", "sampled", "hash", "off"]
+REPLAY_VERIFY = os.getenv("REPLAY_VERIFY", "full")
+REPLAY_SAMPLE_INTERVAL = int(os.getenv("REPLAY_SAMPLE_INTERVAL", 64))
+
+
+class Desync(Exception):
+    pass
+
+
+def verify_mode(verify):
+    if verify is None:
+        verify = REPLAY_VERIFY
+    if verify not in VERIFY_MODES:
+        raise ValueError(f"Unknown replay verification mode: {verify}")
+    return verify
+
+
+class TracingList(list):
+    def __init__(self, *args, prefix=(), verify=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Recorded elements before the list are read from the prefix as they
+        # replay and are never kept in the list, so the current index starts
+        # out negative
+        self.prefix = prefix
+        self.current_index = -len(prefix)
+        self.initial_len = len(self)
+        self.discarded = len(prefix)
+        self.verify = verify_mode(verify)
+        self.check = getattr(self, f"check_{self.verify}")
+
+    @property
+    def tracing(self):
+        return self.current_index < self.initial_len
+
+    @property
+    def current(self):
+        return self.recorded(self.current_index)
+
+    @property
+    def previous(self):
+        return self.recorded(self.current_index - 1)
+
+    def recorded(self, index):
+        if index < 0:
+            return self.prefix[len(self.prefix) + index]
+        return self[index]
+
+    def check_full(self, element, ignore_attrs):
+        if ignore_attrs:
+            attrs = (set(self.current) | set(element)) - set(ignore_attrs)
+            if any(self.current[attr] != element[attr] for attr in attrs):
+                raise Desync()
+        elif self.current != element:
+            raise Desync()
+
+    def check_sampled(self, element, ignore_attrs):
+        if (
+            (self.discarded + self.current_index) % REPLAY_SAMPLE_INTERVAL == 0
+            or self.current_index == self.initial_len - 1
+        ):
+            self.check_full(element, ignore_attrs)
+
+    def check_hash(self, element, ignore_attrs):
+        if self.current.get("trace_index") != element.get("trace_index"):
+            raise Desync()
+
+    def check_off(self, element, ignore_attrs):
+        pass
+
+    def append(self, element, *, ignore_attrs=None):
+        if self.tracing:
+            self.check(element, ignore_attrs)
+        else:
+            super().append(element)
+        self.current_index += 1
+
+    def pop(self):
+        self.current_index -= 1
+        return super().pop()
+
+    def extend(self, iterable, *, ignore_attrs=None):
+        for element in iterable:
+            self.append(element, ignore_attrs=ignore_attrs)
+
+    def discard(self, count):
+        del self[:count]
+        self.current_index -= count
+        self.initial_len = max(self.initial_len - count, 0)
+        self.discarded += count
+
+
+class TracingBlocks(BasicBlocks):
+    def __new__(cls, addresses=(), *, prefix=(), verify=None):
+        return super().__new__(cls, addresses)
+
+    def __init__(self, addresses=(), *, prefix=(), verify=None):
+        self.prefix = prefix
+        self.current_index = -len(prefix)
+        self.initial_len = len(self)
+        self.discarded = len(prefix)
+        self.verify = verify_mode(verify)
+        self.check = getattr(self, f"check_{self.verify}")
+        self.batches = 0
+        # Running checksums of the replayed and recorded blocks, and how far
+        # into the recorded blocks the latter has got
+        self.replayed_hash = 0
+        self.recorded_hash = 0
+        self.hashed_index = -len(prefix)
+
+    @property
+    def tracing(self):
+        return self.current_index < self.initial_len
+
+    def recorded(self, start, stop):
+        # The recorded blocks in [start, stop), a segment at a time for those
+        # in the prefix
+        if start < 0:
+            prefix_len = len(self.prefix)
+            yield from self.prefix.chunks(prefix_len + start, prefix_len + min(stop, 0))
+        if stop > 0:
+            yield self[max(start, 0) : stop]
+
+    def check_full(self, addresses, num_traced):
+        addresses = BasicBlocks(addresses)
+        position = 0
+        for recorded in self.recorded(
+            self.current_index, self.current_index + num_traced
+        ):
+            if recorded != addresses[position : position + len(recorded)]:
+                raise Desync()
+            position += len(recorded)
+
+    def check_sampled(self, addresses, num_traced):
+        self.batches += 1
+        if (
+            self.batches % REPLAY_SAMPLE_INTERVAL == 0
+            or self.current_index + num_traced == self.initial_len
+        ):
+            self.check_full(addresses, num_traced)
+
+    def check_hash(self, addresses, num_traced):
+        if not isinstance(addresses, (ctypes.Array, BasicBlocks)):
+            addresses = BasicBlocks(addresses)
+        self.replayed_hash = zlib.crc32(
+            memoryview(addresses)[:num_traced], self.replayed_hash
+        )
+        if self.current_index + num_traced == self.initial_len:
+            self.verify_hash(self.initial_len)
+
+    def check_off(self, addresses, num_traced):
+        pass
+
+    def verify_hash(self, end):
+        for recorded in self.recorded(self.hashed_index, end):
+            self.recorded_hash = zlib.crc32(recorded, self.recorded_hash)
+        self.hashed_index = end
+        if self.recorded_hash != self.replayed_hash:
+            raise Desync()
+
+    def checkpoint(self):
+        # Called at syscall boundaries, where hashed blocks are compared
+        if self.verify == "hash" and self.tracing:
+            self.verify_hash(self.current_index)
+
+    def extend(self, addresses):
+        if self.tracing:
+            num_traced = min(len(addresses), self.initial_len - self.current_index)
+            self.check(addresses, num_traced)
+            self.current_index += num_traced
+            if num_traced == len(addresses):
+                # Replayed blocks are already recorded, so only new ones are
+                # ever converted
+                return
+            addresses = BasicBlocks(addresses)[num_traced:]
+        else:
+            addresses = BasicBlocks(addresses)
+        super().extend(addresses)
+        self.current_index += len(addresses)
+
+    def discard(self, count):
+        del self[:count]
+        self.current_index -= count
+        self.initial_len = max(self.initial_len - count, 0)
+        self.discarded += count
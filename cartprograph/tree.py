@@ -0,0 +1,170 @@
+import os
+import json
+
+import redis
+
+from . import Node, events, segments, summaries
+from .index import children_key
+
+
+# Most nodes a subtree query returns, deeper levels are cut off past this
+SUBTREE_LIMIT = int(os.getenv("SUBTREE_LIMIT", 10000))
+
+
+def children(redis_client, node_ids):
+    # Children are added as nodes are created, so unlike ancestry they are
+    # always read from Redis
+    pipeline = redis_client.pipeline(transaction=False)
+    for node_id in node_ids:
+        pipeline.zrange(children_key(node_id), 0, -1)
+    return [
+        [int(child_id) for child_id in child_ids] for child_ids in pipeline.execute()
+    ]
+
+
+def subtree(redis_client, ancestor_index, node_id, depth=1, limit=SUBTREE_LIMIT):
+    # Nodes up to depth levels below node_id in depth first order, with one
+    # round trip per level and a constant amount of data per node
+    ancestor_index.fetch(node_id)
+    if node_id not in ancestor_index:
+        return None
+    parents = {node_id: ancestor_index.parents[node_id]}
+    depths = {node_id: ancestor_index.depths[node_id]}
+    node_children = {}
+    level = [node_id]
+    truncated = False
+    for _ in range(depth):
+        next_level = []
+        for parent_id, child_ids in zip(level, children(redis_client, level)):
+            if limit is not None and len(parents) + len(child_ids) > limit:
+                truncated = True
+                break
+            node_children[parent_id] = child_ids
+            for child_id in child_ids:
+                parents[child_id] = parent_id
+                depths[child_id] = depths[parent_id] + 1
+            next_level += child_ids
+        level = next_level
+        if truncated or not level:
+            break
+
+    node_ids = []
+    stack = [node_id]
+    while stack:
+        current_id = stack.pop()
+        node_ids.append(current_id)
+        stack += reversed(node_children.get(current_id, []))
+
+    pipeline = redis_client.pipeline(transaction=False)
+    for current_id in node_ids:
+        pipeline.zcard(children_key(current_id))
+    pipeline.hmget("lengths", node_ids)
+    *num_children, lengths = pipeline.execute()
+    node_summaries = summaries.load(redis_client, node_ids)
+    nodes = []
+    for current_id, current_children, current_lengths in zip(
+        node_ids, num_children, lengths
+    ):
+        current_lengths = json.loads(current_lengths) if current_lengths else []
+        nodes.append(
+            {
+                "id": current_id,
+                "parent_id": parents[current_id],
+                "depth": depths[current_id],
+                "children": current_children,
+                "lengths": {
+                    name: current_lengths[i] if i < len(current_lengths) else 0
+                    for i, name in enumerate(segments.ATTRIBUTES)
+                },
+                "summary": node_summaries[current_id],
+            }
+        )
+    return {"nodes": nodes, "truncated": truncated}
+
+
+def ancestors(ancestor_index, node_id):
+    ancestor_index.fetch(node_id)
+    if node_id not in ancestor_index:
+        return None
+    return ancestor_index.ancestors(node_id)
+
+
+def transcript(redis_client, ancestor_index, node_id):
+    # Interactions from the root down to node_id, consecutive interactions of
+    # a node on the same channel and direction joined into one entry
+    node_ids = ancestors(ancestor_index, node_id)
+    if node_ids is None:
+        return None
+    nodes = Node.load_many(node_ids, ["segments"], redis_client=redis_client)
+    refs = [(node.segments or {}).get("interactions", []) for node in nodes]
+    interactions = segments.load(
+        redis_client,
+        "interactions",
+        [ref for node_refs in refs for ref in node_refs],
+    )
+
+    entries = []
+    blocked = False
+    position = 0
+    for current_id, node_refs in zip(node_ids, refs):
+        num_interactions = segments.length(node_refs)
+        node_interactions = interactions[position : position + num_interactions]
+        position += num_interactions
+        for interaction in node_interactions:
+            if interaction["data"] is None:
+                # A read still waiting for input
+                blocked = current_id == node_id
+                continue
+            entry = entries[-1] if entries else None
+            if (
+                entry is None
+                or entry["node_id"] != current_id
+                or entry["channel"] != interaction["channel"]
+                or entry["direction"] != interaction["direction"]
+            ):
+                entry = {
+                    "node_id": current_id,
+                    "channel": interaction["channel"],
+                    "direction": interaction["direction"],
+                    "data": "",
+                }
+                entries.append(entry)
+            entry["data"] += interaction["data"]
+    return {"node_id": node_id, "blocked": blocked, "transcript": entries}
+
+
+def updates(redis_client, node_ids):
+    parent_ids = Node.parent_ids(node_ids, redis_client)
+    return [
+        {"src_id": parent_id, "dst_id": node_id}
+        for node_id, parent_id in zip(node_ids, parent_ids)
+    ]
+
+
+def snapshot(redis_client):
+    # Read the sequence number first, anything added while we read the edges
+    # is also delivered as a delta, and applying an update twice is harmless
+    seq = events.last_id(redis_client, "event.node")
+    return {
+        "seq": seq,
+        "nodes": [
+            [node_id, parent_id]
+            for node_id, parent_id in sorted(Node.edges(redis_client).items())
+        ],
+    }
+
+
+def missed_updates(redis_client, seq):
+    # The updates since seq, or None if they may have been trimmed already
+    try:
+        entries = events.entries_since(redis_client, "event.node", seq)
+    except (ValueError, redis.ResponseError):
+        return None
+    if entries is None:
+        return None
+
+    node_ids = list(dict.fromkeys(int(fields[b"data"]) for _, fields in entries))
+    return {
+        "seq": entries[-1][0].decode() if entries else seq,
+        "updates": updates(redis_client, node_ids),
+    }
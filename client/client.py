@@ -1,31 +1,42 @@
 import os
+import json
 import time
+import zlib
 
-import networkx as nx
 import requests
 import socketio
 
 URL = "http://localhost:4242/"
+# Levels of the tree shown below the root
+DEPTH = int(os.getenv("DEPTH", 100))
 
 
 class GraphUpdateNamespace(socketio.ClientNamespace):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.graph = nx.DiGraph()
+        self.seq = None
 
-    def on_update(self, data):
-        parent_id, node_id = data["src_id"], data["dst_id"]
+    def auth(self):
+        return {"seq": self.seq, "compress": True}
 
-        def get_trace(attr):
-            return requests.get(f"{URL}/trace/{attr}/{node_id}").json()
+    def advance(self, seq):
+        if seq is None:
+            return
+        if self.seq is None or parse_seq(seq) > parse_seq(self.seq):
+            self.seq = seq
 
-        node_attrs = {
-            attr: get_trace(attr)
-            for attr in ["basic_blocks", "syscalls", "interactions"]
-        }
-        self.graph.add_node(node_id, **node_attrs)
-        if node_id:
-            self.graph.add_edge(parent_id, node_id)
+    def on_snapshot(self, data):
+        if isinstance(data, bytes):
+            data = json.loads(zlib.decompress(data))
+        self.advance(data["seq"])
+
+    def on_updates(self, data):
+        self.advance(data["seq"])
+
+
+def parse_seq(seq):
+    ms, _, seq = seq.partition("-")
+    return int(ms), int(seq or 0)
 
 
 def pretty_print(color, *values, depth=None, reset=True, end="\n"):
@@ -52,40 +63,46 @@ def main():
     client = socketio.Client()
     graph_update_namespace = GraphUpdateNamespace()
     client.register_namespace(graph_update_namespace)
-    client.connect(URL)
+    client.connect(URL, auth=graph_update_namespace.auth)
 
-    graph = graph_update_namespace.graph
-    while 0 not in graph.nodes:
+    session = requests.Session()
+    while session.get(f"{URL}/subtree/0", params={"depth": 0}).status_code != 200:
         time.sleep(1)
 
     while True:
         os.system("clear")
 
-        depths = nx.shortest_path_length(graph, 0)
-
-        for node_id in nx.dfs_preorder_nodes(graph, 0):
-            node = graph.nodes[node_id]
-            depth = depths[node_id]
+        # The server walks the tree, in depth first order, and labels each
+        # node from its summary
+        subtree = session.get(f"{URL}/subtree/0", params={"depth": DEPTH}).json()
 
-            syscalls = node["syscalls"]
-            interactions = node["interactions"]
+        for tree_node in subtree["nodes"]:
+            node_id = tree_node["id"]
+            depth = tree_node["depth"]
+            summary = tree_node["summary"] or {}
+            kind = summary.get("kind")
+            label = repr(summary.get("label"))
+            if summary.get("truncated"):
+                label += "..."
 
-            if syscalls[0]["name"] == "execve":
-                pretty_print("magenta", syscalls[0]["args"][1], depth=depth)
+            if kind == "execve":
+                pretty_print("magenta", summary["label"], depth=depth)
 
-            elif interactions and interactions[0]["direction"] == "input":
-                if interactions[0]["data"] is None:
+            elif kind == "input":
+                if summary["blocked"]:
                     pretty_print("yellow", f"[INTERACT {node_id}]", depth=depth)
                 else:
-                    data = "".join(interaction["data"] for interaction in interactions)
-                    pretty_print("blue", repr(data), depth=depth)
+                    pretty_print("blue", label, depth=depth)
 
-            elif interactions and interactions[0]["direction"] == "output":
-                data = "".join(interaction["data"] for interaction in interactions)
-                pretty_print("green", repr(data), depth=depth)
+            elif kind == "output":
+                pretty_print("green", label, depth=depth)
 
             else:
-                assert False
+                # Not traced yet
+                pretty_print("yellow", f"[{node_id}]", depth=depth)
+
+        if subtree["truncated"]:
+            pretty_print("yellow", "...")
 
         print()
 
@@ -96,19 +113,12 @@ def main():
 
         print()
 
-        for ancestor_node_id in nx.shortest_path(graph, 0, node_id):
-            if ancestor_node_id in [0, node_id]:
-                continue
-            node = graph.nodes[ancestor_node_id]
-
-            interactions = node["interactions"]
-
-            if interactions and interactions[0]["direction"] == "input":
-                data = "".join(interaction["data"] for interaction in interactions)
-                pretty_print("blue", data, end="")
-            elif interactions and interactions[0]["direction"] == "output":
-                data = "".join(interaction["data"] for interaction in interactions)
-                pretty_print("green", data, end="")
+        transcript = session.get(f"{URL}/transcript/{node_id}").json()
+        for entry in transcript["transcript"]:
+            if entry["direction"] == "input":
+                pretty_print("blue", entry["data"], end="")
+            elif entry["direction"] == "output":
+                pretty_print("green", entry["data"], end="")
 
         pretty_print("blue", reset=False)
 
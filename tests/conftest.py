@@ -0,0 +1,64 @@
+import os
+import importlib.util
+
+import pytest
+import redis
+import fakeredis
+
+from cartprograph import context
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class CountingConnection(fakeredis.FakeRedisConnection):
+    # Every command, or every pipeline, is sent to the server in one write
+    round_trips = 0
+
+    def send_packed_command(self, *args, **kwargs):
+        CountingConnection.round_trips += 1
+        return super().send_packed_command(*args, **kwargs)
+
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def redis_client(redis_server):
+    pool = redis.ConnectionPool(
+        connection_class=CountingConnection, server=redis_server
+    )
+    client = redis.Redis(connection_pool=pool)
+    client.ping()
+    saved = dict(context)
+    context.update(redis_client=client, cached_graph=None, ancestor_index=None)
+    yield client
+    context.update(saved)
+
+
+@pytest.fixture
+def round_trips():
+    def count(f, *args, **kwargs):
+        start = CountingConnection.round_trips
+        result = f(*args, **kwargs)
+        return result, CountingConnection.round_trips - start
+
+    return count
+
+
+@pytest.fixture
+def load_worker(monkeypatch):
+    def load(name, redis_client, module_name=None):
+        spec = importlib.util.spec_from_file_location(
+            module_name or name, os.path.join(ROOT, "workers", f"{name}.py")
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        # The workers connect to the default Redis when imported
+        module.redis_client = redis_client
+        monkeypatch.setitem(context, "redis_client", redis_client)
+        monkeypatch.setitem(context, "cached_graph", None)
+        return module
+
+    return load
@@ -0,0 +1,35 @@
+import pytest
+
+from cartprograph import blocks
+from cartprograph.blocks import BasicBlocks
+
+ADDRESSES = [
+    [],
+    [0x400000, 0x400010, 0x400008, 0x7F0000001000, 0x400000],
+    [0, 2**64 - 1, 0, 2**63, 2**63 - 1, 2**64 - 2, 1],
+    [2**64 - 1] * 3,
+]
+
+
+@pytest.fixture(params=["numpy", "python"])
+def implementation(request, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(blocks, "np", None)
+    return request.param
+
+
+@pytest.mark.parametrize("addresses", ADDRESSES)
+@pytest.mark.parametrize("codec", ["raw", "delta-varint"])
+def test_round_trip(implementation, addresses, codec):
+    basic_blocks = BasicBlocks(addresses)
+    assert blocks.loads(blocks.dumps(basic_blocks, codec)) == basic_blocks
+
+
+@pytest.mark.parametrize("addresses", ADDRESSES)
+def test_implementations_agree(monkeypatch, addresses):
+    basic_blocks = BasicBlocks(addresses)
+    encoded = blocks.encode(basic_blocks, "delta-varint")
+    with monkeypatch.context() as m:
+        m.setattr(blocks, "np", None)
+        assert blocks.encode(basic_blocks, "delta-varint") == encoded
+        assert blocks.decode(encoded) == basic_blocks
@@ -0,0 +1,70 @@
+import pytest
+
+from cartprograph import Node, events
+
+
+class Recorder:
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data):
+        self.emitted.append((event, data))
+
+
+@pytest.fixture
+def broadcast_worker(redis_client, load_worker):
+    module = load_worker("broadcast_worker", redis_client)
+    module.socketio = Recorder()
+    return module
+
+
+def consumer(broadcast_worker):
+    consumer = broadcast_worker.BroadcastConsumer(
+        broadcast_worker.redis_client,
+        broadcast_worker.GROUP,
+        "broadcast_worker",
+        {"event.node": broadcast_worker.handle_node_event},
+    )
+    consumer.create_groups()
+    return consumer
+
+
+def pending(redis_client):
+    return redis_client.xpending("event.node", "broadcast_worker")["pending"]
+
+
+def test_entries_are_acked_after_emit(redis_client, broadcast_worker):
+    node = Node.create(0, cached_graph=None)
+    node.parent_id = None
+    broadcast_consumer = consumer(broadcast_worker)
+    for _ in range(3):
+        events.publish(redis_client, "event.node", 0)
+    broadcast_consumer.read({"event.node": ">"})
+
+    assert broadcast_worker.socketio.emitted == []
+    assert pending(redis_client) == 3
+    broadcast_worker.batch.flush()
+    [(name, data)] = broadcast_worker.socketio.emitted
+    assert name == "updates"
+    assert data["updates"] == [{"src_id": None, "dst_id": 0}]
+    assert pending(redis_client) == 0
+
+
+def test_unemitted_entries_stay_pending(redis_client, broadcast_worker):
+    def fail(event, data):
+        raise ConnectionError()
+
+    broadcast_worker.socketio.emit = fail
+    broadcast_consumer = consumer(broadcast_worker)
+    last_id = events.publish(redis_client, "event.node", 0).decode()
+    broadcast_consumer.read({"event.node": ">"})
+    with pytest.raises(ConnectionError):
+        broadcast_worker.batch.flush()
+    assert pending(redis_client) == 1
+
+    # A restarted worker claims the entry again, its seq never goes backwards
+    restarted = broadcast_worker.UpdateBatch()
+    newer_id = events.publish(redis_client, "event.node", 1).decode()
+    restarted.add(1, newer_id)
+    restarted.add(0, last_id)
+    assert restarted.seq == newer_id
@@ -0,0 +1,99 @@
+import pytest
+
+from cartprograph import coverage
+from cartprograph.blocks import BasicBlocks
+
+MAPS = [
+    {
+        "start_address": 0x5000,
+        "end_address": 0x6000,
+        "offset": 0x1000,
+        "pathname": "/lib",
+    },
+    {"start_address": 0x1000, "end_address": 0x2000, "offset": 0, "pathname": "/bin"},
+    {"start_address": 0x2000, "end_address": 0x3000, "offset": 0, "pathname": None},
+]
+
+
+@pytest.fixture(params=["numpy", "python"])
+def fresh_coverage(request, monkeypatch):
+    monkeypatch.setattr(coverage, "module_ids", {})
+    if request.param == "python":
+        monkeypatch.setattr(coverage, "np", None)
+
+
+def record(redis_client, traces):
+    return coverage.record(
+        redis_client,
+        [(node_id, BasicBlocks(addresses)) for node_id, addresses in traces],
+        MAPS,
+    )
+
+
+def hits(redis_client, pathname, offset):
+    _, module, offset = coverage.locate(redis_client, offset, pathname=pathname)
+    return coverage.hits(redis_client, module, offset)
+
+
+def test_record(redis_client, fresh_coverage):
+    novelty = record(
+        redis_client,
+        [
+            (1, [0x1010, 0x5020, 0x1010, 0x4000, 0x2008]),
+            (2, [0x5020, 0x1020, 0x6000]),
+        ],
+    )
+    assert novelty == {1: 3, 2: 1}
+    assert coverage.summary(redis_client) == {
+        "total": 4,
+        "modules": {"/bin": 2, "/lib": 1, "[anonymous]": 1},
+    }
+
+    # The same node again in a later chunk, as its trace streams in
+    novelty = record(redis_client, [(2, [0x1010, 0x1030]), (3, [0x1030])])
+    assert novelty == {2: 1, 3: 0}
+    assert hits(redis_client, "/bin", 0x10) == {"first_seen": 1, "nodes": [1, 2]}
+    assert hits(redis_client, "/lib", 0x1020) == {"first_seen": 1, "nodes": [1, 2]}
+    assert hits(redis_client, "/bin", 0x30) == {"first_seen": 2, "nodes": [2, 3]}
+    assert hits(redis_client, "/bin", 0x40) == {"first_seen": None, "nodes": []}
+    assert coverage.total(redis_client) == 5
+
+
+def test_keys_do_not_grow_with_nodes(redis_client, fresh_coverage, monkeypatch):
+    monkeypatch.setattr(coverage, "SHARD_SIZE", 0x80)
+    record(redis_client, [(node_id, [0x1000 + node_id]) for node_id in range(100)])
+    record(redis_client, [(node_id, range(0x1000, 0x1100)) for node_id in range(10)])
+    keys = {key.decode() for key in redis_client.keys("coverage.*")}
+    assert keys == {
+        "coverage.modules",
+        "coverage.modules.next_id",
+        "coverage.bitmap.0",
+        "coverage.first_seen.0",
+        "coverage.node_blocks.0",
+        "coverage.block_nodes.0.0",
+        "coverage.block_nodes.0.1",
+        "coverage.novelty",
+        "coverage.total",
+        "coverage.timeline",
+    }
+    assert hits(redis_client, "/bin", 0x5)["nodes"] == list(range(10))
+    assert hits(redis_client, "/bin", 0x50) == {
+        "first_seen": 80,
+        "nodes": [*range(10), 80],
+    }
+    assert hits(redis_client, "/bin", 0x80)["nodes"] == list(range(10))
+    assert hits(redis_client, "/bin", 0xFF)["nodes"] == list(range(10))
+
+
+def test_hits_are_one_round_trip(redis_client, fresh_coverage, round_trips):
+    for num_nodes in [10, 1000]:
+        record(
+            redis_client,
+            [(node_id, [0x1000, 0x1000 + node_id]) for node_id in range(num_nodes)],
+        )
+        result, count = round_trips(coverage.hits, redis_client, 0, 0)
+        assert result == {"first_seen": 0, "nodes": list(range(num_nodes))}
+        assert count == 1
+        result, count = round_trips(coverage.hits, redis_client, 0, 500)
+        assert result["nodes"] == ([500] if num_nodes > 500 else [])
+        assert count == 1
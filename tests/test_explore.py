@@ -0,0 +1,44 @@
+import random
+
+from cartprograph import Node, explore, scheduler
+from cartprograph.explore import Explorer
+
+BLOCKED = [{"direction": "input", "data": None}]
+
+
+def blocked_node(node_id):
+    node = Node.create(node_id)
+    with node.batch():
+        node.parent_id = 0
+        node.interactions = BLOCKED
+    return node
+
+
+def test_tracking_is_bounded(redis_client, monkeypatch):
+    monkeypatch.setattr(explore, "MAX_TRACKED", 4)
+    explorer = Explorer(redis_client, ["seed"], inputs_per_node=2, rng=random.Random(0))
+    for node_id in range(1, 11):
+        blocked_node(node_id)
+        explorer.observe(node_id)
+    assert list(explorer.selected) == [7, 8, 9, 10]
+
+    inputs = []
+    while True:
+        explored = explorer.explore()
+        if explored is None:
+            break
+        inputs.append(explored)
+        assert len(explorer.pending) <= 4
+        assert len(explorer.candidates) <= 8
+    assert sorted(node_id for node_id, _, _ in inputs) == [7, 7, 8, 8, 9, 9, 10, 10]
+    # Nodes that had all their inputs are dropped
+    assert explorer.selected == {}
+
+    # Inputs are resolved to the nodes they made before any are dropped
+    for node_id, (blocked_id, data, _) in enumerate(inputs, 11):
+        redis_client.hset("paths", scheduler.path_hash(blocked_id, data), node_id)
+    blocked_node(19)
+    explorer.observe(19)
+    explorer.explore()
+    assert list(explorer.origins) == [15, 16, 17, 18]
+    assert len(explorer.pending) == 1
@@ -0,0 +1,66 @@
+from cartprograph import Node
+from cartprograph.blocks import BasicBlocks
+from cartprograph.index import AncestorIndex
+
+
+def create(node_id, parent_id, redis_client, ancestor_index):
+    node = Node.create(
+        node_id,
+        redis_client=redis_client,
+        cached_graph=None,
+        ancestor_index=ancestor_index,
+    )
+    with node.batch():
+        node.parent_id = parent_id
+        node.tracepoints = []
+        node.basic_blocks = BasicBlocks([node_id, node_id + 1])
+        node.syscalls = [{"name": "read", "trace_index": 1}]
+        node.interactions = [{"channel": "stdio", "direction": "input", "data": "a"}]
+        node.datapoints = []
+        node.maps = None
+    return node
+
+
+def test_batch_is_one_round_trip(redis_client, round_trips):
+    ancestor_index = AncestorIndex(redis_client)
+    _, count = round_trips(create, 0, None, redis_client, ancestor_index)
+    assert count == 1
+    _, count = round_trips(create, 1, 0, redis_client, ancestor_index)
+    assert count == 1
+
+
+def test_batch_reads_pending_values(redis_client):
+    node = Node.create(0, redis_client=redis_client, cached_graph=None)
+    with node.batch():
+        node.parent_id = None
+        node.tracepoints = [1]
+        assert node.tracepoints == [1]
+        assert redis_client.hget("node:0", "tracepoints") is None
+    assert redis_client.hget("node:0", "tracepoints") == b"[1]"
+
+
+def test_create_skips_reads(redis_client, round_trips):
+    node, count = round_trips(Node.create, 0, cached_graph=None)
+    assert count == 0
+    _, count = round_trips(lambda: (node.parent_id, node.segments))
+    assert count == 0
+
+
+def test_load_many_is_one_round_trip(redis_client, round_trips):
+    ancestor_index = AncestorIndex(redis_client)
+    for node_id in range(8):
+        create(node_id, node_id - 1 if node_id else None, redis_client, ancestor_index)
+
+    nodes, count = round_trips(
+        Node.load_many, list(range(8)), redis_client=redis_client, cached_graph=None
+    )
+    assert count == 1
+    _, count = round_trips(lambda: [(node.parent_id, node.maps) for node in nodes])
+    assert count == 0
+    assert [node.parent_id for node in nodes] == [None, 0, 1, 2, 3, 4, 5, 6]
+
+    nodes, count = round_trips(
+        Node.load_many, [3, 9], ["parent_id"], redis_client=redis_client
+    )
+    assert count == 1
+    assert [node.parent_id for node in nodes] == [2, None]
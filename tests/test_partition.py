@@ -0,0 +1,325 @@
+import json
+import random
+
+import redis
+import fakeredis
+
+from cartprograph import context, Node, blocks, events, segments
+from cartprograph.blocks import BasicBlocks
+from cartprograph.index import AncestorIndex
+from cartprograph.prefixes import PrefixCache
+from cartprograph.scheduler import Scheduler
+
+MAPS = [
+    {
+        "start_address": 0x400000,
+        "end_address": 0x500000,
+        "pathname": "/challenge",
+        "offset": 0,
+        "permissions": "r-xp",
+    }
+]
+# The target echoes every line back and exits after this many reads
+READS = 3
+
+
+def echo_trace(inputs):
+    basic_blocks, syscalls, interactions = [], [], []
+
+    def call(name, direction, data, num_blocks):
+        trace_index = len(basic_blocks) + num_blocks - 1
+        basic_blocks.extend(0x400000 + trace_index * 4 for _ in range(num_blocks))
+        syscalls.append({"name": name, "trace_index": trace_index})
+        interactions.append(
+            {
+                "channel": "stdio",
+                "direction": direction,
+                "data": data,
+                "trace_index": trace_index,
+            }
+        )
+
+    call("write", "output", "hello\n", 5)
+    for data in inputs[:READS]:
+        call("read", "input", data, 3)
+        call("write", "output", f"echo:{data}", 5)
+    blocked = len(inputs) < READS
+    if blocked:
+        call("read", "input", None, 3)
+    return basic_blocks, syscalls, interactions, blocked
+
+
+def trace_chunks(job, cuts=None):
+    # The whole trace is computed from the inputs and cut after the traced
+    # node's prefix, then sent in a few chunks that may arrive out of order
+    prefix = {
+        name: segments.load(context["redis_client"], name, refs)
+        for name, refs in job["segments"].items()
+    }
+    inputs = [
+        interaction["data"]
+        for interaction in prefix["interactions"] + job["interactions"]
+        if interaction["direction"] == "input" and interaction["data"] is not None
+    ]
+    basic_blocks, syscalls, interactions, blocked = echo_trace(inputs)
+    start = len(prefix["basic_blocks"])
+    items = {
+        "syscalls": syscalls[len(prefix["syscalls"]) :],
+        "interactions": interactions[len(prefix["interactions"]) :],
+    }
+
+    rng = random.Random("".join(inputs))
+    if cuts is None:
+        cuts = sorted(
+            {
+                rng.randrange(start + 1, len(basic_blocks))
+                for _ in range(rng.randrange(4))
+            }
+        )
+    chunks = []
+    for seq, (chunk_start, chunk_stop) in enumerate(zip([start, *cuts], [*cuts, None])):
+        chunk = {
+            "node_id": job["node_id"],
+            "job": job["job"]["id"],
+            "seq": seq,
+            "trace_index": chunk_start,
+            "basic_blocks": blocks.dumps(
+                BasicBlocks(basic_blocks[chunk_start:chunk_stop])
+            ),
+            "datapoints": [],
+            "maps": MAPS,
+        }
+        for name, values in items.items():
+            chunk[name] = [
+                value
+                for value in values
+                if (seq == 0 or value["trace_index"] >= chunk_start)
+                and (chunk_stop is None or value["trace_index"] < chunk_stop)
+            ]
+        if chunk_stop is not None:
+            stream = "event.trace.progress"
+        elif blocked:
+            stream = "event.trace.blocked"
+        else:
+            stream = "event.trace.finished"
+        chunks.append((stream, chunk))
+    if rng.random() < 0.5:
+        chunks.reverse()
+    return chunks
+
+
+class Cluster:
+    def __init__(self, num_workers, monkeypatch, load_worker):
+        monkeypatch.setattr(events, "NUM_GRAPH_WORKERS", num_workers)
+        self.redis_client = redis.Redis(
+            connection_pool=redis.ConnectionPool(
+                connection_class=fakeredis.FakeRedisConnection,
+                server=fakeredis.FakeServer(),
+            )
+        )
+        monkeypatch.setitem(context, "redis_client", self.redis_client)
+        monkeypatch.setitem(context, "cached_graph", None)
+        monkeypatch.setitem(context, "ancestor_index", None)
+
+        self.workers = []
+        self.consumers = []
+        self.handled = 0
+        for partition in range(num_workers):
+            monkeypatch.setenv("GRAPH_WORKER_PARTITION", str(partition))
+            worker = load_worker(
+                "graph_worker", self.redis_client, f"graph_worker_{partition}"
+            )
+            worker.prefix_cache = PrefixCache(self.redis_client)
+            # Each worker process has its own ancestor index
+            worker.ancestor_index = AncestorIndex(self.redis_client)
+            self.workers.append(worker)
+            consumer = events.EventConsumer(
+                self.redis_client,
+                "graph_worker",
+                worker.NAME,
+                {
+                    f"{stream}.{partition}": self.handler(
+                        worker, getattr(worker, handler)
+                    )
+                    for stream, handler in [
+                        ("event.input", "handle_input_event"),
+                        ("event.trace.progress", "handle_trace_event"),
+                        ("event.trace.blocked", "handle_trace_event"),
+                        ("event.trace.finished", "handle_trace_event"),
+                    ]
+                },
+            )
+            consumer.create_groups()
+            self.consumers.append(consumer)
+        self.scheduler = Scheduler(self.redis_client, "test")
+
+    def handler(self, worker, handle):
+        def wrapped(event):
+            context["ancestor_index"] = worker.ancestor_index
+            handle(event)
+            self.handled += 1
+
+        return wrapped
+
+    def run(self, worker, f, *args):
+        context["ancestor_index"] = worker.ancestor_index
+        f(*args)
+
+    def settle(self):
+        while True:
+            handled = self.handled
+            while any(
+                self.redis_client.llen(queue) for queue in self.scheduler.available()
+            ):
+                job = self.scheduler.next_job(timeout=1)
+                if job is None:
+                    continue
+                for stream, chunk in trace_chunks(job):
+                    events.publish(
+                        self.redis_client,
+                        events.partitioned(stream, job["node_id"]),
+                        json.dumps(chunk),
+                    )
+                self.scheduler.done(job)
+                handled = None
+            for consumer in self.consumers:
+                consumer.read({stream: ">" for stream in consumer.handlers})
+            if handled == self.handled:
+                return
+
+    def blocked_leaves(self):
+        edges = Node.edges()
+        parents = set(edges.values())
+        leaves = [node_id for node_id in edges if node_id not in parents]
+        return sorted(
+            node.id
+            for node in Node.load_many(leaves, ["segments"])
+            if node.interactions[-1]["direction"] == "input"
+            and node.interactions[-1]["data"] is None
+        )
+
+    def explore(self, rounds):
+        self.run(self.workers[0], self.workers[0].initialize_graph)
+        self.settle()
+        answered = set()
+        for _ in range(rounds):
+            for node_id in self.blocked_leaves():
+                if node_id in answered:
+                    continue
+                answered.add(node_id)
+                # The repeated input is a duplicate promoted to interactive
+                for data, priority in [
+                    ("a\n", "background"),
+                    ("b\n", "background"),
+                    ("a\n", "interactive"),
+                ]:
+                    events.publish(
+                        self.redis_client,
+                        events.partitioned("event.input", node_id),
+                        json.dumps({"id": node_id, "data": data, "priority": priority}),
+                    )
+            self.settle()
+
+    def tree(self):
+        # Nodes keyed by the interactions on their path from the root, since
+        # ids depend on the order the workers ran in
+        ancestor_index = AncestorIndex(self.redis_client)
+        edges = Node.edges()
+        nodes = {
+            node.id: node
+            for node in Node.load_many(
+                list(edges), redis_client=self.redis_client, cached_graph=None
+            )
+        }
+        contents = {
+            node_id: (
+                tuple(interaction["data"] or "_" for interaction in node.interactions),
+                len(node.basic_blocks),
+                len(node.syscalls),
+            )
+            for node_id, node in nodes.items()
+        }
+        tree = {}
+        for node_id in edges:
+            path = tuple(
+                contents[ancestor_id]
+                for ancestor_id in ancestor_index.ancestors(node_id)
+            )
+            tree[path] = ancestor_index.offsets(node_id)
+        assert len(tree) == len(edges)
+        return tree
+
+
+def build(num_workers, monkeypatch, load_worker, rounds=READS):
+    cluster = Cluster(num_workers, monkeypatch, load_worker)
+    cluster.explore(rounds)
+    assert cluster.redis_client.hlen("tracing") == 0
+    assert not cluster.redis_client.keys("tracing.chunks.*")
+    return cluster.tree()
+
+
+def test_offsets_follow_ancestors(monkeypatch, load_worker):
+    tree = build(3, monkeypatch, load_worker, rounds=2)
+    for path, offsets in tree.items():
+        assert offsets == {
+            "basic_blocks": sum(length for _, length, _ in path[:-1]),
+            "syscalls": sum(length for _, _, length in path[:-1]),
+            "interactions": sum(len(data) for data, _, _ in path[:-1]),
+            "datapoints": 0,
+        }
+
+
+def test_partitions_build_the_same_tree(monkeypatch, load_worker):
+    tree = build(1, monkeypatch, load_worker)
+    assert len(tree) > 30
+    for num_workers in [2, 3]:
+        assert build(num_workers, monkeypatch, load_worker) == tree
+
+
+def test_chunks_apply_in_order(monkeypatch, load_worker):
+    trees = []
+    for reverse in [False, True]:
+        with monkeypatch.context() as m:
+            cluster = Cluster(1, m, load_worker)
+            cluster.run(cluster.workers[0], cluster.workers[0].initialize_graph)
+            job = cluster.scheduler.next_job(timeout=1)
+            # Reversed, every chunk arrives before the ones it follows
+            chunks = sorted(
+                trace_chunks(job, cuts=[2, 4, 6]),
+                key=lambda item: item[1]["seq"],
+                reverse=reverse,
+            )
+            for stream, chunk in chunks:
+                events.publish(
+                    cluster.redis_client,
+                    events.partitioned(stream, 0),
+                    json.dumps(chunk),
+                )
+            cluster.scheduler.done(job)
+            cluster.settle()
+            assert cluster.redis_client.hlen("tracing") == 0
+            assert not cluster.redis_client.keys("tracing.chunks.*")
+            trees.append(cluster.tree())
+    assert len(trees[0]) > 1
+    assert trees[0] == trees[1]
+
+
+def test_aborted_trace_is_cleaned_up(monkeypatch, load_worker):
+    cluster = Cluster(2, monkeypatch, load_worker)
+    cluster.run(cluster.workers[0], cluster.workers[0].initialize_graph)
+    job = cluster.scheduler.next_job(timeout=1)
+    chunk = min(trace_chunks(job, cuts=[2]), key=lambda item: item[1]["seq"])[1]
+    # The abort arrives first and waits for the progress chunk before it
+    aborted = {"node_id": 0, "job": chunk["job"], "seq": 1, "aborted": True}
+    for stream, trace in [
+        ("event.trace.finished", aborted),
+        ("event.trace.progress", chunk),
+    ]:
+        events.publish(
+            cluster.redis_client, events.partitioned(stream, 0), json.dumps(trace)
+        )
+    cluster.scheduler.done(job)
+    cluster.settle()
+    assert cluster.redis_client.hlen("tracing") == 0
+    assert not cluster.redis_client.keys("tracing.chunks.*")
+    assert len(Node(0).basic_blocks) == 2
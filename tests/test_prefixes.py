@@ -0,0 +1,60 @@
+from cartprograph import context, Node, prefixes, segments
+from cartprograph.blocks import BasicBlocks
+from cartprograph.index import AncestorIndex
+
+
+def test_invalidate_leaves_lru(redis_client, round_trips):
+    cache = prefixes.PrefixCache(redis_client, size=2)
+    for node_id in [1, 2]:
+        cache.put(node_id, {"basic_blocks": []}, 0)
+    _, count = round_trips(prefixes.invalidate, redis_client, 1)
+    assert count == 1
+    assert cache.get(1) is None
+    assert redis_client.zrange("prefix.lru", 0, -1) == [b"2"]
+
+    # A stale member would otherwise be evicted in place of a live entry
+    cache.put(3, {"basic_blocks": []}, 0)
+    assert cache.get(2) is not None
+    assert cache.get(3) is not None
+
+
+def set_trace(node, syscalls):
+    with node.batch():
+        node.basic_blocks = BasicBlocks()
+        node.syscalls = syscalls
+        node.interactions = []
+        node.datapoints = []
+
+
+def test_parent_segments_invalidate_children(
+    redis_client, load_worker, monkeypatch, round_trips
+):
+    graph_worker = load_worker("graph_worker", redis_client)
+    graph_worker.prefix_cache = prefixes.PrefixCache(redis_client)
+    monkeypatch.setitem(context, "ancestor_index", AncestorIndex(redis_client))
+    for node_id, parent_id in [(0, None), (1, 0), (2, 1)]:
+        node = Node.create(node_id)
+        node.parent_id = parent_id
+        set_trace(node, [{"trace_index": node_id}])
+
+    def syscalls(node_id):
+        prefix, _, hit = graph_worker.merged_prefix(node_id)
+        return segments.load(redis_client, "syscalls", prefix["syscalls"]), hit
+
+    assert syscalls(2) == ([{"trace_index": i} for i in range(3)], False)
+    assert syscalls(2)[1]
+    # Setting the segments of a node without children stays one round trip
+    node = Node(2)
+    node.segments
+    _, count = round_trips(set_trace, node, [{"trace_index": 2, "nr": 1}])
+    assert count == 1
+    assert syscalls(2) == (
+        [{"trace_index": i} for i in range(2)] + [{"trace_index": 2, "nr": 1}],
+        False,
+    )
+
+    set_trace(Node(1), [{"trace_index": 1, "nr": 0}])
+    assert syscalls(2) == (
+        [{"trace_index": 0}, {"trace_index": 1, "nr": 0}, {"trace_index": 2, "nr": 1}],
+        False,
+    )
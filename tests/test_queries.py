@@ -0,0 +1,52 @@
+from werkzeug.datastructures import MultiDict
+
+from cartprograph import Node, events, queries, tree
+
+
+def window(**args):
+    return queries.window_args(MultiDict(args))
+
+
+def test_window_args():
+    assert window(offset="2", limit="x", name="read,write") == {
+        "offset": 2,
+        "limit": None,
+        "start": None,
+        "end": None,
+        "names": {"read", "write"},
+    }
+    assert window(limit="-1") is None
+    assert not queries.windowed(window())
+    assert queries.windowed(window(end="0"))
+
+
+def test_block_range():
+    assert queries.block_range(window()) == (0, None)
+    assert queries.block_range(window(offset="5", limit="10")) == (5, 15)
+    # Positions are relative to the first trace index of the node
+    assert queries.block_range(window(start="110", end="150"), 100) == (10, 50)
+    assert queries.block_range(window(start="50", end="120", limit="5"), 100) == (
+        0,
+        5,
+    )
+    assert queries.block_range(window(start="200", end="150"), 100) == (100, 100)
+
+
+def test_missed_updates(redis_client):
+    for node_id, parent_id in [(0, None), (1, 0), (2, 0)]:
+        node = Node.create(node_id, cached_graph=None)
+        node.parent_id = parent_id
+    first_id = events.publish(redis_client, "event.node", 0).decode()
+    snapshot = tree.snapshot(redis_client)
+    assert snapshot == {"seq": first_id, "nodes": [[0, None], [1, 0], [2, 0]]}
+
+    for node_id in [2, 1, 2]:
+        last_id = events.publish(redis_client, "event.node", node_id).decode()
+    assert tree.missed_updates(redis_client, first_id) == {
+        "seq": last_id,
+        "updates": [{"src_id": 0, "dst_id": 2}, {"src_id": 0, "dst_id": 1}],
+    }
+    assert tree.missed_updates(redis_client, last_id)["updates"] == []
+    # Entries before the oldest one may have been trimmed
+    assert tree.missed_updates(redis_client, "0-1") is None
+    assert tree.missed_updates(redis_client, "bad") is None
@@ -0,0 +1,76 @@
+from cartprograph import scheduler
+from cartprograph.scheduler import Scheduler
+
+
+def depths(redis_client):
+    return {
+        priority: work["depth"]
+        for priority, work in scheduler.queue_info(redis_client).items()
+    }
+
+
+def test_promote_replaces_queued_job(redis_client):
+    background_id = scheduler.submit(redis_client, {"node_id": 1}, "background")
+    assert not scheduler.submit(
+        redis_client, {"node_id": 1}, "background", promote=True
+    )
+    assert depths(redis_client) == {"interactive": 0, "background": 1}
+
+    job_id = scheduler.submit(redis_client, {"node_id": 1}, "interactive", promote=True)
+    assert job_id != background_id
+    assert depths(redis_client) == {"interactive": 1, "background": 0}
+    assert scheduler.pending(redis_client, 1)["priority"] == "interactive"
+
+    worker = Scheduler(redis_client, "test")
+    job = worker.next_job(timeout=1)
+    assert job["job"]["id"] == job_id
+    worker.done(job)
+    assert scheduler.pending(redis_client, 1) is None
+    assert not redis_client.keys("work.trace.*")
+
+
+def test_superseded_entries_are_dropped(redis_client, monkeypatch):
+    worker = Scheduler(redis_client, "test")
+    claimed = []
+    claim = worker.claim
+    monkeypatch.setattr(
+        worker, "claim", lambda job: claimed.append(job["job"]["id"]) or claim(job)
+    )
+
+    # Submitting again leaves the first entry queued, but it is no longer the
+    # node's job
+    scheduler.submit(redis_client, {"node_id": 1})
+    job_id = scheduler.submit(redis_client, {"node_id": 1})
+    assert depths(redis_client)["interactive"] == 2
+    assert worker.next_job(timeout=1) is None
+    job = worker.next_job(timeout=1)
+    assert job["job"]["id"] == job_id
+    assert claimed == [job_id]
+
+    # A job cancelled before it runs is taken off its queue
+    scheduler.submit(redis_client, {"node_id": 2}, "background")
+    scheduler.cancel(redis_client, 2)
+    assert depths(redis_client) == {"interactive": 0, "background": 0}
+    assert scheduler.pending(redis_client, 2) is None
+
+
+def test_checkpointed_jobs_prefer_their_worker(redis_client):
+    first = Scheduler(redis_client, "first")
+    second = Scheduler(redis_client, "second")
+
+    job_id = scheduler.submit(redis_client, {"node_id": 1}, worker="first")
+    assert not scheduler.promotable(redis_client, 1, "interactive")
+    job = first.next_job(timeout=1)
+    assert job["job"]["id"] == job_id
+    # Its other entry is gone, so no other worker takes it too
+    assert depths(redis_client)["interactive"] == 0
+    assert second.next_job(timeout=1) is None
+    first.done(job)
+
+    # A worker that is busy or gone does not keep the job from running
+    job_id = scheduler.submit(redis_client, {"node_id": 2}, worker="first")
+    job = second.next_job(timeout=1)
+    assert job["job"]["id"] == job_id
+    assert not redis_client.llen("work.trace.first")
+    second.done(job)
+    assert not redis_client.keys("work.trace.*")
@@ -0,0 +1,42 @@
+from cartprograph import Node, segments
+from cartprograph.blocks import BasicBlocks
+
+
+def sweep(redis_client, grace=0):
+    return segments.sweep(redis_client, Node.segment_ids(redis_client), grace)
+
+
+def segment_ids(redis_client):
+    return {key.decode() for key in redis_client.keys(segments.segment_key("*"))}
+
+
+def test_sweep_deletes_unreferenced_segments(redis_client):
+    node = Node.create(0, cached_graph=None)
+    node.parent_id = None
+    node.basic_blocks = BasicBlocks([1, 2, 3])
+    node.syscalls = [{"trace_index": 0}]
+    [[orphaned, _]] = node.segments["basic_blocks"]
+    # Restarting the trace replaces the node's segments
+    node.basic_blocks = BasicBlocks([1, 2, 4])
+    live = Node.segment_ids(redis_client)
+    assert segment_ids(redis_client) == {
+        segments.segment_key(segment_id) for segment_id in [*live, orphaned]
+    }
+
+    # The first sweep only marks what nothing refers to
+    assert sweep(redis_client) == 0
+    assert sweep(redis_client, grace=60) == 0
+    assert sweep(redis_client) == 1
+    assert segment_ids(redis_client) == {
+        segments.segment_key(segment_id) for segment_id in live
+    }
+    assert not redis_client.exists("segments.unreferenced")
+
+
+def test_stored_segments_are_kept(redis_client):
+    refs = segments.store(redis_client, "syscalls", [{"trace_index": 0}])
+    assert sweep(redis_client) == 0
+    # Stored again for a node about to refer to it
+    assert segments.store(redis_client, "syscalls", [{"trace_index": 0}]) == refs
+    assert sweep(redis_client) == 0
+    assert sweep(redis_client) == 1
@@ -0,0 +1,91 @@
+import sys
+import types
+import importlib.util
+
+import pytest
+
+SYSCALLS = ["read", "write", "open", "close", "accept", "exit"]
+
+
+class TraceMachine:
+    def __init__(self, argv):
+        self.argv = argv
+        self.acks = 0
+
+    def ack(self):
+        self.acks += 1
+
+
+def stub_breakpoint(address):
+    def decorate(callback):
+        callback.address = address
+        return callback
+
+    return decorate
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    # qtrace runs the target under QEMU, the tracer only needs its syscall
+    # table, its base class and its breakpoint decorator
+    qtrace = types.ModuleType("qtrace")
+    qtrace.syscalls = {
+        "x86_64": [(nr, f"sys_{name}") for nr, name in enumerate(SYSCALLS)]
+    }
+    qtrace.TraceMachine = TraceMachine
+    qtrace.breakpoint = stub_breakpoint
+    monkeypatch.setitem(sys.modules, "qtrace", qtrace)
+    spec = importlib.util.find_spec("cartprograph.tracer")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def machine(tracer_class):
+    target = types.SimpleNamespace(target_args=["/challenge"])
+    return tracer_class(target, [], [], [], [])
+
+
+def test_syscalls_reach_their_handlers(tracer):
+    class RecordingTracer(tracer.CartprographTracer):
+        def handle_read(self, *args):
+            self.handled.append(("read", args))
+
+        def handle_write(self, *args):
+            self.handled.append(("write", args))
+
+        def handle_accept(self, *args):
+            self.handled.append(("accept", args))
+
+        def handle_accept_end(self, ret):
+            self.handled.append(("accept_end", ret))
+
+    assert tracer.SYSCALL_NAMES == SYSCALLS
+    traced = machine(RecordingTracer)
+    traced.handled = []
+    for nr, name in enumerate(SYSCALLS):
+        traced.on_syscall_start(nr, nr, 0, 1)
+        traced.on_syscall_end(nr, nr)
+    assert traced.handled == [
+        ("read", (0, 0, 1)),
+        ("write", (1, 0, 1)),
+        ("accept", (4, 0, 1)),
+        ("accept_end", 4),
+    ]
+    # Syscalls without a handler are still acked and recorded
+    assert traced.acks == 2 * len(SYSCALLS)
+    assert [syscall["name"] for syscall in traced.syscalls] == SYSCALLS
+    assert [syscall["ret"] for syscall in traced.syscalls] == list(range(len(SYSCALLS)))
+
+
+def test_tracepoint_classes_are_cached(tracer):
+    first = tracer.tracer_class([{"address": 0x1000, "datapoints": ["rax"]}])
+    second = tracer.tracer_class([{"address": 0x2000, "datapoints": ["rdi"]}])
+    assert tracer.tracer_class([{"address": 0x1000, "datapoints": ["rax"]}]) is first
+    assert second is not first
+    assert first.breakpoint_0x1000.address == 0x1000
+    assert not hasattr(first, "breakpoint_0x2000")
+    assert second.breakpoint_0x2000.address == 0x2000
+    assert not hasattr(second, "breakpoint_0x1000")
+    assert first.dispatch_table() == second.dispatch_table()
+    assert first.dispatch_table() is not second.dispatch_table()
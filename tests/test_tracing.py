@@ -0,0 +1,80 @@
+import pytest
+
+from cartprograph import segments
+from cartprograph.blocks import BasicBlocks
+from cartprograph.tracing import VERIFY_MODES, Desync, TracingBlocks, TracingList
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(segments, "SEGMENT_SIZE", 16)
+
+
+def reader(redis_client, name, values):
+    refs = segments.store(redis_client, name, values)
+    return segments.SegmentReader(redis_client, name, refs)
+
+
+def replay(traced, addresses, batch_size=7):
+    for start in range(0, len(addresses), batch_size):
+        traced.extend(addresses[start : start + batch_size])
+        traced.checkpoint()
+
+
+@pytest.mark.parametrize("verify", VERIFY_MODES)
+def test_blocks_replay_prefix(redis_client, small_segments, verify):
+    recorded = BasicBlocks(range(0x1000, 0x1000 + 100))
+    prefix = reader(redis_client, "basic_blocks", recorded[:90])
+    traced = TracingBlocks(recorded[90:], prefix=prefix, verify=verify)
+    assert traced.tracing
+    replay(traced, BasicBlocks([*recorded, 1, 2, 3]))
+    assert not traced.tracing
+    # Only the job's own blocks and the new ones are kept
+    assert list(traced) == [*recorded[90:], 1, 2, 3]
+    assert traced.discarded == 90
+    assert len(prefix.loaded) <= 2
+
+
+@pytest.mark.parametrize("verify", ["full", "hash"])
+def test_blocks_desync_in_prefix(redis_client, small_segments, verify):
+    recorded = BasicBlocks(range(0x1000, 0x1000 + 100))
+    prefix = reader(redis_client, "basic_blocks", recorded[:90])
+    traced = TracingBlocks(recorded[90:], prefix=prefix, verify=verify)
+    replayed = BasicBlocks(recorded)
+    replayed[89] = 0
+    with pytest.raises(Desync):
+        replay(traced, replayed)
+
+
+def test_list_replays_prefix(redis_client, small_segments):
+    recorded = [{"nr": i, "trace_index": i} for i in range(50)]
+    prefix = reader(redis_client, "syscalls", recorded[:40])
+    traced = TracingList(recorded[40:], prefix=prefix)
+    for element in recorded:
+        assert traced.current == element
+        traced.append(dict(element))
+        assert traced.previous == element
+    assert not traced.tracing
+    traced.append({"nr": 50, "trace_index": 50})
+    assert traced == [*recorded[40:], {"nr": 50, "trace_index": 50}]
+    assert len(prefix.loaded) <= 2
+
+    traced = TracingList(recorded[40:], prefix=prefix)
+    with pytest.raises(Desync):
+        traced.append({"nr": 1, "trace_index": 0})
+
+
+def test_reader_loads_segments_on_demand(redis_client, small_segments, round_trips):
+    values = [{"trace_index": i} for i in range(64)]
+    prefix, count = round_trips(reader, redis_client, "syscalls", values)
+    assert count == 1
+    assert len(prefix) == 64
+    _, count = round_trips(prefix.__getitem__, 40)
+    assert count == 1
+    _, count = round_trips(prefix.__getitem__, 47)
+    assert count == 0
+    assert [value for chunk in prefix.chunks(10, 40) for value in chunk] == values[
+        10:40
+    ]
+    with pytest.raises(IndexError):
+        prefix[64]
@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+
+import os
+import json
+import zlib
+
+import redis
+import redis.asyncio
+import socketio
+import uvicorn
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+from cartprograph import context, Node, blocks, events, metrics, scheduler, coverage
+from cartprograph import queries, segments, timing, tree, summaries
+from cartprograph.blocks import BasicBlocks
+from cartprograph.index import AncestorIndex
+
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/")
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", 64))
+# Trace segments fetched per MGET while streaming a response
+STREAM_SEGMENTS = int(os.getenv("STREAM_SEGMENTS", 16))
+
+async_redis = redis.asyncio.Redis(
+    connection_pool=redis.asyncio.BlockingConnectionPool.from_url(
+        REDIS_URL, max_connections=REDIS_POOL_SIZE
+    )
+)
+# The less frequent routes reuse the synchronous helpers from worker threads
+redis_client = redis.Redis(
+    connection_pool=redis.BlockingConnectionPool.from_url(
+        REDIS_URL, max_connections=REDIS_POOL_SIZE
+    )
+)
+context["redis_client"] = redis_client
+ancestor_index = AncestorIndex(redis_client)
+
+sio = socketio.AsyncServer(
+    async_mode="asgi",
+    client_manager=socketio.AsyncRedisManager(REDIS_URL, channel="flask-socketio"),
+)
+
+
+def json_response(data, status_code=200):
+    return JSONResponse(data, status_code=status_code)
+
+
+async def index_route(request):
+    return json_response(dict(status="alive"))
+
+
+async def initialize(request):
+    tracepoints = (await request.json())["tracepoints"]
+    initialize = {
+        "tracepoints": tracepoints,
+    }
+    await events.publish(async_redis, "event.initialize", json.dumps(initialize))
+    return json_response(dict(success=True))
+
+
+async def nodes(request):
+    node_ids = await async_redis.zrange("nodes", 0, -1)
+    return json_response(dict(nodes=[int(node_id) for node_id in node_ids]))
+
+
+async def tracing(request):
+    states = await async_redis.hgetall("tracing")
+    return json_response(
+        {
+            node_id.decode(): json.loads(state)["current"]
+            for node_id, state in states.items()
+        }
+    )
+
+
+async def queues(request):
+    return json_response(await run_in_threadpool(scheduler.queues, redis_client))
+
+
+async def explore_stats(request):
+    stats = await async_redis.hgetall("explore.stats")
+    return json_response({name.decode(): float(value) for name, value in stats.items()})
+
+
+def accept_mimetypes(request):
+    return parse_accept_header(request.headers.get("accept"), MIMEAccept)
+
+
+async def metrics_route(request):
+    mimetype = accept_mimetypes(request).best_match(metrics.MIMETYPES)
+    if metrics.wants_prometheus(mimetype, request.query_params.get("format")):
+        data = await run_in_threadpool(
+            lambda: metrics.prometheus(
+                redis_client, scheduler.queue_gauges(redis_client)
+            )
+        )
+        response = Response(data, media_type=metrics.PROMETHEUS_MIMETYPE)
+    else:
+        summaries = await run_in_threadpool(metrics.summaries, redis_client)
+        response = json_response(summaries)
+    response.headers["Vary"] = "Accept"
+    return response
+
+
+async def timings(request):
+    count = queries.int_arg(request.query_params, "count", 100)
+    return json_response(await run_in_threadpool(timing.recent, redis_client, count))
+
+
+async def node_segments(node_id):
+    data = await async_redis.hget(f"node:{node_id}", "segments")
+    return json.loads(data) if data is not None else None
+
+
+async def trace_plan(node_id, name, refs, args):
+    # The segments to stream, how many of their values to skip and take, and
+    # which values are kept at all
+    offset = args["offset"] or 0
+    limit = args["limit"]
+    start, end = args["start"], args["end"]
+
+    names = args["names"] if name == "syscalls" else None
+    if name != "basic_blocks" and (start is not None or end is not None or names):
+
+        def keep(value):
+            trace_index = value["trace_index"]
+            return (
+                (start is None or trace_index >= start)
+                and (end is None or trace_index < end)
+                and (not names or value["name"] in names)
+            )
+
+        return refs, offset, limit, keep
+
+    node_start = None
+    if name == "basic_blocks" and queries.ranged(args):
+        node_start = await run_in_threadpool(ancestor_index.trace_index, int(node_id))
+    lo, hi = queries.block_range(args, node_start)
+    selected, first = segments.window(refs, lo, hi)
+    return selected, lo - first, max(hi - lo, 0) if hi is not None else None, None
+
+
+async def fetch_segments(refs):
+    for batch_start in range(0, len(refs), STREAM_SEGMENTS):
+        batch = refs[batch_start : batch_start + STREAM_SEGMENTS]
+        keys = [segments.segment_key(segment_id) for segment_id, _ in batch]
+        for (segment_id, _), data in zip(batch, await async_redis.mget(keys)):
+            if data is None:
+                raise KeyError(f"Missing trace segment: {segment_id}")
+            yield data
+
+
+def segment_json(name, data, skip, take, keep):
+    # The values of one segment as the inside of a JSON array, and how many
+    # were skipped and taken
+    if not skip and take is None and keep is None and name != "basic_blocks":
+        # Already stored as a JSON array
+        return data[1:-1], 0, 0
+    values = segments.decode(name, data)
+    if keep is not None:
+        values = [value for value in values if keep(value)]
+    skipped = min(skip, len(values))
+    values = values[skipped : skipped + take if take is not None else None]
+    if name == "basic_blocks":
+        values = values.tolist()
+    return json.dumps(values)[1:-1].encode(), skipped, len(values)
+
+
+async def stream_values(name, plan):
+    refs, skip, take, keep = plan
+    yield b"["
+    separator = b""
+    async for data in fetch_segments(refs):
+        if take == 0:
+            break
+        # Decoding and encoding a segment can take a while, so it happens off
+        # the event loop
+        chunk, skipped, taken = await run_in_threadpool(
+            segment_json, name, data, skip, take, keep
+        )
+        skip -= skipped
+        if take is not None:
+            take -= taken
+        if chunk:
+            yield separator + chunk
+            separator = b", "
+    yield b"]"
+
+
+def not_modified(etag):
+    return Response(status_code=304, headers={"ETag": f'"{etag}"'})
+
+
+def conditional(response, etag):
+    response.headers["ETag"] = f'"{etag}"'
+    # Nodes grow while their trace streams in, so always revalidate
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def if_none_match(request):
+    return parse_etags(request.headers.get("if-none-match"))
+
+
+async def trace_attribute(request, node_id, name):
+    args = queries.window_args(request.query_params)
+    if args is None:
+        return Response(status_code=400)
+    trace_segments = await node_segments(node_id)
+    if trace_segments is None:
+        return json_response(None)
+    etag = segments.etag(trace_segments, [name])
+    if etag in if_none_match(request):
+        return not_modified(etag)
+    refs = trace_segments.get(name, [])
+    plan = await trace_plan(node_id, name, refs, args)
+    response = StreamingResponse(
+        stream_values(name, plan), media_type="application/json"
+    )
+    response.headers["X-Total-Count"] = str(segments.length(refs))
+    return conditional(response, etag)
+
+
+async def trace(request):
+    node_id = request.path_params["node_id"]
+    attrs = request.query_params.get("attrs")
+    attrs = attrs.split(",") if attrs else Node.trace_attributes
+    if any(attr not in Node.trace_attributes for attr in attrs):
+        return Response(status_code=400)
+    args = queries.window_args(request.query_params)
+    if args is None:
+        return Response(status_code=400)
+    trace_segments = await node_segments(node_id)
+    if trace_segments is None:
+        return json_response(None)
+    etag = segments.etag(trace_segments, attrs)
+    if etag in if_none_match(request):
+        return not_modified(etag)
+    plans = {
+        attr: await trace_plan(node_id, attr, trace_segments.get(attr, []), args)
+        for attr in attrs
+    }
+
+    async def stream():
+        separator = b"{"
+        for attr, plan in plans.items():
+            yield separator + json.dumps(attr).encode() + b": "
+            async for chunk in stream_values(attr, plan):
+                yield chunk
+            separator = b", "
+        yield b"}"
+
+    return conditional(StreamingResponse(stream(), media_type="application/json"), etag)
+
+
+async def trace_basic_block(request):
+    node_id = request.path_params["node_id"]
+    mimetype = accept_mimetypes(request).best_match(
+        ["application/json", blocks.MIMETYPE, "application/octet-stream"]
+    )
+    if mimetype == "application/json":
+        response = await trace_attribute(request, node_id, "basic_blocks")
+        response.headers["Vary"] = "Accept"
+        return response
+
+    args = queries.window_args(request.query_params)
+    if args is None:
+        return Response(status_code=400)
+    trace_segments = await node_segments(node_id)
+    if trace_segments is None:
+        return Response(status_code=404)
+    codec = request.query_params.get("codec")
+    etag = segments.etag(trace_segments, ["basic_blocks"], [mimetype, codec])
+    if etag in if_none_match(request):
+        return not_modified(etag)
+    refs = trace_segments.get("basic_blocks", [])
+    selected, skip, take, _ = await trace_plan(node_id, "basic_blocks", refs, args)
+    chunks = [data async for data in fetch_segments(selected)]
+
+    def encode():
+        windowed = skip or take is not None
+        if len(chunks) == 1 and not windowed:
+            data = chunks[0]
+            if codec and codec != blocks.codec_name(data):
+                data = blocks.encode(blocks.decode(data), codec)
+            return data
+        values = segments.empty("basic_blocks")
+        for data in chunks:
+            values.extend(blocks.decode(data))
+        values = values[skip : skip + take if take is not None else None]
+        return blocks.encode(values, codec)
+
+    data = (
+        await run_in_threadpool(encode)
+        if chunks
+        else blocks.encode(BasicBlocks(), codec)
+    )
+    response = Response(data, media_type=mimetype)
+    response.headers["X-Basic-Block-Codec"] = blocks.codec_name(data)
+    response.headers["X-Total-Count"] = str(segments.length(refs))
+    response.headers["Vary"] = "Accept"
+    return conditional(response, etag)
+
+
+async def trace_syscall(request):
+    return await trace_attribute(request, request.path_params["node_id"], "syscalls")
+
+
+async def trace_interactions(request):
+    node_id = request.path_params["node_id"]
+    return await trace_attribute(request, node_id, "interactions")
+
+
+async def trace_datapoints(request):
+    node_id = request.path_params["node_id"]
+    return await trace_attribute(request, node_id, "datapoints")
+
+
+async def trace_maps(request):
+    maps = await async_redis.hget("node:0", "maps")
+    return json_response(json.loads(maps) if maps is not None else None)
+
+
+async def subtree(request):
+    depth = queries.int_arg(request.query_params, "depth", 1)
+    limit = queries.int_arg(request.query_params, "limit", tree.SUBTREE_LIMIT)
+    if depth < 0 or limit < 1:
+        return Response(status_code=400)
+    result = await run_in_threadpool(
+        tree.subtree,
+        redis_client,
+        ancestor_index,
+        int(request.path_params["node_id"]),
+        depth,
+        min(limit, tree.SUBTREE_LIMIT),
+    )
+    if result is None:
+        return Response(status_code=404)
+    return json_response(result)
+
+
+async def summaries_route(request):
+    # Either the nodes in ?ids=, or a page of all nodes by ?offset= and ?limit=
+    ids = request.query_params.get("ids")
+    offset = queries.int_arg(request.query_params, "offset", 0)
+    limit = queries.int_arg(request.query_params, "limit", tree.SUBTREE_LIMIT)
+    if offset < 0 or limit < 1:
+        return Response(status_code=400)
+    if ids:
+        try:
+            node_ids = [int(node_id) for node_id in ids.split(",")]
+        except ValueError:
+            return Response(status_code=400)
+        result = await run_in_threadpool(
+            summaries.load, redis_client, node_ids[: tree.SUBTREE_LIMIT]
+        )
+    else:
+        result = await run_in_threadpool(
+            summaries.page, redis_client, offset, min(limit, tree.SUBTREE_LIMIT)
+        )
+    return json_response(dict(summaries=result))
+
+
+async def ancestors(request):
+    node_id = int(request.path_params["node_id"])
+    node_ids = await run_in_threadpool(tree.ancestors, ancestor_index, node_id)
+    if node_ids is None:
+        return Response(status_code=404)
+    return json_response(dict(node_id=node_id, ancestors=node_ids))
+
+
+async def transcript(request):
+    node_id = int(request.path_params["node_id"])
+    result = await run_in_threadpool(
+        tree.transcript, redis_client, ancestor_index, node_id
+    )
+    if result is None:
+        return Response(status_code=404)
+    return json_response(result)
+
+
+async def coverage_summary(request):
+    return json_response(await run_in_threadpool(coverage.summary, redis_client))
+
+
+async def coverage_address(request):
+    return json_response(
+        await run_in_threadpool(
+            coverage.address_hits,
+            redis_client,
+            int(request.path_params["address"], 0),
+            request.query_params.get("module"),
+        )
+    )
+
+
+async def coverage_timeline(request):
+    return json_response(
+        await run_in_threadpool(
+            coverage.timeline,
+            redis_client,
+            request.query_params.get("start", "-"),
+            request.query_params.get("end", "+"),
+            queries.int_arg(request.query_params, "count"),
+        )
+    )
+
+
+async def coverage_novelty(request):
+    node_id = int(request.path_params["node_id"])
+    novelty = await run_in_threadpool(coverage.novelty, redis_client, [node_id])
+    return json_response(novelty[node_id])
+
+
+async def new_input(request):
+    body = await request.json()
+    input_ = {
+        "id": int(request.path_params["id"]),
+        "data": body["input"],
+        "priority": body.get("priority", "interactive"),
+        "timing": timing.start("input"),
+    }
+    if input_["priority"] not in scheduler.PRIORITIES:
+        return json_response(dict(success=False), 400)
+    stream = events.partitioned("event.input", input_["id"])
+    await events.publish(async_redis, stream, json.dumps(input_))
+    return json_response(dict(success=True, trace=input_["timing"]["id"]))
+
+
+@sio.event
+async def connect(sid, environ, auth=None):
+    auth = auth or {}
+
+    seq = auth.get("seq")
+    if seq is not None:
+        updates = await run_in_threadpool(tree.missed_updates, redis_client, str(seq))
+        if updates is not None:
+            await sio.emit("updates", updates, to=sid)
+            return
+
+    data = await run_in_threadpool(tree.snapshot, redis_client)
+    if auth.get("compress"):
+        data = await run_in_threadpool(lambda: zlib.compress(json.dumps(data).encode()))
+    await sio.emit("snapshot", data, to=sid)
+
+
+routes = [
+    Route("/", index_route),
+    Route("/initialize", initialize, methods=["POST"]),
+    Route("/nodes", nodes),
+    Route("/tracing", tracing),
+    Route("/queues", queues),
+    Route("/explore", explore_stats),
+    Route("/metrics", metrics_route),
+    Route("/timings", timings),
+    Route("/trace/maps", trace_maps),
+    Route("/trace/basic_blocks/{node_id}", trace_basic_block),
+    Route("/trace/syscalls/{node_id}", trace_syscall),
+    Route("/trace/interactions/{node_id}", trace_interactions),
+    Route("/trace/datapoints/{node_id}", trace_datapoints),
+    Route("/trace/{node_id}", trace),
+    Route("/subtree/{node_id}", subtree),
+    Route("/summaries", summaries_route),
+    Route("/ancestors/{node_id}", ancestors),
+    Route("/transcript/{node_id}", transcript),
+    Route("/coverage", coverage_summary),
+    Route("/coverage/address/{address}", coverage_address),
+    Route("/coverage/timeline", coverage_timeline),
+    Route("/coverage/novelty/{node_id}", coverage_novelty),
+    Route("/input/{id}", new_input, methods=["POST"]),
+]
+
+app = socketio.ASGIApp(sio, other_asgi_app=Starlette(routes=routes))
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=4242)
@@ -5,15 +5,20 @@ import eventlet
 eventlet.monkey_patch()
 
 import json
+import zlib
+import bisect
 
 import redis
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
 from flask_socketio import SocketIO, emit, join_room
-from cartprograph import context, Node
+from cartprograph import context, Node, blocks, events, metrics, scheduler, coverage
+from cartprograph import queries, segments, timing, tree, summaries
+from cartprograph.index import AncestorIndex
 
 
 redis_client = redis.Redis(host="localhost", port=6379)
 context["redis_client"] = redis_client
+ancestor_index = AncestorIndex(redis_client)
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "SECRET"
@@ -21,14 +26,6 @@ app.config["JSON_SORT_KEYS"] = False
 socketio = SocketIO(app, message_queue="redis://localhost:6379/")
 
 
-def all_nodes():
-    node_ids = sorted(
-        set(int(n.decode().split(".")[1]) for n in redis_client.keys("node.*"))
-    )
-    for node_id in node_ids:
-        yield Node(node_id)
-
-
 @app.route("/")
 def index_route():
     return jsonify(dict(status="alive"))
@@ -40,33 +37,183 @@ def initialize():
     initialize = {
         "tracepoints": tracepoints,
     }
-    redis_client.publish("event.initialize", json.dumps(initialize))
+    events.publish(redis_client, "event.initialize", json.dumps(initialize))
     return jsonify(dict(success=True))
 
 
 @app.route("/nodes")
 def nodes():
-    return jsonify(dict(nodes=[node.id for node in all_nodes()]))
+    return jsonify(dict(nodes=Node.ids()))
+
+
+@app.route("/tracing")
+def tracing():
+    # Traces still streaming in, by traced node, with the node being appended to
+    states = redis_client.hgetall("tracing")
+    return jsonify(
+        {
+            node_id.decode(): json.loads(state)["current"]
+            for node_id, state in states.items()
+        }
+    )
+
+
+@app.route("/queues")
+def queues():
+    return jsonify(scheduler.queues(redis_client))
+
+
+@app.route("/explore")
+def explore_stats():
+    stats = redis_client.hgetall("explore.stats")
+    return jsonify({name.decode(): float(value) for name, value in stats.items()})
+
+
+@app.route("/metrics")
+def metrics_route():
+    mimetype = request.accept_mimetypes.best_match(metrics.MIMETYPES)
+    if metrics.wants_prometheus(mimetype, request.args.get("format")):
+        data = metrics.prometheus(redis_client, scheduler.queue_gauges(redis_client))
+        response = Response(data, mimetype=metrics.PROMETHEUS_MIMETYPE)
+    else:
+        response = jsonify(metrics.summaries(redis_client))
+    response.vary.add("Accept")
+    return response
+
+
+@app.route("/timings")
+def timings():
+    count = request.args.get("count", 100, type=int)
+    return jsonify(timing.recent(redis_client, count))
+
+
+def trace_window(node_id, name, refs, args):
+    offset = args["offset"] or 0
+    limit = args["limit"]
+    start, end = args["start"], args["end"]
+
+    if name == "basic_blocks":
+        node_start = None
+        if queries.ranged(args):
+            node_start = ancestor_index.trace_index(int(node_id))
+        lo, hi = queries.block_range(args, node_start)
+        return segments.load_range(redis_client, name, refs, lo, hi)
+
+    names = args["names"] if name == "syscalls" else None
+    if start is None and end is None and not names:
+        stop = offset + limit if limit is not None else None
+        return segments.load_range(redis_client, name, refs, offset, stop)
+
+    values = segments.load(redis_client, name, refs)
+    if start is not None or end is not None:
+        trace_indexes = [value["trace_index"] for value in values]
+        lo = bisect.bisect_left(trace_indexes, start) if start is not None else 0
+        hi = bisect.bisect_left(trace_indexes, end) if end is not None else None
+        values = values[lo:hi]
+    if names:
+        values = [value for value in values if value["name"] in names]
+    return values[offset : offset + limit if limit is not None else None]
+
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def conditional(response, etag):
+    response.set_etag(etag)
+    # Nodes grow while their trace streams in, so always revalidate
+    response.cache_control.no_cache = True
+    return response
+
+
+def trace_attribute(node_id, name):
+    args = queries.window_args(request.args)
+    if args is None:
+        return Response(status=400)
+    node_segments = Node(node_id).segments
+    if node_segments is None:
+        return jsonify(None)
+    etag = segments.etag(node_segments, [name])
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    refs = node_segments.get(name, [])
+    values = trace_window(node_id, name, refs, args)
+    response = jsonify(values.tolist() if name == "basic_blocks" else values)
+    response.headers["X-Total-Count"] = segments.length(refs)
+    return conditional(response, etag)
+
+
+@app.route("/trace/<node_id>")
+def trace(node_id):
+    attrs = request.args.get("attrs")
+    attrs = attrs.split(",") if attrs else Node.trace_attributes
+    if any(attr not in Node.trace_attributes for attr in attrs):
+        return Response(status=400)
+    args = queries.window_args(request.args)
+    if args is None:
+        return Response(status=400)
+    node_segments = Node(node_id).segments
+    if node_segments is None:
+        return jsonify(None)
+    etag = segments.etag(node_segments, attrs)
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    result = {}
+    for attr in attrs:
+        values = trace_window(node_id, attr, node_segments.get(attr, []), args)
+        result[attr] = values.tolist() if attr == "basic_blocks" else values
+    return conditional(jsonify(result), etag)
 
 
 @app.route("/trace/basic_blocks/<node_id>")
 def trace_basic_block(node_id):
-    return jsonify(Node(node_id).basic_blocks)
+    mimetype = request.accept_mimetypes.best_match(
+        ["application/json", blocks.MIMETYPE, "application/octet-stream"]
+    )
+    if mimetype == "application/json":
+        response = trace_attribute(node_id, "basic_blocks")
+        response.vary.add("Accept")
+        return response
+
+    args = queries.window_args(request.args)
+    if args is None:
+        return Response(status=400)
+    node_segments = Node(node_id).segments
+    if node_segments is None:
+        return Response(status=404)
+    codec = request.args.get("codec")
+    etag = segments.etag(node_segments, ["basic_blocks"], [mimetype, codec])
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    refs = node_segments.get("basic_blocks", [])
+    if queries.windowed(args):
+        data = blocks.encode(trace_window(node_id, "basic_blocks", refs, args), codec)
+    else:
+        data = segments.load_raw(redis_client, "basic_blocks", refs)
+        if codec and codec != blocks.codec_name(data):
+            data = blocks.encode(blocks.decode(data), codec)
+    response = Response(data, mimetype=mimetype)
+    response.headers["X-Basic-Block-Codec"] = blocks.codec_name(data)
+    response.headers["X-Total-Count"] = segments.length(refs)
+    response.vary.add("Accept")
+    return conditional(response, etag)
 
 
 @app.route("/trace/syscalls/<node_id>")
 def trace_syscall(node_id):
-    return jsonify(Node(node_id).syscalls)
+    return trace_attribute(node_id, "syscalls")
 
 
 @app.route("/trace/interactions/<node_id>")
 def trace_interactions(node_id):
-    return jsonify(Node(node_id).interactions)
+    return trace_attribute(node_id, "interactions")
 
 
 @app.route("/trace/datapoints/<node_id>")
 def trace_datapoints(node_id):
-    return jsonify(Node(node_id).datapoints)
+    return trace_attribute(node_id, "datapoints")
 
 
 @app.route("/trace/maps")
@@ -74,26 +221,121 @@ def trace_maps():
     return jsonify(Node(0).maps)
 
 
+@app.route("/subtree/<node_id>")
+def subtree(node_id):
+    # Only what a listing shows, so a client can draw a window of a large map
+    depth = request.args.get("depth", 1, type=int)
+    limit = request.args.get("limit", tree.SUBTREE_LIMIT, type=int)
+    if depth < 0 or limit < 1:
+        return Response(status=400)
+    result = tree.subtree(
+        redis_client,
+        ancestor_index,
+        int(node_id),
+        depth,
+        min(limit, tree.SUBTREE_LIMIT),
+    )
+    if result is None:
+        return Response(status=404)
+    return jsonify(result)
+
+
+@app.route("/summaries")
+def summaries_route():
+    # Either the nodes in ?ids=, or a page of all nodes by ?offset= and ?limit=
+    ids = request.args.get("ids")
+    offset = request.args.get("offset", 0, type=int)
+    limit = request.args.get("limit", tree.SUBTREE_LIMIT, type=int)
+    if offset < 0 or limit < 1:
+        return Response(status=400)
+    if ids:
+        try:
+            node_ids = [int(node_id) for node_id in ids.split(",")]
+        except ValueError:
+            return Response(status=400)
+        result = summaries.load(redis_client, node_ids[: tree.SUBTREE_LIMIT])
+    else:
+        result = summaries.page(redis_client, offset, min(limit, tree.SUBTREE_LIMIT))
+    return jsonify(dict(summaries=result))
+
+
+@app.route("/ancestors/<node_id>")
+def ancestors(node_id):
+    node_ids = tree.ancestors(ancestor_index, int(node_id))
+    if node_ids is None:
+        return Response(status=404)
+    return jsonify(dict(node_id=int(node_id), ancestors=node_ids))
+
+
+@app.route("/transcript/<node_id>")
+def transcript(node_id):
+    result = tree.transcript(redis_client, ancestor_index, int(node_id))
+    if result is None:
+        return Response(status=404)
+    return jsonify(result)
+
+
+@app.route("/coverage")
+def coverage_summary():
+    return jsonify(coverage.summary(redis_client))
+
+
+@app.route("/coverage/address/<address>")
+def coverage_address(address):
+    return jsonify(
+        coverage.address_hits(redis_client, int(address, 0), request.args.get("module"))
+    )
+
+
+@app.route("/coverage/timeline")
+def coverage_timeline():
+    count = request.args.get("count", type=int)
+    return jsonify(
+        coverage.timeline(
+            redis_client,
+            request.args.get("start", "-"),
+            request.args.get("end", "+"),
+            count,
+        )
+    )
+
+
+@app.route("/coverage/novelty/<node_id>")
+def coverage_novelty(node_id):
+    node_id = int(node_id)
+    return jsonify(coverage.novelty(redis_client, [node_id])[node_id])
+
+
 @app.route("/input/<id>", methods=["POST"])
 def new_input(id):
     input_ = {
         "id": int(id),
         "data": request.json["input"],
+        "priority": request.json.get("priority", "interactive"),
+        "timing": timing.start("input"),
     }
-    redis_client.publish("event.input", json.dumps(input_))
-    return jsonify(dict(success=True))
+    if input_["priority"] not in scheduler.PRIORITIES:
+        return jsonify(dict(success=False)), 400
+    stream = events.partitioned("event.input", input_["id"])
+    events.publish(redis_client, stream, json.dumps(input_))
+    return jsonify(dict(success=True, trace=input_["timing"]["id"]))
 
 
 @socketio.on("connect")
-def on_connect():
-    for node in all_nodes():
-        emit(
-            "update",
-            {
-                "src_id": node.parent_id,
-                "dst_id": node.id,
-            },
-        )
+def on_connect(auth=None):
+    auth = auth or {}
+
+    seq = auth.get("seq")
+    if seq is not None:
+        updates = tree.missed_updates(redis_client, str(seq))
+        if updates is not None:
+            emit("updates", updates)
+            return
+
+    data = tree.snapshot(redis_client)
+    if auth.get("compress"):
+        data = zlib.compress(json.dumps(data).encode())
+    emit("snapshot", data)
 
 
 if __name__ == "__main__":
@@ -2,47 +2,121 @@
 
 import os
 import json
+import time
 import logging
 
 import redis
 from flask_socketio import SocketIO
 
-from cartprograph import context, Node
+from cartprograph import context, events, metrics, timing, tree
 
 
 l = logging.getLogger(__name__)
 logging.basicConfig(level=os.getenv("LOGLEVEL", "INFO"))
 logging.getLogger().setLevel(os.getenv("LOGLEVEL", "INFO"))
 
+BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 256))
+FLUSH_INTERVAL = float(os.getenv("BROADCAST_FLUSH_INTERVAL", 0.05))
+GROUP = "broadcast_worker"
+
 redis_client = redis.Redis(host="localhost", port=6379)
 socketio = SocketIO(message_queue="redis://localhost:6379")
 context["redis_client"] = redis_client
 
 
+class UpdateBatch:
+    def __init__(self):
+        self.node_ids = {}
+        self.entry_ids = []
+        self.seq = None
+        self.started = None
+        self.timings = []
+
+    def add(self, node_id, seq, job_timing=None):
+        if not self.node_ids:
+            self.started = time.monotonic()
+        # Keep the first position so parents still precede their children
+        self.node_ids[node_id] = seq
+        self.entry_ids.append(seq)
+        # Entries claimed again after a restart are older than the last seq
+        if self.seq is None or events.parse_id(seq) > events.parse_id(self.seq):
+            self.seq = seq
+        if job_timing is not None:
+            self.timings.append(job_timing)
+
+    def due(self):
+        if not self.node_ids:
+            return False
+        if len(self.node_ids) >= BATCH_SIZE:
+            return True
+        return time.monotonic() - self.started >= FLUSH_INTERVAL
+
+    def flush(self):
+        if not self.node_ids:
+            return
+
+        node_ids = list(self.node_ids)
+
+        l.info(f"Broadcasting {len(node_ids)} nodes up to {self.seq}")
+
+        socketio.emit(
+            "updates",
+            {"seq": self.seq, "updates": tree.updates(redis_client, node_ids)},
+        )
+
+        latency = time.monotonic() - self.started
+        pipeline = redis_client.pipeline(transaction=False)
+        # Entries are only acknowledged once they have been emitted, so a
+        # crash before then leaves them pending to be claimed again
+        pipeline.xack("event.node", GROUP, *self.entry_ids)
+        metrics.observe(redis_client, "broadcast.batch_size", len(node_ids), pipeline)
+        metrics.observe(redis_client, "broadcast.flush_latency", latency, pipeline)
+        for job_timing in self.timings:
+            timing.record(redis_client, timing.stamp(job_timing, "broadcast"), pipeline)
+        pipeline.execute()
+
+        self.node_ids = {}
+        self.entry_ids = []
+        self.started = None
+        self.timings = []
+
+
+batch = UpdateBatch()
+
+
 def handle_node_event(event):
-    node = Node(int(event["data"]))
+    job_timing = json.loads(event["timing"]) if event["timing"] is not None else None
+    batch.add(int(event["data"]), event["id"].decode(), job_timing)
+    if batch.due():
+        batch.flush()
 
-    l.info("Broadcasting %d", node.id)
 
-    socketio.emit(
-        "update",
-        {
-            "src_id": node.parent_id,
-            "dst_id": node.id,
-        },
-    )
+class BroadcastConsumer(events.EventConsumer):
+    def read(self, streams, block=None):
+        if batch.node_ids:
+            remaining = FLUSH_INTERVAL - (time.monotonic() - batch.started)
+            block = max(1, min(block, int(remaining * 1000)))
+        super().read(streams, block=block)
+        if batch.due():
+            batch.flush()
+
+    def ack(self, stream, entry_id):
+        # The batch acknowledges its entries when it is flushed
+        pass
 
 
 def main():
-    p = redis_client.pubsub(ignore_subscribe_messages=True)
-    p.psubscribe(
-        **{
+    consumer = BroadcastConsumer(
+        redis_client,
+        GROUP,
+        "broadcast_worker",
+        {
             "event.node": handle_node_event,
-        }
+        },
+        count=BATCH_SIZE,
     )
 
-    for event in p.listen():
-        pass
+    consumer.listen()
 
 
 if __name__ == "__main__":
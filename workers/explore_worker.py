@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import os
+import time
+import logging
+
+import redis
+
+from cartprograph import context, events, metrics, scheduler, coverage
+from cartprograph.explore import Explorer, load_seeds, load_dictionary
+
+
+l = logging.getLogger(__name__)
+logging.basicConfig(level=os.getenv("LOGLEVEL", "INFO"))
+logging.getLogger().setLevel(os.getenv("LOGLEVEL", "INFO"))
+
+EXPLORE_STRATEGIES = os.getenv("EXPLORE_STRATEGIES", "seed,mutation,dictionary")
+EXPLORE_SEEDS = os.getenv("EXPLORE_SEEDS")
+EXPLORE_DICTIONARY = os.getenv("EXPLORE_DICTIONARY")
+EXPLORE_RATE = float(os.getenv("EXPLORE_RATE", 10))
+EXPLORE_QUEUE_DEPTH = int(
+    os.getenv("EXPLORE_QUEUE_DEPTH", 2 * int(os.getenv("NUM_TRACERS", 4)))
+)
+EXPLORE_INPUTS_PER_NODE = int(os.getenv("EXPLORE_INPUTS_PER_NODE", 16))
+EXPLORE_REPORT_INTERVAL = float(os.getenv("EXPLORE_REPORT_INTERVAL", 10))
+
+redis_client = redis.Redis(host="localhost", port=6379)
+context["redis_client"] = redis_client
+
+explorer = Explorer(
+    redis_client,
+    [name.strip() for name in EXPLORE_STRATEGIES.split(",") if name.strip()],
+    seeds=load_seeds(EXPLORE_SEEDS),
+    dictionary=load_dictionary(EXPLORE_DICTIONARY),
+    inputs_per_node=EXPLORE_INPUTS_PER_NODE,
+)
+
+
+def handle_node_event(event):
+    explorer.observe(int(event["data"]))
+
+
+class ExploreConsumer(events.EventConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.allowance = 0
+        self.last_time = time.monotonic()
+        self.report_time = time.monotonic()
+        self.report_coverage = 0
+
+    def read(self, streams, block=None):
+        super().read(streams, block=block)
+        self.explore()
+        self.report()
+
+    def explore(self):
+        now = time.monotonic()
+        self.allowance = min(
+            self.allowance + (now - self.last_time) * EXPLORE_RATE, EXPLORE_RATE
+        )
+        self.last_time = now
+
+        # Only top up the background queue, so tracers stay busy without
+        # piling up work that interactive inputs would have to wait behind
+        depth = scheduler.queue_info(redis_client)["background"]["depth"]
+        while self.allowance >= 1 and depth < EXPLORE_QUEUE_DEPTH:
+            if explorer.explore() is None:
+                break
+            self.allowance -= 1
+            depth += 1
+
+    def report(self):
+        now = time.monotonic()
+        elapsed = now - self.report_time
+        if elapsed < EXPLORE_REPORT_INTERVAL:
+            return
+
+        covered = coverage.total(redis_client)
+        rate = (covered - self.report_coverage) / elapsed
+        self.report_time = now
+        self.report_coverage = covered
+
+        l.info(f"Coverage {covered} blocks ({rate:.2f} new/s)")
+        metrics.observe(redis_client, "explore.new_coverage_per_second", rate)
+        redis_client.hset(
+            "explore.stats",
+            mapping={
+                "coverage": covered,
+                "new_coverage_per_second": rate,
+                "candidates": len(explorer.selected),
+                "corpus": len(explorer.corpus),
+                **{
+                    f"{name}.{stat}": value
+                    for name, stats in explorer.stats.items()
+                    for stat, value in stats.items()
+                },
+            },
+        )
+
+
+def main():
+    consumer = ExploreConsumer(
+        redis_client,
+        "explore_worker",
+        "explore_worker",
+        {
+            "event.node": handle_node_event,
+        },
+    )
+
+    consumer.listen(block=int(1000 / max(EXPLORE_RATE, 1)))
+
+
+if __name__ == "__main__":
+    main()
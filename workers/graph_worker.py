@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
 import os
+import sys
 import json
-import itertools
+import time
+import signal
 import collections
 import bisect
 import logging
@@ -10,71 +12,209 @@ import logging
 import redis
 import networkx as nx
 
-from cartprograph import context, Node
+from cartprograph import (
+    context,
+    Node,
+    blocks,
+    segments,
+    events,
+    index,
+    scheduler,
+    coverage,
+    metrics,
+    timing,
+    summaries,
+)
+from cartprograph.blocks import BasicBlocks
+from cartprograph.index import AncestorIndex
+from cartprograph.prefixes import PrefixCache
 
 
 l = logging.getLogger(__name__)
 logging.basicConfig(level=os.getenv("LOGLEVEL", "INFO"))
 logging.getLogger().setLevel(os.getenv("LOGLEVEL", "INFO"))
 
+PARTITION = int(os.getenv("GRAPH_WORKER_PARTITION", 0))
+NAME = f"graph_worker.{PARTITION}"
+GRAPH_SNAPSHOT = os.getenv("GRAPH_SNAPSHOT")
+GRAPH_SNAPSHOT_INTERVAL = float(os.getenv("GRAPH_SNAPSHOT_INTERVAL", 300))
+SEGMENT_SWEEP_INTERVAL = float(os.getenv("SEGMENT_SWEEP_INTERVAL", 3600))
+
+if GRAPH_SNAPSHOT and events.NUM_GRAPH_WORKERS > 1:
+    GRAPH_SNAPSHOT = f"{GRAPH_SNAPSHOT}.{PARTITION}"
+
+if GRAPH_SNAPSHOT and index.np is None:
+    l.warning("numpy is not installed, graph snapshots are disabled")
+    GRAPH_SNAPSHOT = None
+
 redis_client = redis.Redis(host="localhost", port=6379)
 context["redis_client"] = redis_client
 context["cached_graph"] = nx.DiGraph()
-new_id = itertools.count()
+context["ancestor_index"] = AncestorIndex(redis_client)
+prefix_cache = PrefixCache(redis_client)
+
 
+def graph_version():
+    return int(redis_client.get("graph.version") or 0)
 
-def event_node(node):
+
+def load_graph():
+    version = graph_version()
+    if GRAPH_SNAPSHOT and os.path.exists(GRAPH_SNAPSHOT):
+        try:
+            ancestor_index, snapshot_version = AncestorIndex.load(
+                GRAPH_SNAPSHOT, redis_client
+            )
+        except (OSError, ValueError) as e:
+            l.warning(f"Failed to load graph snapshot: {e}")
+        else:
+            if snapshot_version != version:
+                # Ancestry never changes, only the trace lengths may be stale
+                l.info(f"Graph snapshot is stale ({snapshot_version} != {version})")
+                ancestor_index.lengths = {}
+            return ancestor_index
+
+    if redis_client.hlen("ancestry") < redis_client.zcard("nodes"):
+        ancestor_index = AncestorIndex.build(Node.edges(), Node.lengths(), redis_client)
+        ancestor_index.store()
+        return ancestor_index
+    return AncestorIndex.from_redis(redis_client)
+
+
+def save_graph():
+    version = graph_version()
+    context["ancestor_index"].save(GRAPH_SNAPSHOT, version)
+    l.info(f"Saved graph snapshot at version {version}")
+    return version
+
+
+def sweep_segments():
+    deleted = segments.sweep(redis_client, Node.segment_ids())
+    l.info(f"Deleted {deleted} unreferenced trace segments")
+
+
+class GraphConsumer(events.EventConsumer):
+    snapshot_time = 0
+    snapshot_version = None
+    sweep_time = 0
+
+    def read(self, streams, block=None):
+        super().read(streams, block=block)
+        if GRAPH_SNAPSHOT and time.monotonic() >= self.snapshot_time:
+            if graph_version() != self.snapshot_version:
+                self.snapshot_version = save_graph()
+            self.snapshot_time = time.monotonic() + GRAPH_SNAPSHOT_INTERVAL
+        # One worker sweeps for all of them
+        if PARTITION == 0 and SEGMENT_SWEEP_INTERVAL:
+            if time.monotonic() >= self.sweep_time:
+                sweep_segments()
+                self.sweep_time = time.monotonic() + SEGMENT_SWEEP_INTERVAL
+
+
+def event_node(node, job_timing=None):
     l.info(f"Node new or update: {node.id}")
-    redis_client.publish(f"event.node", node.id)
-
-
-def work_trace(node):
-    tracepoints = []
-    basic_blocks = []
-    syscalls = []
-    interactions = []
-    datapoints = []
-    root = True
-    node_ids = reversed(
-        [
-            node.id,
-            *(e[1] for e in nx.dfs_edges(context["cached_graph"].reverse(), node.id)),
-        ]
-    )
+    if job_timing is not None:
+        job_timing = json.dumps(job_timing)
+    events.publish(redis_client, "event.node", node.id, timing=job_timing)
+
+
+def summarize(node, syscalls, interactions, restart=False):
+    # Appended syscalls and interactions update the node's summary, ones that
+    # replace its trace start it over
+    summary = None if restart else node.summary
+    if summary is None:
+        summary = summaries.empty(context["ancestor_index"].depth(node.id))
+    node.summary = summaries.update(summary, syscalls, interactions, node.segments)
+
+
+def merged_prefix(node_id):
+    # Hot nodes and their children are found in the cache without walking
+    # the ancestors, which is only needed when neither is cached
+    ancestor_index = context["ancestor_index"]
+    ancestor_index.fetch(node_id)
+    for cached_id in [node_id, ancestor_index.parents[node_id]]:
+        entry = prefix_cache.get(cached_id) if cached_id is not None else None
+        if entry is not None:
+            break
+    if entry is not None and cached_id == node_id:
+        return entry["segments"], entry["root"], True
+
+    if entry is not None:
+        prefix, root_id = entry["segments"], entry["root"]
+        node_ids = [node_id]
+    else:
+        prefix = {name: [] for name in segments.ATTRIBUTES}
+        node_ids = ancestor_index.ancestors(node_id)
+        root_id = node_ids[0]
+    uncached = [
+        current_node_id
+        for current_node_id in node_ids
+        if "segments" not in Node(current_node_id).cache
+    ]
+    Node.load_many(uncached, ["segments"])
     for current_node_id in node_ids:
-        current_node = Node(current_node_id)
-        if root:
-            tracepoints.extend(current_node.tracepoints)
-            root = False
-        basic_blocks.extend(current_node.basic_blocks)
-        syscalls.extend(current_node.syscalls)
-        interactions.extend(current_node.interactions)
-        datapoints.extend(current_node.datapoints)
-
-    trace = json.dumps(
-        {
-            "node_id": node.id,
-            "tracepoints": tracepoints,
-            "basic_blocks": basic_blocks,
-            "syscalls": syscalls,
-            "interactions": interactions,
-            "datapoints": datapoints,
-        }
-    )
-    redis_client.rpush("work.trace", trace)
+        current_node_segments = Node(current_node_id).segments
+        for name in segments.ATTRIBUTES:
+            prefix[name].extend(current_node_segments[name])
+    prefix_cache.put(node_id, prefix, root_id)
+    return prefix, root_id, False
+
+
+def work_trace(
+    node, checkpoint=None, priority="interactive", promote=False, job_timing=None
+):
+    start_time = time.perf_counter()
+    ancestor_index = context["ancestor_index"]
+    ancestor_index.fetch(node.id)
+    parent_id = ancestor_index.parents[node.id]
+    if parent_id is None:
+        prefix = {name: [] for name in segments.ATTRIBUTES}
+        root_id = node.id
+    else:
+        prefix, root_id, hit = merged_prefix(parent_id)
+        metrics.observe(redis_client, "work_trace.prefix_hit", int(hit))
+
+    trace = {
+        "node_id": node.id,
+        "tracepoints": Node(root_id).tracepoints,
+        "segments": prefix,
+        "basic_blocks": blocks.dumps(node.basic_blocks),
+        "syscalls": node.syscalls,
+        "interactions": node.interactions,
+        "datapoints": node.datapoints,
+    }
+    worker = None
+    if checkpoint is not None:
+        trace["checkpoint"] = checkpoint["key"]
+        worker = checkpoint["worker"]
+    if job_timing is None:
+        trace["timing"] = timing.start("submitted")
+    else:
+        trace["timing"] = timing.stamp(job_timing, "submitted")
+    if not scheduler.submit(redis_client, trace, priority, worker, promote=promote):
+        return
+    prepare_time = time.perf_counter() - start_time
+    metrics.observe(redis_client, "work_trace.prepare_time", prepare_time)
+
+    if events.partition(node.id) != PARTITION:
+        # The worker owning this node rewrites it once the trace comes back
+        ancestor_index.forget_lengths(node.id)
+        node.cache.clear()
 
 
 def initialize_graph(tracepoints=None):
     if tracepoints is None:
         tracepoints = []
-    node = Node(next(new_id))
-    node.parent_id = None
-    node.tracepoints = tracepoints
-    node.basic_blocks = []
-    node.syscalls = []
-    node.interactions = []
-    node.datapoints = []
-    node.maps = None
+    node = Node.create(Node.allocate_id())
+    with node.batch():
+        node.parent_id = None
+        node.tracepoints = tracepoints
+        node.basic_blocks = BasicBlocks()
+        node.syscalls = []
+        node.interactions = []
+        node.datapoints = []
+        node.maps = None
+        summarize(node, [], [], restart=True)
     work_trace(node)
 
 
@@ -89,44 +229,105 @@ def handle_input_event(event):
     node = Node(event_data["id"])
 
     input_data = event_data["data"]
-
-    new_node = Node(next(new_id), copy_from=node)
-
-    new_node.interactions[-1]["data"] = input_data
-    new_node.invalidate("interactions")
+    priority = event_data.get("priority", "interactive")
+    if "timing" in event_data:
+        job_timing = timing.stamp(event_data["timing"], "input_event")
+    else:
+        job_timing = timing.start("input_event")
+
+    # The same input to the same blocked node always produces the same trace
+    path = scheduler.path_hash(node.id, input_data)
+    existing_id = redis_client.hget("paths", path)
+    if existing_id is not None:
+        existing_id = int(existing_id)
+        l.info(f"Duplicate input for {node.id}, already node {existing_id}")
+        if scheduler.promotable(redis_client, existing_id, priority):
+            work_trace(Node(existing_id), priority=priority, promote=True)
+        return
+
+    checkpoint = redis_client.hget("checkpoints", node.id)
+    if checkpoint is not None:
+        checkpoint = json.loads(checkpoint)
+        pipeline = redis_client.pipeline(transaction=False)
+        pipeline.hdel("checkpoints", node.id)
+        pipeline.hdel("checkpoints.nodes", checkpoint["key"])
+        pipeline.execute()
+
+    interactions = node.interactions
+    interactions[-1]["data"] = input_data
+
+    new_node = Node.create(Node.allocate_id())
+    with new_node.batch():
+        for name, value in node:
+            setattr(new_node, name, value)
+        new_node.interactions = interactions
+        summarize(new_node, new_node.syscalls, interactions, restart=True)
+        new_node.pipeline.hset("paths", path, new_node.id)
 
     l.info("New input: %d", new_node.id)
 
     event_node(new_node)
-    work_trace(new_node)
+    work_trace(new_node, checkpoint, priority, job_timing=job_timing)
+
+
+def trace_state(node_id):
+    state = redis_client.hget("tracing", node_id)
+    return json.loads(state) if state is not None else None
 
 
 def handle_trace_event(event):
     trace = json.loads(event["data"])
-    blocked = event["channel"] == b"event.trace.blocked"
-
     node_id = trace["node_id"]
-    basic_blocks = trace["basic_blocks"]
+    job_id = trace.get("job")
+    seq = trace.get("seq", 0)
+
+    # Progress and the final chunk of a trace arrive on different streams, so
+    # chunks are applied in order and any that arrive early wait their turn
+    chunks_key = f"tracing.chunks.{node_id}"
+    state = trace_state(node_id)
+    if seq == 0 and (state is None or state["job"] != job_id):
+        state = {
+            "job": job_id,
+            "seq": 0,
+            "current": node_id,
+            "cluster": None,
+            "trace_index": context["ancestor_index"].trace_index(node_id),
+        }
+    elif state is None or state["job"] != job_id or state["seq"] != seq:
+        chunk = {"channel": event["channel"].decode(), "data": event["data"].decode()}
+        redis_client.hset(chunks_key, f"{job_id}.{seq}", json.dumps(chunk))
+        return
+
+    channel = event["channel"].decode()
+    while not trace.get("aborted") and apply_trace_chunk(state, channel, trace):
+        state["seq"] += 1
+        redis_client.hset("tracing", node_id, json.dumps(state))
+
+        chunk_id = f"{job_id}.{state['seq']}"
+        chunk = redis_client.hget(chunks_key, chunk_id)
+        if chunk is None:
+            return
+        redis_client.hdel(chunks_key, chunk_id)
+        chunk = json.loads(chunk)
+        channel = chunk["channel"]
+        trace = json.loads(chunk["data"])
+
+    if trace.get("aborted"):
+        l.warning(f"Trace of node {node_id} was aborted after {trace['seq']} chunks")
+    redis_client.hdel("tracing", node_id)
+    redis_client.delete(chunks_key)
+
+
+def apply_trace_chunk(state, channel, trace):
+    blocked = channel.startswith("event.trace.blocked")
+    progress = channel.startswith("event.trace.progress")
+
+    basic_blocks = blocks.loads(trace["basic_blocks"])
     syscalls = trace["syscalls"]
     interactions = trace["interactions"]
     datapoints = trace["datapoints"]
     maps = trace["maps"]
-    trace_index = 0
-
-    node = Node(node_id)
-
-    if node.parent_id is not None:
-        for current_node_id in reversed(
-            [e[1] for e in nx.dfs_edges(context["cached_graph"].reverse(), node.id)]
-        ):
-            current_node = Node(current_node_id)
-            basic_blocks = basic_blocks[len(current_node.basic_blocks) :]
-            syscalls = syscalls[len(current_node.syscalls) :]
-            interactions = interactions[len(current_node.interactions) :]
-            datapoints = datapoints[len(current_node.datapoints) :]
-            trace_index += len(current_node.basic_blocks)
-    else:
-        node.maps = maps
+    trace_index = state["trace_index"]
 
     if blocked:
         blocked_basic_block, basic_blocks = basic_blocks[-1], basic_blocks[:-1]
@@ -138,91 +339,138 @@ def handle_trace_event(event):
         else:
             blocked_datapoint = None
 
-    def iter_interaction_clusters(interactions):
-        cluster_attributes = ["channel", "direction"]
-        prev_interaction = {"channel": None, "direction": None}
-        cluster = []
-        for interaction in interactions:
-            if (
-                any(
-                    prev_interaction[attribute] != interaction[attribute]
-                    for attribute in cluster_attributes
-                )
-                and cluster
-            ):
-                yield cluster
-                cluster = []
-            cluster.append(interaction)
-            prev_interaction = interaction
-        if cluster:
-            yield cluster
-
-    def iter_cluster_trace_indexes(interaction_clusters):
-        clusters = list(interaction_clusters)
-        for cluster in [*clusters[1:], None]:
-            yield cluster[0]["trace_index"] if cluster else None
-
     def split_trace(trace, trace_index):
         if trace_index is None:
             return trace[:], []
         split_index = bisect.bisect_left([e["trace_index"] for e in trace], trace_index)
         return trace[:split_index], trace[split_index:]
 
-    clusters = iter_interaction_clusters(interactions)
-    current_node = node
-    first = True
-    for cluster_trace_index in iter_cluster_trace_indexes(clusters):
-        if first:
-            first = False
-        else:
-            new_node = Node(next(new_id))
-            new_node.parent_id = current_node.id
-            current_node = new_node
+    # A new node starts wherever the channel or direction of the interactions
+    # changes, everything before that belongs to the current node
+    cluster_trace_indexes = []
+    cluster = state["cluster"]
+    for interaction in interactions:
+        interaction_cluster = [interaction["channel"], interaction["direction"]]
+        if cluster is not None and interaction_cluster != cluster:
+            cluster_trace_indexes.append(interaction["trace_index"])
+        cluster = interaction_cluster
+    state["cluster"] = cluster
+
+    current_node = Node(state["current"])
+    written = []
+    for cluster_trace_index in [*cluster_trace_indexes, None]:
         delta_index = (
             cluster_trace_index - trace_index
             if cluster_trace_index is not None
             else None
         )
-        current_node.basic_blocks = basic_blocks[:delta_index]
-        basic_blocks = basic_blocks[delta_index:]
-        trace_index = cluster_trace_index
-        current_node.syscalls, syscalls = split_trace(syscalls, cluster_trace_index)
-        current_node.interactions, interactions = split_trace(
-            interactions, cluster_trace_index
-        )
-        current_node.datapoints, datapoints = split_trace(
-            datapoints, cluster_trace_index
+        node_basic_blocks, basic_blocks = (
+            basic_blocks[:delta_index],
+            basic_blocks[delta_index:],
         )
-        event_node(current_node)
+        node_syscalls, syscalls = split_trace(syscalls, cluster_trace_index)
+        node_interactions, interactions = split_trace(interactions, cluster_trace_index)
+        node_datapoints, datapoints = split_trace(datapoints, cluster_trace_index)
+        with current_node.batch():
+            if current_node.parent_id is None:
+                current_node.maps = maps
+            # The trace starts from the beginning of the traced node
+            restart = current_node.id == trace["node_id"] and trace.get("seq", 0) == 0
+            if restart:
+                current_node.basic_blocks = node_basic_blocks
+                current_node.syscalls = node_syscalls
+                current_node.interactions = node_interactions
+                current_node.datapoints = node_datapoints
+            else:
+                current_node.append("basic_blocks", node_basic_blocks)
+                current_node.append("syscalls", node_syscalls)
+                current_node.append("interactions", node_interactions)
+                current_node.append("datapoints", node_datapoints)
+            summarize(current_node, node_syscalls, node_interactions, restart)
+        written.append((current_node, node_basic_blocks))
+
+        if cluster_trace_index is not None:
+            trace_index = cluster_trace_index
+            parent_id = current_node.id
+            current_node = Node.create(Node.allocate_id())
+            with current_node.batch():
+                current_node.parent_id = parent_id
+    state["current"] = current_node.id
+    state["trace_index"] = trace_index + len(node_basic_blocks)
 
     if blocked:
-        new_node = Node(next(new_id))
-        new_node.parent_id = current_node.id
-        new_node.basic_blocks = [blocked_basic_block]
-        new_node.syscalls = [blocked_syscall]
-        new_node.interactions = [blocked_interaction]
-        new_node.datapoints = [blocked_datapoint] if blocked_datapoint else []
-        event_node(new_node)
+        new_node = Node.create(Node.allocate_id())
+        with new_node.batch():
+            new_node.parent_id = current_node.id
+            blocked_basic_blocks = BasicBlocks([blocked_basic_block])
+            new_node.basic_blocks = blocked_basic_blocks
+            written.append((new_node, blocked_basic_blocks))
+            new_node.syscalls = [blocked_syscall]
+            new_node.interactions = [blocked_interaction]
+            new_node.datapoints = [blocked_datapoint] if blocked_datapoint else []
+            summarize(new_node, [blocked_syscall], [blocked_interaction], restart=True)
+        if "checkpoint" in trace:
+            # Keyed both ways, so a trace worker evicting a checkpoint can
+            # drop its node's entry
+            pipeline = redis_client.pipeline(transaction=False)
+            pipeline.hset("checkpoints", new_node.id, json.dumps(trace["checkpoint"]))
+            pipeline.hset("checkpoints.nodes", trace["checkpoint"]["key"], new_node.id)
+            pipeline.execute()
+
+    coverage.record(
+        redis_client,
+        [(written_node.id, written_blocks) for written_node, written_blocks in written],
+        maps,
+    )
+    # The last node written is the one whose update ends the job's timing
+    job_timing = trace.get("timing")
+    if job_timing is not None:
+        timing.stamp(job_timing, "applied")
+    for i, (written_node, _) in enumerate(written):
+        event_node(written_node, job_timing if i == len(written) - 1 else None)
+    return progress
 
 
 def main():
-    p = redis_client.pubsub(ignore_subscribe_messages=True)
-    p.psubscribe(
-        **{
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    start_time = time.perf_counter()
+    ancestor_index = load_graph()
+    context["ancestor_index"] = ancestor_index
+    end_time = time.perf_counter()
+    load_time = round(end_time - start_time, 3)
+    l.info(f"Loaded {len(ancestor_index)} nodes in {load_time}s")
+
+    last_node = redis_client.zrange("nodes", -1, -1)
+    if last_node:
+        # Databases written before ids were allocated in Redis have no counter
+        next_id = int(last_node[0]) + 1
+        if int(redis_client.get("node_id") or 0) < next_id:
+            redis_client.set("node_id", next_id)
+    elif PARTITION == 0:
+        initialize_graph()
+
+    consumer = GraphConsumer(
+        redis_client,
+        "graph_worker",
+        NAME,
+        {
             "event.initialize": handle_initialize_event,
-            "event.input": handle_input_event,
-            "event.trace.blocked": handle_trace_event,
-            "event.trace.finished": handle_trace_event,
+            f"event.input.{PARTITION}": handle_input_event,
+            f"event.trace.progress.{PARTITION}": handle_trace_event,
+            f"event.trace.blocked.{PARTITION}": handle_trace_event,
+            f"event.trace.finished.{PARTITION}": handle_trace_event,
             # "event.trace.desync": handle_trace_error_event,
             # "event.trace.timeout": handle_trace_error_event,
             # "event.trace.error": handle_trace_error_event,
-        }
+        },
     )
 
-    initialize_graph()
-
-    for event in p.listen():
-        pass
+    try:
+        consumer.listen()
+    finally:
+        if GRAPH_SNAPSHOT:
+            save_graph()
 
 
 if __name__ == "__main__":
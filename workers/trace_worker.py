@@ -1,17 +1,21 @@
 #!/usr/bin/env python
 
 import os
-import re
 import time
-import signal
-import socket
 import json
-import contextlib
+import uuid
+import queue
+import threading
+import itertools
+import collections
 import logging
 
 import redis
 import archr
-import qtrace
+
+from cartprograph import blocks, segments, events, metrics, timing
+from cartprograph.scheduler import Scheduler
+from cartprograph.tracer import Block, tracer_class
 
 
 l = logging.getLogger(__name__)
@@ -24,327 +28,398 @@ TARGET_NETWORK = os.getenv("TARGET_NETWORK")
 if not TARGET_IMAGE:
     raise Exception("Error: no target image specified")
 NAME = os.getenv("SUPERVISOR_PROCESS_NAME")
-
-
-class timeout(contextlib.ContextDecorator):
-    def __init__(self, seconds, suppress_timeout_errors=False):
-        self.seconds = int(seconds)
-        self.suppress = bool(suppress_timeout_errors)
-
-    def _timeout_handler(self, signum, frame):
-        raise TimeoutError()
-
-    def __enter__(self):
-        signal.signal(signal.SIGALRM, self._timeout_handler)
-        signal.alarm(self.seconds)
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        signal.alarm(0)
-        if self.suppress and exc_type is TimeoutError:
-            return True
-
-
-class Block(Exception):
-    pass
-
-
-class Desync(Exception):
-    pass
-
-
-class TracingList(list):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.current_index = 0
-        self.initial_len = len(self)
-
-    @property
-    def tracing(self):
-        return self.current_index < self.initial_len
-
-    @property
-    def current(self):
-        return self[self.current_index]
+TRACE_TIMEOUT = int(os.getenv("TRACE_TIMEOUT", 180))
+CHECKPOINT_MEMORY_LIMIT = int(os.getenv("CHECKPOINT_MEMORY_LIMIT", 1024)) * 2**20
+POOL_SIZE = int(os.getenv("POOL_SIZE", 2))
+RECYCLE_AFTER = int(os.getenv("RECYCLE_AFTER", 1))
+SEGMENT_CACHE_SIZE = int(os.getenv("SEGMENT_CACHE_SIZE", 256)) * 2**20
+TRACE_CHUNK_SIZE = int(os.getenv("TRACE_CHUNK_SIZE", segments.SEGMENT_SIZE))
+TRACE_PROGRESS_INTERVAL = float(os.getenv("TRACE_PROGRESS_INTERVAL", 0.5))
+
+
+class TargetPool:
+    def __init__(self, size, recycle_after):
+        self.size = size
+        self.recycle_after = recycle_after
+        self.idle = queue.Queue()
+        self.traces = {}
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.container_ids = itertools.count()
+        self.top_up()
+
+    def top_up(self):
+        with self.lock:
+            missing = self.size - self.idle.qsize() - self.pending
+            self.pending += max(missing, 0)
+        for _ in range(missing):
+            threading.Thread(target=self.spawn, daemon=True).start()
+
+    def spawn(self):
+        try:
+            target = archr.targets.DockerImageTarget(
+                TARGET_IMAGE, network=TARGET_NETWORK
+            )
+            target.build()
+            target.start(name=f"{NAME}_{next(self.container_ids)}")
+        except Exception:
+            l.exception("Error starting target")
+            target = None
+        with self.lock:
+            self.pending -= 1
+        if target is None:
+            time.sleep(1)
+            self.top_up()
+            return
+        self.traces[target] = 0
+        self.idle.put(target)
+
+    def acquire(self):
+        while True:
+            target = self.idle.get()
+            self.top_up()
+            if self.healthy(target):
+                return target
+            l.warning("Discarding unhealthy target")
+            self.discard(target)
+
+    def release(self, target):
+        self.traces[target] += 1
+        if (
+            self.traces[target] < self.recycle_after
+            and self.idle.qsize() < self.size
+            and self.healthy(target)
+        ):
+            self.idle.put(target)
+        else:
+            self.discard(target)
+            self.top_up()
+
+    def discard(self, target):
+        def remove():
+            target.stop()
+            target.remove()
+
+        del self.traces[target]
+        threading.Thread(target=remove, daemon=True).start()
+
+    @staticmethod
+    def healthy(target):
+        try:
+            target.container.reload()
+        except Exception:
+            return False
+        return target.container.status == "running"
+
+
+class TraceSession(threading.Thread):
+    def __init__(self, pool, target, job, prefix):
+        super().__init__(daemon=True)
+        self.pool = pool
+        self.target = target
+        self.job = job
+        # The prefix is read a segment at a time as it replays, so the lists
+        # only hold the job's own trace and what is traced after it
+        self.offsets = {name: 0 for name in segments.ATTRIBUTES}
+        self.events = queue.Queue()
+        self.resumes = queue.Queue()
+        self.parked = False
+        self.seq = 0
+        self.progress_time = time.monotonic() + TRACE_PROGRESS_INTERVAL
+
+        basic_blocks = blocks.loads(job["basic_blocks"])
+        # Where the current job's blocks start, and how many of them replay
+        self.start_index = 0
+        self.replayed_blocks = len(prefix["basic_blocks"]) + len(basic_blocks)
+        self.machine = tracer_class(job["tracepoints"])(
+            target,
+            basic_blocks,
+            job["syscalls"],
+            job["interactions"],
+            job["datapoints"],
+            prefix=prefix,
+            on_block=self.park,
+            on_progress=self.progress,
+        )
 
     @property
-    def previous(self):
-        return self[self.current_index - 1]
-
-    def append(self, element, *, ignore_attrs=None):
-        if self.tracing:
-            if ignore_attrs:
-                attrs = (set(self.current) | set(element)) - set(ignore_attrs)
-                if any(self.current[attr] != element[attr] for attr in attrs):
-                    raise Desync()
-            elif self.current != element:
-                raise Desync()
+    def memory_usage(self):
+        # A one shot sample does not wait for a second reading to compute the
+        # CPU usage, which takes about a second
+        stats = self.target.container.stats(stream=False, one_shot=True)
+        return stats["memory_stats"].get("usage", 0)
+
+    def run(self):
+        try:
+            analyzer = archr.analyzers.QTraceAnalyzer(self.target)
+            analyzer.fire(lambda _: self.machine, timeout_exception=False)
+        except Block:
+            pass
+        except Exception as e:
+            self.events.put(("error", e))
         else:
-            super().append(element)
-        self.current_index += 1
-
-    def extend(self, iterable, *, ignore_attrs=None):
-        for element in iterable:
-            self.append(element, ignore_attrs=ignore_attrs)
-
-
-class CartprographTracer(qtrace.TraceMachine):
-    def __init__(
-        self, target, tracepoints, basic_blocks, syscalls, interactions, datapoints
-    ):
-        super().__init__(argv=target.target_args)
+            self.events.put(("event.trace.finished", self.trace()))
+        finally:
+            self.pool.release(self.target)
+
+    def park(self, interaction):
+        self.parked = True
+        self.events.put(("event.trace.blocked", self.trace()))
+        offsets = self.blocked_offsets()
+        job = self.resumes.get()
+        self.parked = False
+        if job is None:
+            raise Block()
+        self.job = job
+        self.offsets = offsets
+        self.seq = 0
+        self.start_index = self.machine.trace_index + 1
+        self.replayed_blocks = 0
+        return job["interactions"][-1]["data"]
+
+    def progress(self):
+        machine = self.machine
+        traces = [getattr(machine, name) for name in segments.ATTRIBUTES]
+        if any(values.tracing for values in traces):
+            return
+        timing.stamp(self.job["timing"], "replayed")
+        pending = {
+            name: len(values) - self.offsets[name]
+            for name, values in zip(segments.ATTRIBUTES, traces)
+        }
+        if (
+            pending["basic_blocks"] < TRACE_CHUNK_SIZE
+            and pending["syscalls"] < TRACE_CHUNK_SIZE
+            and not (pending["interactions"] and time.monotonic() >= self.progress_time)
+        ):
+            return
 
-        self.target = target
-        self.tracepoints = tracepoints
-        self.basic_blocks = TracingList(basic_blocks)
-        self.syscalls = TracingList(syscalls)
-        self.interactions = TracingList(interactions)
-        self.datapoints = TracingList(datapoints)
-
-        self.trace_index = -1
-        self.buffered_interaction = {
-            "channel": None,
-            "direction": None,
-            "data": None,
+        # The current basic block may still make a syscall or hit a
+        # tracepoint, so it and anything at its trace index wait for the next
+        # chunk, where graph_worker may need to start a new node from it
+        ends = {"basic_blocks": len(machine.basic_blocks) - 1}
+        for name in ["syscalls", "interactions", "datapoints"]:
+            values = getattr(machine, name)
+            end = len(values)
+            while (
+                end > self.offsets[name]
+                and values[end - 1]["trace_index"] >= machine.trace_index
+            ):
+                end -= 1
+            ends[name] = end
+
+        self.events.put(("event.trace.progress", self.trace(ends)))
+        # Everything sent is no longer needed here
+        for name, values in zip(segments.ATTRIBUTES, traces):
+            values.discard(ends[name])
+            self.offsets[name] = 0
+        self.progress_time = time.monotonic() + TRACE_PROGRESS_INTERVAL
+
+    def blocked_offsets(self):
+        machine = self.machine
+        datapoints = machine.datapoints
+        blocked_datapoint = (
+            datapoints and datapoints[-1]["trace_index"] == machine.trace_index
+        )
+        return {
+            "basic_blocks": len(machine.basic_blocks) - 1,
+            "syscalls": len(machine.syscalls) - 1,
+            "interactions": len(machine.interactions) - 1,
+            "datapoints": len(datapoints) - blocked_datapoint,
         }
 
-        self._fd_channels = {}
+    def resume(self, job):
+        self.resumes.put(job)
 
-    @property
-    def fd_channels(self):
-        if not self._fd_channels:
-            stdin, stdout, stderr = self.std_streams
-            self._fd_channels.update(
+    def close(self):
+        if self.parked:
+            self.resumes.put(None)
+        else:
+            self.target.stop()
+
+    def trace(self, ends=None):
+        if ends is None:
+            ends = {}
+        trace = {
+            "node_id": self.job["node_id"],
+            "job": self.job["job"]["id"],
+            "seq": self.seq,
+            "trace_index": (
+                self.machine.basic_blocks.discarded + self.offsets["basic_blocks"]
+            ),
+        }
+        self.seq += 1
+        for name in segments.ATTRIBUTES:
+            trace[name] = getattr(self.machine, name)[
+                self.offsets[name] : ends.get(name)
+            ]
+        trace["basic_blocks"] = blocks.dumps(trace["basic_blocks"])
+        maps = []
+        for region, mapping in self.machine.maps.items():
+            start_address, end_address = region
+            pathname, offset, permissions = mapping
+            maps.append(
                 {
-                    0: ("stdio", stdin),
-                    1: ("stdio", stdout),
-                    2: ("stderr", stderr),
+                    "start_address": start_address,
+                    "end_address": end_address,
+                    "pathname": pathname,
+                    "offset": offset,
+                    "permissions": permissions,
                 }
             )
-        return self._fd_channels
-
-    def run(self, *args, **kwargs):
-        for tracepoint in self.tracepoints:
-            address = tracepoint["address"]
-            datapoints = tracepoint["datapoints"]
-
-            @qtrace.breakpoint(address)
-            def tracepoint_callback(self, *, address=address, datapoints=datapoints):
-                data = dict()
-                for datapoint in datapoints:
-                    result = self.gdb.registers[datapoint]
-                    data[datapoint] = result
-                datapoint = {
-                    "address": address,
-                    "data": data,
-                    "trace_index": self.trace_index,
-                }
-                self.datapoints.append(datapoint)
-
-            setattr(
-                self, f"breakpoint_{hex(address)}", tracepoint_callback.__get__(self)
-            )
-
-        syscall = {
-            "nr": None,
-            "name": "execve",
-            "args": [self.target.target_args[0], self.target.target_args, {}],
-            "ret": None,
-            "trace_index": -1,
+        trace["maps"] = maps
+        return trace
+
+
+class CheckpointCache:
+    def __init__(self, redis_client, memory_limit):
+        self.redis_client = redis_client
+        self.memory_limit = memory_limit
+        self.memory_usage = 0
+        self.checkpoints = collections.OrderedDict()
+
+    def add(self, key, session):
+        if not self.memory_limit:
+            session.close()
+            return False
+        memory_usage = session.memory_usage
+        while self.checkpoints and self.memory_usage + memory_usage > self.memory_limit:
+            self.evict()
+        if memory_usage > self.memory_limit:
+            session.close()
+            return False
+        self.checkpoints[key] = (session, memory_usage)
+        self.memory_usage += memory_usage
+        return True
+
+    def pop(self, key):
+        if key not in self.checkpoints:
+            return None
+        session, memory_usage = self.checkpoints.pop(key)
+        self.memory_usage -= memory_usage
+        return session
+
+    def evict(self):
+        key, (session, memory_usage) = self.checkpoints.popitem(last=False)
+        self.memory_usage -= memory_usage
+        l.info(f"Evicting checkpoint {key}")
+        session.close()
+        # Its node is traced from the prefix instead
+        node_id = self.redis_client.hget("checkpoints.nodes", key)
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.hdel("checkpoints.nodes", key)
+        if node_id is not None:
+            pipeline.hdel("checkpoints", node_id)
+        pipeline.execute()
+
+
+def abort_trace(redis_client, job, seq):
+    # graph_worker otherwise keeps waiting for the rest of a trace it has
+    # already seen chunks of
+    trace = {
+        "node_id": job["node_id"],
+        "job": job["job"]["id"],
+        "seq": seq,
+        "aborted": True,
+    }
+    stream = events.partitioned("event.trace.finished", job["node_id"])
+    events.publish(redis_client, stream, json.dumps(trace))
+
+
+def trace_job(redis_client, job, checkpoints, pool, segment_cache):
+    node_id = job["node_id"]
+
+    session = checkpoints.pop(job.get("checkpoint"))
+    if session:
+        l.info(f"Tracing node {node_id} from checkpoint")
+        timing.stamp(job["timing"], "target")
+        session.resume(job)
+    else:
+        acquire_start_time = time.perf_counter()
+        target = pool.acquire()
+        timing.stamp(job["timing"], "target")
+        acquire_end_time = time.perf_counter()
+        acquire_time = round(acquire_end_time - acquire_start_time, 3)
+        l.info(f"Tracing node {node_id} (acquired target in {acquire_time}s)")
+        prefix = {
+            name: segments.SegmentReader(redis_client, name, refs, segment_cache)
+            for name, refs in job["segments"].items()
         }
-        self.syscalls.append(syscall)
-
-        super().run(*args, **kwargs)
-
-    def on_basic_blocks(self, addresses):
-        super().on_basic_blocks(addresses)
-        self.basic_blocks.extend(addresses)
-        self.trace_index += len(addresses)
-
-    def on_syscall_start(self, syscall_nr, *args):
-        super().on_syscall_start(syscall_nr, *args)
-        syscall_name = qtrace.syscalls["x86_64"][syscall_nr][1][len("sys_") :]
-        l.debug(f"Trace syscall start: {syscall_name}")
-        syscall = {
-            "nr": syscall_nr,
-            "name": syscall_name,
-            "args": list(args),
-            "ret": None,
-            "trace_index": self.trace_index,
-        }
-        self.syscalls.append(syscall, ignore_attrs=["ret"])
+        session = TraceSession(pool, target, job, prefix)
+        session.start()
 
-        syscall_handlers = {
-            "read": self.handle_read,
-            "write": self.handle_write,
-            "accept": self.handle_accept,
-        }
-        if syscall_name in syscall_handlers:
-            syscall_handlers[syscall_name](*args)
-
-    def on_syscall_end(self, syscall_nr, ret):
-        super().on_syscall_end(syscall_nr, ret)
-        current_syscall = self.syscalls.previous
-        syscall_name = current_syscall["name"]
-        l.debug(f"Trace syscall end: {syscall_name}")
-        assert current_syscall["nr"] == syscall_nr
-        assert current_syscall["trace_index"] == self.trace_index
-        if self.syscalls.tracing:
-            assert current_syscall["ret"] == ret
-        current_syscall["ret"] = ret
-
-        syscall_handlers = {
-            "accept": self.handle_accept_end,
-        }
-        if syscall_name in syscall_handlers:
-            syscall_handlers[syscall_name](ret)
+    start_time = time.perf_counter()
+    deadline = time.monotonic() + TRACE_TIMEOUT
 
-    def handle_read(self, fd, buf, count):
-        if fd not in self.fd_channels:
-            return
-        channel_name, channel = self.fd_channels[fd]
-        interaction = {
-            "channel": channel_name,
-            "direction": "input",
-            "data": None,
-            "trace_index": self.trace_index,
-        }
-        buffered_interaction_available = (
-            all(
-                self.buffered_interaction[attr] == interaction[attr]
-                for attr in ["channel", "direction"]
+    seq = 0
+    while True:
+        try:
+            channel, trace = session.events.get(
+                timeout=max(deadline - time.monotonic(), 0)
             )
-            and self.buffered_interaction["data"]
-        )
-
-        if self.interactions.tracing:
-            current_interaction = self.interactions.current
-            for attr in ["channel", "direction", "trace_index"]:
-                if current_interaction[attr] != interaction[attr]:
-                    raise Desync()
-            interaction["data"] = current_interaction["data"]
-        elif buffered_interaction_available:
-            interaction["data"] = self.buffered_interaction["data"]
-        else:
-            self.interactions.append(interaction)
-            raise Block()
-
-        data = interaction["data"]
-        data, buffered_data = data[:count], data[count:]
-        l.info(f"data={repr(data)}, buffered_data={repr(buffered_data)}")
-        interaction["data"] = data
-        for attr in ["channel", "direction"]:
-            self.buffered_interaction[attr] = interaction[attr]
-        self.buffered_interaction["data"] = buffered_data
-        os.write(channel.fileno(), data.encode("latin"))
-
-        if self.interactions.tracing:
-            assert self.interactions.current["data"].startswith(data)
-            self.interactions.current["data"] = data
-        self.interactions.append(interaction)
-
-    def handle_write(self, fd, buf, count):
-        if fd not in self.fd_channels:
+        except queue.Empty:
+            l.warning(f"Timed out tracing node {node_id}")
+            session.close()
+            abort_trace(redis_client, job, seq)
             return
-        channel_name, channel = self.fd_channels[fd]
-        data = os.read(channel.fileno(), count)
-        interaction = {
-            "channel": channel_name,
-            "direction": "output",
-            "data": data.decode("latin"),
-            "trace_index": self.trace_index,
-        }
-        self.interactions.append(interaction)
-
-    def handle_accept(self, sockfd, addr, addrlen):
-        # TODO: determine the port correctly (with detailed syscall info)
-        address = (self.target.ipv4_address, self.target.tcp_ports[0])
-        self.accepted_socket = socket.create_connection(address)
-
-    def handle_accept_end(self, ret):
-        if hasattr(self, "accepted_socket"):
-            port = self.accepted_socket.getpeername()[1]
-            self.fd_channels[ret] = (f"TCP:{port}", self.accepted_socket)
-            del self.accepted_socket
+        if channel != "event.trace.progress":
+            break
+        stream = events.partitioned(channel, node_id)
+        events.publish(redis_client, stream, json.dumps(trace))
+        l.debug(f"Trace progress ({trace['seq']}) from node {node_id}")
+        seq += 1
+
+    end_time = time.perf_counter()
+    total_time = round(end_time - start_time, 3)
+    l.info(f"Traced {job['timing']['id']} in {total_time}s")
+
+    if channel == "error":
+        l.error(f"Error tracing node {node_id}", exc_info=trace)
+        abort_trace(redis_client, job, seq)
+        return
+
+    trace["timing"] = timing.stamp(job["timing"], "traced")
+    new_blocks = (
+        session.machine.trace_index + 1 - session.start_index - session.replayed_blocks
+    )
+    pipeline = redis_client.pipeline(transaction=False)
+    metrics.observe(
+        redis_client, "trace_job.replayed_blocks", session.replayed_blocks, pipeline
+    )
+    metrics.observe(redis_client, "trace_job.new_blocks", max(new_blocks, 0), pipeline)
+    pipeline.execute()
+
+    key = None
+    if channel == "event.trace.blocked" and checkpoints.memory_limit:
+        key = uuid.uuid4().hex
+        trace["checkpoint"] = {"worker": NAME, "key": key}
+
+    stream = events.partitioned(channel, node_id)
+    events.publish(redis_client, stream, json.dumps(trace))
+    l.info(f"New trace ({channel}) from node {node_id}")
+
+    if channel == "event.trace.blocked":
+        # Measuring the target can take a while, so it is parked only after
+        # the trace is sent. A checkpoint that did not fit is not found when
+        # its node is resumed and is traced from the prefix instead.
+        checkpoints.add(key, session)
 
 
 def main():
     redis_client = redis.Redis(host="localhost", port=6379)
+    checkpoints = CheckpointCache(redis_client, CHECKPOINT_MEMORY_LIMIT)
+    pool = TargetPool(POOL_SIZE, RECYCLE_AFTER)
+    segment_cache = segments.SegmentCache(SEGMENT_CACHE_SIZE)
+    scheduler = Scheduler(redis_client, NAME)
 
     while True:
-        target = archr.targets.DockerImageTarget(TARGET_IMAGE, network=TARGET_NETWORK)
-        target.build()
-        target.start(name=NAME)
-        with target:
-            _, trace = redis_client.blpop("work.trace")
-            trace = json.loads(trace)
-
-            node_id = trace["node_id"]
-            tracepoints = trace["tracepoints"]
-            basic_blocks = trace["basic_blocks"]
-            syscalls = trace["syscalls"]
-            interactions = trace["interactions"]
-            datapoints = trace["datapoints"]
-
-            machine = CartprographTracer(
-                target,
-                tracepoints,
-                basic_blocks,
-                syscalls,
-                interactions,
-                datapoints,
-            )
-
-            def publish_trace(channel):
-                trace["basic_blocks"] = machine.basic_blocks
-                trace["syscalls"] = machine.syscalls
-                trace["interactions"] = machine.interactions
-                trace["datapoints"] = machine.datapoints
-                maps = []
-                for region, mapping in machine.maps.items():
-                    start_address, end_address = region
-                    pathname, offset, permissions = mapping
-                    maps.append(
-                        {
-                            "start_address": start_address,
-                            "end_address": end_address,
-                            "pathname": pathname,
-                            "offset": offset,
-                            "permissions": permissions,
-                        }
-                    )
-                trace["maps"] = maps
-                trace_data = json.dumps(trace)
-                redis_client.publish(channel, trace_data)
-                l.info(f"New trace ({channel}) from node {node_id}")
-
-            l.info(f"Tracing node {node_id}")
-            start_time = time.perf_counter()
-
-            try:
-                with timeout(180):
-                    analyzer = archr.analyzers.QTraceAnalyzer(target)
-                    analyzer.fire(lambda _: machine, timeout_exception=False)
-
-            except Block:
-                end_time = time.perf_counter()
-                total_time = round(end_time - start_time, 3)
-                l.info(f"Traced in {total_time}s")
-
-                publish_trace("event.trace.blocked")
-
-            # except Desync as e:
-            #     trace["annotation"] = traceback.format_exc()
-            #     publish_trace("event.trace.desync")
-
-            # except TimeoutError:
-            #     publish_trace("event.trace.timeout")
-
-            # except Exception as e:
-            #     trace["annotation"] = traceback.format_exc()
-            #     publish_trace("event.trace.error")
-
-            else:
-                publish_trace("event.trace.finished")
+        job = scheduler.next_job()
+        if job is None:
+            continue
+        try:
+            trace_job(redis_client, job, checkpoints, pool, segment_cache)
+        finally:
+            scheduler.done(job)
 
 
 if __name__ == "__main__":